@@ -0,0 +1,128 @@
+from apiclient.errors import HttpError
+from pydrive.files import ApiRequestError, GoogleDriveFile
+
+from metrics import METRICS
+from path_cache import PATH_CACHE
+from query import ITEM_FIELDS, children_query
+
+import time
+
+FOLDER_MIME_TYPE = "application/vnd.google-apps.folder"
+
+# Drive rejects batches of more than 100 calls.
+MAX_BATCH_SIZE = 100
+
+LOOKUP_FIELDS = "items(%s)" % ITEM_FIELDS
+FOLDER_FIELDS = "id,title,mimeType,parents(id)"
+
+def execute_batch(drive, requests):
+    """
+    Sends REQUESTS (googleapiclient HttpRequests) as multipart batches of at most MAX_BATCH_SIZE
+    calls each. Returns a list of (response, error) pairs in the same order, where exactly one of
+    the two is None. A batch that fails as a whole fails every call in it.
+    """
+    results = [None] * len(requests)
+    for start in range(0, len(requests), MAX_BATCH_SIZE):
+        def callback(request_id, response, exception):
+            error = ApiRequestError(exception) if isinstance(exception, HttpError) else exception
+            results[int(request_id)] = (response, error)
+
+        batch = drive.auth.service.new_batch_http_request(callback=callback)
+        for i in range(start, min(start + MAX_BATCH_SIZE, len(requests))):
+            batch.add(requests[i], request_id=str(i))
+
+        try:
+            with METRICS.timed("batch"):
+                batch.execute(http=drive.auth.Get_Http_Object())
+        except HttpError as e:
+            for i in range(start, min(start + MAX_BATCH_SIZE, len(requests))):
+                results[i] = (None, ApiRequestError(e))
+        except Exception as e:
+            for i in range(start, min(start + MAX_BATCH_SIZE, len(requests))):
+                results[i] = (None, e)
+
+    return results
+
+def execute_batch_with_retries(drive, make_request, items, retry_policy=None):
+    """
+    Batches MAKE_REQUEST(item) for every item in ITEMS, retrying the calls that fail with
+    retryable errors in follow-up batches. Returns a dict of item -> (response, error).
+    """
+    results, attempt = {}, 0
+    while items:
+        if retry_policy is not None:
+            for _ in range((len(items) + MAX_BATCH_SIZE - 1) // MAX_BATCH_SIZE):
+                retry_policy.rate_limiter.acquire()
+
+        retry, delay = [], 0
+        for item, (response, error) in zip(items, execute_batch(drive, [make_request(item) for item in items])):
+            results[item] = (response, error)
+            if error is not None and retry_policy is not None:
+                item_delay = retry_policy.on_failure(attempt, error)
+                if item_delay is not None:
+                    retry.append(item)
+                    delay = max(delay, item_delay)
+            elif error is None and retry_policy is not None:
+                retry_policy.rate_limiter.on_success()
+
+        items = retry
+        if items:
+            time.sleep(delay)
+            attempt += 1
+
+    return results
+
+def lookup_files_batch(drive, lookups, retry_policy=None):
+    """
+    Looks up many (parent id, title) pairs at once. Returns a dict of (parent id, title) ->
+    (drive file or None, error).
+    """
+    def make_request(lookup):
+        parent_id, title = lookup
+        return drive.auth.service.files().list(
+            q=children_query(parent_id, [title]),
+            fields=LOOKUP_FIELDS, maxResults=1)
+
+    results = {}
+    for lookup, (response, error) in execute_batch_with_retries(drive, make_request, list(lookups), retry_policy).items():
+        drive_file = None
+        if error is None and response.get("items"):
+            drive_file = GoogleDriveFile(auth=drive.auth, metadata=response["items"][0], uploaded=True)
+        results[lookup] = (drive_file, error)
+    return results
+
+def create_folders_batch(drive, folders, retry_policy=None):
+    """
+    Creates many folders at once. FOLDERS is a list of (parent id, title) pairs, none of which may
+    depend on another. Returns a dict of (parent id, title) -> (drive folder or None, error).
+    """
+    def make_request(folder):
+        parent_id, title = folder
+        return drive.auth.service.files().insert(body={
+            "title": title,
+            "parents": [{"id": parent_id}],
+            "mimeType": FOLDER_MIME_TYPE,
+        }, fields=FOLDER_FIELDS)
+
+    results = {}
+    for folder, (response, error) in execute_batch_with_retries(drive, make_request, list(folders), retry_policy).items():
+        drive_folder = None
+        if error is None:
+            drive_folder = GoogleDriveFile(auth=drive.auth, metadata=response, uploaded=True)
+        results[folder] = (drive_folder, error)
+    return results
+
+def trash_files_batch(drive, paths_and_ids, retry_policy=None):
+    """
+    Trashes many files at once. PATHS_AND_IDS is a list of (remote path, file id) pairs; trashed
+    paths are dropped from the path cache. Returns a dict of file id -> error (None on success).
+    """
+    paths = dict((file_id, path) for path, file_id in paths_and_ids)
+    make_request = lambda file_id: drive.auth.service.files().trash(fileId=file_id, fields="id")
+
+    results = {}
+    for file_id, (_, error) in execute_batch_with_retries(drive, make_request, list(paths), retry_policy).items():
+        if error is None:
+            PATH_CACHE.invalidate(paths[file_id])
+        results[file_id] = error
+    return results
@@ -0,0 +1,275 @@
+from argparse import ArgumentParser
+from pathlib import Path
+
+from fake_drive import FakeDriveServer, FakeDriveStore, FaultInjector, make_fake_drive
+from metrics import METRICS
+from path_cache import PATH_CACHE
+
+import gc, json, math, random, sys, tempfile, time, tracemalloc
+
+SCENARIOS = ["diff", "diff-snapshot", "upload", "upload-dedup", "upload-bundled", "download", "stream"]
+
+def make_synthetic_tree(root, depth=3, fan_out=4, files_per_folder=20, median_size=32 * 1024, sigma=1.5, seed=0):
+    """
+    Creates a tree of folders DEPTH levels deep under ROOT, each with FAN_OUT subfolders (but the
+    deepest) and FILES_PER_FOLDER files whose sizes follow a lognormal distribution around
+    MEDIAN_SIZE. Files are sparse, so even a big tree costs next to nothing on disk, and read back
+    as zeros. Returns a 2-tuple of (number of files, total bytes).
+    """
+    rng = random.Random(seed)
+    root = Path(root)
+    num_files, total_bytes = 0, 0
+    folders = [root]
+    for level in range(depth + 1):
+        next_folders = []
+        for folder in folders:
+            folder.mkdir(parents=True, exist_ok=True)
+            for i in range(files_per_folder):
+                size = int(rng.lognormvariate(math.log(median_size), sigma))
+                with open(str(folder / ("file%04i.bin" % i)), "wb") as f:
+                    f.truncate(size)
+                num_files += 1
+                total_bytes += size
+            if level < depth:
+                next_folders.extend(folder / ("dir%03i" % i) for i in range(fan_out))
+        folders = next_folders
+    return num_files, total_bytes
+
+def make_retry_policy(args):
+    from retry import RateLimiter, RetryPolicy
+
+    return RetryPolicy(args.max_attempts, base_delay=0.1, max_delay=2.0,
+                       rate_limiter=RateLimiter(args.request_rate, max_rate=max(args.request_rate, 100.0)))
+
+def run_diff(drive, server, args, local_root, work_dir):
+    from syncer import get_file, get_missing_remote_files
+
+    missing = get_missing_remote_files(drive, local_root, "/bench", get_file(drive, "/bench"))
+    return {"items": len(missing)}
+
+def run_diff_snapshot(drive, server, args, local_root, work_dir):
+    from snapshot import take_snapshot
+    from syncer import get_missing_remote_files
+
+    snapshot = take_snapshot(drive, verbose=False)
+    missing = get_missing_remote_files(drive, local_root, "/bench", snapshot.get_file("/bench"), snapshot)
+    return {"items": len(missing)}
+
+def run_upload(drive, server, args, local_root, work_dir, dedup=None):
+    from uploader import UploadScheduler
+    from syncer import get_file, get_missing_remote_files
+
+    to_upload = get_missing_remote_files(drive, local_root, "/bench", get_file(drive, "/bench"))
+    scheduler = UploadScheduler(
+        lambda: make_fake_drive(server.url), num_workers=args.workers,
+        resumable_threshold=args.resumable_threshold * 1024 * 1024, chunk_size=args.chunk_size * 1024 * 1024,
+        state_dir=str(Path(work_dir) / "upload_sessions"), retry_policy=make_retry_policy(args), dedup=dedup,
+        verbose=False)
+    uploaded, errored = scheduler.run(local_root, "/bench", to_upload)
+    return {"items": uploaded, "errored": len(errored)}
+
+def run_upload_dedup(drive, server, args, local_root, work_dir):
+    from dedup import build_index
+
+    dedup = build_index(drive)
+    result = run_upload(drive, server, args, local_root, work_dir, dedup)
+    result["saved_bytes"] = dedup.saved_bytes
+    return result
+
+def run_upload_bundled(drive, server, args, local_root, work_dir):
+    from bundles import BundleUploader, BundlingScan
+    from scanner import ParallelScanner
+    from syncer import get_file, iter_missing_remote_files
+    from uploader import UploadScheduler
+
+    # Every top-level folder goes up as bundles, the files beside them one by one.
+    with ParallelScanner(local_root) as scanner:
+        bundling = BundlingScan(scanner, local_root, ["dir*"])
+        to_upload = list(iter_missing_remote_files(drive, local_root, "/bench", get_file(drive, "/bench"),
+                                                   local_scan=bundling))
+    scheduler = UploadScheduler(
+        lambda: make_fake_drive(server.url), num_workers=args.workers,
+        resumable_threshold=args.resumable_threshold * 1024 * 1024, chunk_size=args.chunk_size * 1024 * 1024,
+        state_dir=str(Path(work_dir) / "upload_sessions"), retry_policy=make_retry_policy(args), verbose=False)
+    uploaded, errored = scheduler.run(local_root, "/bench", to_upload)
+    bundler = BundleUploader(
+        lambda: make_fake_drive(server.url), num_workers=args.workers, chunk_size=args.chunk_size * 1024 * 1024,
+        retry_policy=make_retry_policy(args), verbose=False)
+    _, bundle_errored = bundler.run(local_root, "/bench", bundling.bundled)
+    return {"items": uploaded + bundler.bundled_files, "errored": len(errored) + len(bundle_errored)}
+
+def run_download(drive, server, args, local_root, work_dir):
+    from downloader import DownloadScheduler
+
+    scheduler = DownloadScheduler(
+        lambda: make_fake_drive(server.url), num_workers=args.workers, chunk_size=args.chunk_size * 1024 * 1024,
+        retry_policy=make_retry_policy(args), verbose=False)
+    downloaded, errored = scheduler.mirror(drive, "/bench", Path(work_dir) / "download")
+    return {"items": len(downloaded), "errored": len(errored)}
+
+def run_stream(drive, server, args, local_root, work_dir):
+    from drivefs import DriveFS
+
+    # Read every file the way a media player would, in small sequential reads through a DriveFS.
+    streamed = 0
+    with DriveFS(lambda: make_fake_drive(server.url), "/bench", cache_dir=Path(work_dir) / "drivefs_cache",
+                 chunk_size=args.chunk_size * 1024 * 1024, workers=args.workers,
+                 retry_policy=make_retry_policy(args)) as fs:
+        stack = [""]
+        while stack:
+            path = stack.pop()
+            for name in fs.listdir(path):
+                child_path = path + "/" + name
+                if fs.isdir(child_path):
+                    stack.append(child_path)
+                    continue
+                with fs.open(child_path) as f:
+                    while f.read(64 * 1024):
+                        pass
+                streamed += 1
+    return {"items": streamed}
+
+SCENARIO_FUNCTIONS = {
+    "diff": run_diff,
+    "diff-snapshot": run_diff_snapshot,
+    "upload": run_upload,
+    "upload-dedup": run_upload_dedup,
+    "upload-bundled": run_upload_bundled,
+    "download": run_download,
+    "stream": run_stream,
+}
+
+def run_scenario(name, args, local_root):
+    """
+    Runs the scenario NAME against a fresh fake Drive, which holds all of LOCAL_ROOT for downloads
+    and streaming,
+    nothing for uploads (but a copy elsewhere for deduplicated ones), and about
+    ARGS.remote_fraction of it for diffs. Returns a dict of results:
+    wall time, API calls by operation as the server counted them, and peak traced memory, which
+    includes the fake server's own. A scenario that raises gets an "error" instead of its items.
+    """
+    store = FakeDriveStore(keep_content=False)
+    bench_id = store.add_folder("root", "bench")["id"]
+    if name in ("download", "stream"):
+        store.add_tree(local_root, bench_id)
+    elif name == "upload-dedup":
+        store.add_tree(local_root, store.add_folder("root", "elsewhere")["id"])
+    elif name not in ("upload", "upload-bundled"):
+        rng = random.Random(args.seed)
+        store.add_tree(local_root, bench_id, include=lambda path: rng.random() < args.remote_fraction)
+
+    faults = FaultInjector(args.latency, args.jitter, args.bandwidth, args.error_rate, args.rate_limit, args.seed)
+    with FakeDriveServer(store, faults) as server, tempfile.TemporaryDirectory() as work_dir:
+        drive = make_fake_drive(server.url)
+        PATH_CACHE.clear()
+        METRICS.clear()
+        gc.collect()
+        if args.trace_memory:
+            tracemalloc.start()
+        started = time.time()
+        try:
+            result = SCENARIO_FUNCTIONS[name](drive, server, args, local_root, work_dir)
+        except Exception as e:
+            result = {"error": "%s: %s" % (type(e).__name__, str(e))}
+        result["seconds"] = time.time() - started
+        if args.trace_memory:
+            result["peak_bytes"] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        result["calls"] = server.stats()
+    return result
+
+def format_calls(calls):
+    return ", ".join("%s %i" % (operation, count) for operation, count in
+                     sorted(calls.items(), key=lambda item: -item[1]))
+
+def find_regressions(results, baseline, tolerance, call_tolerance):
+    """
+    Compares RESULTS with BASELINE (both dicts of scenario -> results). Returns a list of
+    descriptions of every figure more than TOLERANCE (or CALL_TOLERANCE, for API calls) worse.
+    """
+    regressions = []
+    for name, result in sorted(results.items()):
+        before = baseline.get(name)
+        if before is None:
+            continue
+        if "error" in result and "error" not in before:
+            regressions.append("%s: failed with %s" % (name, result["error"]))
+            continue
+        figures = [("seconds", result["seconds"], before["seconds"], tolerance),
+                   ("API calls", sum(result["calls"].values()), sum(before["calls"].values()), call_tolerance)]
+        if "peak_bytes" in result and "peak_bytes" in before:
+            figures.append(("peak memory", result["peak_bytes"], before["peak_bytes"], tolerance))
+        for figure, value, old_value, allowed in figures:
+            if value > old_value * (1 + allowed):
+                regressions.append("%s: %s went from %s to %s" % (name, figure, round(old_value, 3), round(value, 3)))
+    return regressions
+
+if __name__ == "__main__":
+    from uploader import format_bytes
+
+    parser = ArgumentParser(description="Benchmark diff, upload, download and streaming against a local fake Drive")
+    parser.add_argument("scenarios", nargs="*", metavar="SCENARIO", help="Any of %s (default all)" % ", ".join(SCENARIOS))
+    parser.add_argument("--depth", type=int, default=3, help="Levels of folders in the synthetic tree")
+    parser.add_argument("--fan-out", type=int, default=4, help="Subfolders per folder")
+    parser.add_argument("--files-per-folder", type=int, default=20)
+    parser.add_argument("--median-size", type=int, default=32, help="Median file size in KB")
+    parser.add_argument("--sigma", type=float, default=1.5, help="Spread of the lognormal file size distribution")
+    parser.add_argument("--remote-fraction", type=float, default=0.9,
+                        help="Fraction of the tree already on the fake Drive for the diff scenarios")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--resumable-threshold", type=int, default=8, help="In MB")
+    parser.add_argument("--chunk-size", type=int, default=1, help="Resumable upload and ranged download chunk size in MB")
+    parser.add_argument("--request-rate", type=float, default=1000.0)
+    parser.add_argument("--max-attempts", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0.005, help="Seconds the fake Drive adds to every request")
+    parser.add_argument("--jitter", type=float, default=0.5)
+    parser.add_argument("--bandwidth", type=float, help="Fake Drive media bytes per second")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit", type=int, help="Fake Drive calls per second")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-trace-memory", dest="trace_memory", action="store_false",
+                        help="Skip measuring memory, which slows everything down")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--baseline", help="Compare with results saved by --output, failing on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="How much slower or bigger than the baseline is still fine")
+    parser.add_argument("--call-tolerance", type=float, default=0.0,
+                        help="How many more API calls than the baseline are still fine")
+    args = parser.parse_args()
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error("Unknown scenario %s" % name)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as temp_dir:
+        # The diff expects the local and remote folders to have the same name.
+        local_root = Path(temp_dir) / "bench"
+        num_files, total_bytes = make_synthetic_tree(
+            local_root, args.depth, args.fan_out, args.files_per_folder, args.median_size * 1024, args.sigma, args.seed)
+        print("Synthetic tree: %i files, %s" % (num_files, format_bytes(total_bytes)))
+
+        print("%-14s %8s %8s %10s %10s  %s" % ("scenario", "items", "seconds", "API calls", "peak mem", "calls by operation"))
+        for name in args.scenarios or SCENARIOS:
+            result = results[name] = run_scenario(name, args, local_root)
+            print("%-14s %8s %8.2f %10i %10s  %s" % (
+                name, "failed" if "error" in result else result["items"], result["seconds"], sum(result["calls"].values()),
+                format_bytes(result["peak_bytes"]) if "peak_bytes" in result else "-", format_calls(result["calls"])))
+            if "error" in result:
+                print("  %s" % result["error"][ : 300])
+            elif result.get("errored"):
+                print("  %i items errored" % result["errored"])
+            if result.get("saved_bytes"):
+                print("  %s not uploaded thanks to deduplication" % format_bytes(result["saved_bytes"]))
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            regressions = find_regressions(results, json.load(f), args.tolerance, args.call_tolerance)
+        for regression in regressions:
+            print("Regression: %s" % regression)
+        if regressions:
+            sys.exit(1)
+        print("No regressions against %s" % args.baseline)
@@ -0,0 +1,496 @@
+from argparse import ArgumentParser
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from fnmatch import fnmatch
+from pathlib import Path
+
+from apiclient.http import MediaIoBaseUpload
+
+from downloader import get_range
+from metrics import METRICS
+from query import ITEM_FIELDS, find_child
+from retry import RetryPolicy
+from scanner import scan
+from syncer import create_remote_folder, create_remote_path, get_file
+
+import gzip, io, json, os, tarfile, threading
+
+# A bundled local directory D is kept remotely as a folder named D + BUNDLE_SUFFIX, holding the tar
+# bundles and an index of where every file is in them.
+BUNDLE_SUFFIX = ".bundle"
+INDEX_TITLE = "index.json.gz"
+BUNDLE_MIME_TYPE = "application/x-tar"
+
+DEFAULT_BUNDLE_SIZE = 64 * 1024 * 1024
+
+# Each member's tar header is held in memory while its bundle streams out, so cap them too.
+DEFAULT_MAX_BUNDLE_FILES = 10000
+
+# When restoring, ranges of a bundle this close together are fetched in one request, up to a
+# request of MAX_RANGE bytes; a member bigger than that is fetched in pieces of that size.
+DEFAULT_MAX_GAP = 1024 * 1024
+DEFAULT_MAX_RANGE = 64 * 1024 * 1024
+
+BLOCK_SIZE = tarfile.BLOCKSIZE
+
+def padding(size):
+    return -size % BLOCK_SIZE
+
+class TarStream(io.RawIOBase):
+    """
+    A tar archive of MEMBERS, a list of (local path, name in the archive, size, mtime in
+    nanoseconds), read straight off the member files: nothing is copied to disk first, and only the
+    headers are held in memory. Its size is known up front, and it can be read from any offset, as
+    a resumable upload needs to resend a chunk. A member whose size changed since it was statted
+    makes the read fail.
+    """
+
+    def __init__(self, members):
+        super().__init__()
+        # (offset, header bytes, local path, size) for each member, in archive order.
+        self.layout = []
+        self.content_offsets = []
+        offset = 0
+        for local_path, name, size, mtime_ns in members:
+            info = tarfile.TarInfo(name)
+            info.size, info.mtime, info.mode = size, mtime_ns // 10 ** 9, 0o644
+            header = info.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape")
+            self.layout.append((offset, header, Path(local_path), size))
+            self.content_offsets.append(offset + len(header))
+            offset += len(header) + size + padding(size)
+        self.starts = [start for start, _, _, _ in self.layout]
+        # Two empty blocks end the archive.
+        self.members_end = offset
+        self.size = offset + 2 * BLOCK_SIZE
+        self.position = 0
+        self.open_file = None
+
+    def close(self):
+        self.close_member()
+        super().close()
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.position = max(0, offset)
+        return self.position
+
+    def read_member(self, local_path, size, offset, length):
+        if self.open_file is None or self.open_file[0] != local_path:
+            self.close_member()
+            f = open(str(local_path), "rb")
+            if os.fstat(f.fileno()).st_size != size:
+                f.close()
+                raise ValueError("%s changed while being bundled" % local_path)
+            self.open_file = (local_path, f)
+        f = self.open_file[1]
+        f.seek(offset)
+        data = f.read(length)
+        if len(data) != length:
+            raise ValueError("%s changed while being bundled" % local_path)
+        return data
+
+    def close_member(self):
+        if self.open_file is not None:
+            self.open_file[1].close()
+            self.open_file = None
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.size - self.position
+        end = min(self.position + size, self.size)
+        parts = []
+        while self.position < end:
+            if self.position >= self.members_end:
+                piece = bytes(end - self.position)
+            else:
+                i = bisect_right(self.starts, self.position) - 1
+                start, header, local_path, member_size = self.layout[i]
+                content_start = self.content_offsets[i]
+                content_end = content_start + member_size
+                if self.position < content_start:
+                    piece = header[self.position - start : min(end, content_start) - start]
+                elif self.position < content_end:
+                    piece = self.read_member(
+                        local_path, member_size, self.position - content_start, min(end, content_end) - self.position)
+                else:
+                    piece = bytes(min(end, content_end + padding(member_size)) - self.position)
+            parts.append(piece)
+            self.position += len(piece)
+        return b"".join(parts)
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[ : len(data)] = data
+        return len(data)
+
+class BundleIndex:
+    """
+    Where every file of a bundled directory is: BUNDLES maps each bundle's title to [file id, size],
+    and FILES each path (relative to the directory) to [size, mtime in nanoseconds, bundle title,
+    offset of its content in the bundle]. Stored as gzipped JSON next to the bundles.
+    """
+
+    def __init__(self, bundles=None, files=None, next_number=0):
+        self.bundles = {} if bundles is None else bundles
+        self.files = {} if files is None else files
+        self.next_number = next_number
+
+    def dumps(self):
+        return gzip.compress(json.dumps({
+            "bundles": self.bundles,
+            "files": self.files,
+            "next_number": self.next_number,
+        }, separators=(",", ":")).encode("utf-8"))
+
+    def new_title(self):
+        title = "bundle-%05i.tar" % self.next_number
+        self.next_number += 1
+        return title
+
+    def select(self, patterns=None):
+        """
+        Returns the paths matching any of PATTERNS (globs, or folders whose whole content is
+        wanted), or every path if there are none.
+        """
+        if not patterns:
+            return sorted(self.files)
+        return sorted(
+            path for path in self.files
+            if any(fnmatch(path, pattern) or path.startswith(pattern.strip("/") + "/") for pattern in patterns)
+        )
+
+def loads_index(data):
+    saved = json.loads(gzip.decompress(data).decode("utf-8"))
+    return BundleIndex(saved["bundles"], saved["files"], saved["next_number"])
+
+def plan_bundles(index, files, bundle_size=DEFAULT_BUNDLE_SIZE, max_files=DEFAULT_MAX_BUNDLE_FILES):
+    """
+    Compares INDEX with FILES, a dict of path -> (size, mtime_ns) of what's on disk now. Returns a
+    3-tuple of (1) the titles of the bundles still holding exactly what's on disk, which are kept,
+    (2) the titles of the others, which are replaced, and (3) lists of paths to pack into new
+    bundles of about BUNDLE_SIZE bytes and at most MAX_FILES files each, in path order so
+    neighbours stay together.
+    """
+    # Bundles no file points to any more, after an interrupted run, are replaced too.
+    stale = set(index.bundles) - {entry[2] for entry in index.files.values()}
+    for path, (size, mtime_ns, title, _) in index.files.items():
+        if files.get(path) != (size, mtime_ns):
+            stale.add(title)
+    kept = [title for title in index.bundles if title not in stale]
+    bundled = {path for path, entry in index.files.items() if entry[2] not in stale}
+
+    groups, group, group_size = [], [], 0
+    for path in sorted(path for path in files if path not in bundled):
+        size = files[path][0]
+        if group and (group_size + size > bundle_size or len(group) >= max_files):
+            groups.append(group)
+            group, group_size = [], 0
+        group.append(path)
+        group_size += size
+    if group:
+        groups.append(group)
+    return kept, sorted(stale & set(index.bundles)), groups
+
+def upload_stream(drive, stream, title=None, parent_id=None, file_id=None, mime_type=BUNDLE_MIME_TYPE,
+                  chunk_size=-1):
+    """
+    Uploads the seekable STREAM through a resumable session, in chunks of CHUNK_SIZE bytes (or all
+    at once), as a new file TITLE under PARENT_ID or as new content for FILE_ID. Returns the
+    metadata of the file.
+    """
+    media = MediaIoBaseUpload(stream, mime_type, chunksize=chunk_size, resumable=True)
+    files = drive.auth.service.files()
+    if file_id is None:
+        request = files.insert(body={"title": title, "mimeType": mime_type, "parents": [{"id": parent_id}]},
+                               media_body=media, fields=ITEM_FIELDS)
+        operation = "files.insert"
+    else:
+        request = files.update(fileId=file_id, body={}, media_body=media, fields=ITEM_FIELDS)
+        operation = "files.update"
+    with METRICS.timed(operation):
+        return request.execute(http=drive.auth.Get_Http_Object())
+
+def read_index(drive, bundle_folder):
+    """
+    Returns the BundleIndex in BUNDLE_FOLDER and the metadata of its file, or (None, None) if
+    there's none.
+    """
+    index_file = find_child(drive, bundle_folder["id"], INDEX_TITLE)
+    if index_file is None:
+        return None, None
+    data = get_range(drive.auth.Get_Http_Object(), index_file["id"], 0, int(index_file["fileSize"]) - 1)
+    return loads_index(data), index_file
+
+def is_bundled(rel_dir, patterns):
+    return any(fnmatch(rel_dir, pattern.strip("/")) for pattern in patterns)
+
+class BundlingScan:
+    """
+    Wraps the LOCAL_SCAN a diff reads the local tree through (see syncer.iter_missing_remote_files)
+    to hide every directory whose path relative to LOCAL_ROOT matches one of PATTERNS (globs whose
+    * also matches /, e.g. "*/node_modules"), which are left for a BundleUploader instead. Those the
+    diff comes across are collected in BUNDLED, by relative path.
+    """
+
+    def __init__(self, local_scan, local_root, patterns):
+        self.local_scan = local_scan
+        self.local_root = Path(local_root)
+        self.patterns = patterns
+        self.bundled = {}
+        self.matches = {}
+
+    def relative(self, local_path):
+        return Path(local_path).relative_to(self.local_root).as_posix()
+
+    def is_bundled(self, rel_dir):
+        if rel_dir not in self.matches:
+            self.matches[rel_dir] = is_bundled(rel_dir, self.patterns)
+        if self.matches[rel_dir]:
+            self.bundled[rel_dir] = True
+        return self.matches[rel_dir]
+
+    def needs_visit(self, local_path):
+        return self.local_scan.needs_visit(local_path)
+
+    def list_dir(self, local_path):
+        return [
+            (name, is_dir, size) for name, is_dir, size in self.local_scan.list_dir(local_path)
+            if not (is_dir and self.is_bundled(self.relative(Path(local_path) / name)))
+        ]
+
+    def files_under(self, local_path):
+        for file_path, size in self.local_scan.files_under(local_path):
+            parts = self.relative(file_path).split("/")
+            if not any(self.is_bundled("/".join(parts[ : i])) for i in range(1, len(parts))):
+                yield file_path, size
+
+class BundleUploader:
+    """
+    Keeps bundled local directories on Drive as a handful of tar bundles of about BUNDLE_SIZE
+    bytes (and at most MAX_FILES files) each plus a BundleIndex, instead of a file per file: a tree
+    of thousands of tiny files goes up in a few requests rather than thousands. Bundles are
+    streamed off the member files, CHUNK_SIZE bytes per request, by NUM_WORKERS threads each using
+    its own GoogleDrive client built by DRIVE_FACTORY.
+
+    Bundles whose files are all unchanged are kept; the others are repacked, together with new
+    files, into new bundles, and trashed once the index no longer points at them.
+    """
+
+    def __init__(self, drive_factory, num_workers=4, bundle_size=DEFAULT_BUNDLE_SIZE,
+                 max_files=DEFAULT_MAX_BUNDLE_FILES, chunk_size=32 * 1024 * 1024, retry_policy=None,
+                 verbose=True):
+        self.drive_factory = drive_factory
+        self.num_workers = num_workers
+        self.bundle_size, self.max_files = bundle_size, max_files
+        self.chunk_size = chunk_size
+        self.retry_policy = RetryPolicy() if retry_policy is None else retry_policy
+        self.verbose = verbose
+        self.local = threading.local()
+        self.factory_lock = threading.Lock()
+        self.uploaded_bundles, self.kept_bundles, self.bundled_files = 0, 0, 0
+
+    def drive(self):
+        if getattr(self.local, "drive", None) is None:
+            with self.factory_lock:
+                self.local.drive = self.drive_factory()
+        return self.local.drive
+
+    def run(self, local_root, remote_root, rel_dirs):
+        """
+        Brings the bundles of each directory in REL_DIRS (relative to LOCAL_ROOT, bundled under the
+        matching path under REMOTE_ROOT) up to date. Returns a 2-tuple of (bundled, errored) lists,
+        holding local directories and (local directory, None, exception) triples respectively.
+        """
+        local_root, remote_root = Path(local_root), Path(remote_root)
+        bundled, errored = [], []
+        with ThreadPoolExecutor(self.num_workers, thread_name_prefix="bundle") as executor:
+            for rel_dir in rel_dirs:
+                local_dir = local_root / rel_dir
+                try:
+                    self.sync_dir(executor, local_dir, (remote_root / rel_dir).parent)
+                    bundled.append(local_dir)
+                except Exception as e:
+                    errored.append((local_dir, None, e))
+        if self.verbose:
+            print(self.summary())
+        return bundled, errored
+
+    def sync_dir(self, executor, local_dir, remote_parent_path):
+        drive = self.drive()
+        files = {entry.path: (entry.size, entry.mtime_ns) for entry in scan(local_dir) if not entry.is_dir}
+
+        folder_path = remote_parent_path / (local_dir.name + BUNDLE_SUFFIX)
+        folder = get_file(drive, str(folder_path))
+        index, index_file = None, None
+        if folder is None:
+            parent = get_file(drive, str(remote_parent_path))
+            if parent is None:
+                parent = create_remote_path(drive, str(remote_parent_path))
+            folder = self.retry_policy.call(create_remote_folder, drive, folder_path, parent)
+        else:
+            index, index_file = self.retry_policy.call(read_index, drive, folder)
+        if index is None:
+            index = BundleIndex()
+
+        kept, stale, groups = plan_bundles(index, files, self.bundle_size, self.max_files)
+        self.kept_bundles += len(kept)
+        if not groups and not stale and index_file is not None:
+            return
+
+        futures = {}
+        for group in groups:
+            title = index.new_title()
+            members = [(local_dir / path, path, files[path][0], files[path][1]) for path in group]
+            futures[executor.submit(self.retry_policy.call, self.upload_bundle, members, title, folder["id"])] = \
+                (title, group)
+
+        # Every upload is waited for, so that one failing doesn't leave the others out of the index.
+        new_bundles, new_files, error = {}, {}, None
+        for future in as_completed(futures):
+            title, group = futures[future]
+            try:
+                drive_file, content_offsets = future.result()
+            except Exception as e:
+                print("Failed to upload bundle %s of %s: %s" % (title, local_dir, str(e)))
+                error = e if error is None else error
+                continue
+            new_bundles[title] = [drive_file["id"], int(drive_file["fileSize"])]
+            for path, offset in zip(group, content_offsets):
+                new_files[path] = [files[path][0], files[path][1], title, offset]
+            self.uploaded_bundles += 1
+            self.bundled_files += len(group)
+
+        old_bundles = index.bundles
+        if error is None:
+            # Only once every new bundle is up does the index stop pointing at the ones they replace.
+            index.bundles = {title: old_bundles[title] for title in kept}
+            index.files = {path: entry for path, entry in index.files.items() if entry[2] not in stale}
+        else:
+            # Otherwise the bundles that did go up join the old ones, which stay until a later run
+            # replaces them, so nothing uploaded is orphaned and their titles aren't reused.
+            index.bundles, stale = dict(old_bundles), []
+        index.bundles.update(new_bundles)
+        index.files.update(new_files)
+        stream = io.BytesIO(index.dumps())
+        self.retry_policy.call(
+            upload_stream, drive, stream, INDEX_TITLE, folder["id"],
+            None if index_file is None else index_file["id"], "application/gzip")
+        for title in stale:
+            file_id = old_bundles[title][0]
+            with METRICS.timed("files.trash"):
+                self.retry_policy.call(lambda: drive.auth.service.files().trash(fileId=file_id, fields="id").execute(
+                    http=drive.auth.Get_Http_Object()))
+        if error is not None:
+            raise error
+
+    def upload_bundle(self, members, title, parent_id):
+        """
+        Uploads a tar of MEMBERS as TITLE under PARENT_ID. Returns its metadata and the offsets of
+        the members' contents in it.
+        """
+        with TarStream(members) as stream:
+            drive_file = upload_stream(self.drive(), stream, title, parent_id, chunk_size=self.chunk_size)
+            return drive_file, stream.content_offsets
+
+    def summary(self):
+        return "Bundles: %i uploaded holding %i files, %i unchanged and kept" % (
+            self.uploaded_bundles, self.bundled_files, self.kept_bundles)
+
+def coalesce(entries, max_gap=DEFAULT_MAX_GAP, max_range=DEFAULT_MAX_RANGE):
+    """
+    Groups ENTRIES, (path, size, offset) triples within one bundle, into runs that are fetched
+    with a request each: neighbours at most MAX_GAP bytes apart, spanning at most MAX_RANGE bytes
+    (unless it's a single member that big).
+    """
+    runs = []
+    for entry in sorted(entries, key=lambda entry: entry[2]):
+        if runs:
+            first, last = runs[-1][0], runs[-1][-1]
+            if entry[2] - (last[2] + last[1]) <= max_gap and entry[2] + entry[1] - first[2] <= max_range:
+                runs[-1].append(entry)
+                continue
+        runs.append([entry])
+    return runs
+
+def restore(drive, remote_bundle_path, local_dir, patterns=None, max_gap=DEFAULT_MAX_GAP,
+            max_range=DEFAULT_MAX_RANGE, verbose=True):
+    """
+    Restores the files of the bundled folder REMOTE_BUNDLE_PATH matching PATTERNS (see
+    BundleIndex.select; all of them by default) into LOCAL_DIR, fetching only the byte ranges of
+    the bundles holding them. Returns the local paths restored.
+    """
+    folder = get_file(drive, str(remote_bundle_path))
+    if folder is None:
+        raise ValueError("No bundled folder at %s" % remote_bundle_path)
+    index, _ = read_index(drive, folder)
+    if index is None:
+        raise ValueError("No bundle index in %s" % remote_bundle_path)
+
+    by_bundle = {}
+    for path in index.select(patterns):
+        size, _, title, offset = index.files[path]
+        by_bundle.setdefault(title, []).append((path, size, offset))
+
+    http = drive.auth.Get_Http_Object()
+    local_dir, restored = Path(local_dir), []
+    for title, entries in sorted(by_bundle.items()):
+        file_id = index.bundles[title][0]
+        for run in coalesce(entries, max_gap, max_range):
+            start, end = run[0][2], run[-1][2] + run[-1][1]
+            content = None
+            if end - start <= max_range:
+                content = get_range(http, file_id, start, end - 1) if end > start else b""
+            for path, size, offset in run:
+                local_path = local_dir / path
+                local_path.parent.mkdir(parents=True, exist_ok=True)
+                partial_path = local_path.with_name(local_path.name + ".part")
+                with open(str(partial_path), "wb") as f:
+                    if content is not None:
+                        f.write(content[offset - start : offset - start + size])
+                    else:
+                        for piece_start in range(offset, offset + size, max_range):
+                            f.write(get_range(http, file_id, piece_start, min(piece_start + max_range, offset + size) - 1))
+                mtime_ns = index.files[path][1]
+                os.utime(str(partial_path), ns=(mtime_ns, mtime_ns))
+                os.replace(str(partial_path), str(local_path))
+                restored.append(local_path)
+        if verbose:
+            print("Restored %i files from %s" % (len(entries), title))
+    return restored
+
+if __name__ == "__main__":
+    import syncer
+
+    parser = ArgumentParser(description="Restore files from a bundled folder on Drive")
+    parser.add_argument("remote", help="Remote bundled folder, ending in %s" % BUNDLE_SUFFIX)
+    parser.add_argument("local", help="Local directory to restore into")
+    parser.add_argument("patterns", nargs="*", metavar="PATTERN",
+                        help="Paths, folders or globs of the files to restore (default all)")
+    parser.add_argument("--credentials", default=syncer.CREDENTIALS_FILE)
+    parser.add_argument("--list", action="store_true", help="Only list the matching files and their bundles")
+    args = parser.parse_args()
+
+    syncer.CREDENTIALS_FILE = args.credentials
+    drive = syncer.make_drive()
+    if args.list:
+        folder = get_file(drive, args.remote)
+        index, _ = read_index(drive, folder) if folder is not None else (None, None)
+        if index is None:
+            parser.error("No bundle index at %s" % args.remote)
+        for path in index.select(args.patterns):
+            print("%s\t%s\t%i" % (path, index.files[path][2], index.files[path][0]))
+    else:
+        restore(drive, args.remote, args.local, args.patterns)
+    print(METRICS.summary())
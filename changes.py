@@ -0,0 +1,107 @@
+from apiclient import errors
+from pydrive.files import ApiRequestError
+
+from metrics import METRICS
+from path_cache import PATH_CACHE
+from snapshot import SNAPSHOT_ITEM_FIELDS
+
+import time
+
+CHANGES_FIELDS = "nextPageToken,newStartPageToken,items(fileId,deleted,file(%s,labels(trashed)))" % \
+    SNAPSHOT_ITEM_FIELDS
+
+class DriveChangesFeed:
+    """
+    Reads the Drive changes feed for the account behind DRIVE.
+    """
+
+    def __init__(self, drive, page_size=1000):
+        self.drive = drive
+        self.page_size = page_size
+
+    def get_start_page_token(self):
+        try:
+            with METRICS.timed("changes.start_token"):
+                response = self.drive.auth.service.changes().getStartPageToken().execute()
+        except errors.HttpError as error:
+            raise ApiRequestError(error)
+        return response["startPageToken"]
+
+    def list_changes(self, page_token):
+        """
+        Yields pages of changes made since PAGE_TOKEN, as 2-tuples of (changes, new start page
+        token). The new start page token is None on every page but the last.
+        """
+        while page_token is not None:
+            try:
+                with METRICS.timed("changes.list"):
+                    response = self.drive.auth.service.changes().list(
+                        pageToken=page_token,
+                        includeDeleted=True,
+                        includeSubscribed=True,
+                        maxResults=self.page_size,
+                        fields=CHANGES_FIELDS).execute()
+            except errors.HttpError as error:
+                raise ApiRequestError(error)
+
+            page_token = response.get("nextPageToken")
+            yield response.get("items", []), response.get("newStartPageToken")
+
+class RecordedChangesFeed:
+    """
+    Stand-in for DriveChangesFeed which replays a list of change resources, for exercising
+    apply_changes without a Google account. Page tokens are indices into the list.
+    """
+
+    def __init__(self, changes=(), page_size=1000):
+        self.changes = list(changes)
+        self.page_size = page_size
+
+    def record(self, change):
+        self.changes.append(change)
+
+    def get_start_page_token(self):
+        return str(len(self.changes))
+
+    def list_changes(self, page_token):
+        start = int(page_token)
+        while True:
+            page = self.changes[start : start + self.page_size]
+            start += len(page)
+            if start >= len(self.changes):
+                yield page, str(len(self.changes))
+                return
+            yield page, None
+
+def apply_changes(snapshot, feed, verbose=True):
+    """
+    Brings SNAPSHOT up to date with every change FEED reports since the snapshot's page token, and
+    advances the token. Paths that were renamed, moved or removed are also dropped from the path
+    cache. Returns the number of changes applied.
+    """
+    if snapshot.page_token is None:
+        raise ValueError("Snapshot has no changes page token to resume from")
+
+    num_changes = 0
+    for changes, new_start_page_token in feed.list_changes(snapshot.page_token):
+        for change in changes:
+            drive_file = change.get("file")
+            old_path = snapshot.get_path(change["fileId"])
+            if old_path is not None:
+                PATH_CACHE.invalidate(old_path)
+
+            if change.get("deleted") or drive_file is None or \
+               drive_file.get("labels", {}).get("trashed"):
+                snapshot.remove(change["fileId"])
+            else:
+                snapshot.add(drive_file)
+            num_changes += 1
+
+        if new_start_page_token is not None:
+            snapshot.page_token = new_start_page_token
+
+    snapshot.taken = time.time()
+    if verbose:
+        print("Applied %i remote changes to snapshot" % num_changes)
+
+    return num_changes
@@ -0,0 +1,134 @@
+from collections import namedtuple
+
+from pydrive.files import GoogleDriveFile
+
+from metrics import METRICS
+from query import ITEM_FIELDS, list_files
+from retry import get_http_error
+from snapshot import FOLDER_MIME_TYPE
+
+import threading
+
+MODES = ["copy", "parent"]
+
+# Just what's needed to find a file by its content and place a copy of it.
+INDEX_FIELDS = "id,title,fileSize,md5Checksum,parents(id)"
+
+# A remote file holding some content: its id, size, title and the ids of its parents.
+IndexEntry = namedtuple("IndexEntry", ["file_id", "size", "title", "parent_ids"])
+
+class DedupIndex:
+    """
+    Account-wide index of MD5 -> IndexEntry, for uploading a file whose content is already on Drive
+    by copying it server side (MODE "copy"), or, where the names match, by adding the new folder
+    as another parent of the existing file ("parent"), which takes no space at all but makes both
+    paths the same file.
+
+    Workers uploading the same content at once would each send it, so the first one claims the MD5
+    and the others wait to copy what it uploads.
+    """
+
+    def __init__(self, mode="copy"):
+        if mode not in MODES:
+            raise ValueError("Unknown dedup mode %s" % mode)
+        self.mode = mode
+        self.entries = {}
+        self.claimed = set()
+        self.condition = threading.Condition()
+        self.saved_files, self.saved_bytes = 0, 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, drive_file, md5=None):
+        md5 = drive_file.get("md5Checksum") if md5 is None else md5
+        if md5 is None or drive_file.get("fileSize") is None:
+            return
+        parent_ids = [parent["id"] if isinstance(parent, dict) else parent for parent in drive_file.get("parents", [])]
+        with self.condition:
+            # Keep the first file seen with the content, only taking in changes to its parents.
+            if md5 not in self.entries or self.entries[md5].file_id == drive_file["id"]:
+                self.entries[md5] = IndexEntry(
+                    drive_file["id"], int(drive_file["fileSize"]), drive_file["title"], parent_ids)
+
+    def discard(self, md5, file_id):
+        with self.condition:
+            if md5 in self.entries and self.entries[md5].file_id == file_id:
+                del self.entries[md5]
+
+    def claim(self, md5, size):
+        """
+        Returns the IndexEntry of a remote file with content MD5 (and SIZE bytes), waiting for any
+        upload of it in progress. If there's none, returns None, and the caller must release MD5
+        once it's done uploading it.
+        """
+        with self.condition:
+            while md5 in self.claimed:
+                self.condition.wait()
+            entry = self.entries.get(md5)
+            if entry is not None and entry.size == size:
+                return entry
+            self.claimed.add(md5)
+            return None
+
+    def release(self, md5, drive_file=None):
+        """
+        Gives up the claim on MD5, recording DRIVE_FILE as holding that content if it was uploaded.
+        """
+        if drive_file is not None:
+            self.add(drive_file, md5)
+        with self.condition:
+            self.claimed.discard(md5)
+            self.condition.notify_all()
+
+    def record_saved(self, size):
+        with self.condition:
+            self.saved_files += 1
+            self.saved_bytes += size
+        METRICS.inc("dedup_files_total")
+        METRICS.inc("dedup_bytes_saved_total", size)
+
+    def link(self, drive, entry, title, parent_id):
+        """
+        Puts the content of ENTRY at TITLE under PARENT_ID without uploading it, as MODE says.
+        Returns the resulting drive file.
+        """
+        files = drive.auth.service.files()
+        if self.mode == "parent" and entry.title == title and parent_id not in entry.parent_ids:
+            request = files.patch(fileId=entry.file_id, addParents=parent_id, body={}, fields=ITEM_FIELDS)
+            operation = "files.patch"
+        else:
+            request = files.copy(
+                fileId=entry.file_id, body={"title": title, "parents": [{"id": parent_id}]}, fields=ITEM_FIELDS)
+            operation = "files.copy"
+        with METRICS.timed(operation):
+            metadata = request.execute(http=drive.auth.Get_Http_Object())
+        return GoogleDriveFile(auth=drive.auth, metadata=metadata, uploaded=True)
+
+    def summary(self):
+        from uploader import format_bytes
+
+        return "Deduplicated %i files by %s instead of uploading them, saving %s" % (
+            self.saved_files, "server-side copy" if self.mode == "copy" else "adding parents or copying",
+            format_bytes(self.saved_bytes))
+
+def is_gone(error):
+    """
+    Whether ERROR says the file being copied no longer exists, so the index was out of date.
+    """
+    http_error = get_http_error(error)
+    return http_error is not None and http_error.resp is not None and http_error.resp.status == 404
+
+def build_index(drive, snapshot=None, mode="copy"):
+    """
+    Returns a DedupIndex of every file with binary content the account can see, read from
+    SNAPSHOT if given, or listed in as few pages as possible otherwise.
+    """
+    index = DedupIndex(mode)
+    if snapshot is not None:
+        drive_files = snapshot.files.values()
+    else:
+        drive_files = list_files(drive, "trashed=false and mimeType!='%s'" % FOLDER_MIME_TYPE, INDEX_FIELDS)
+    for drive_file in drive_files:
+        index.add(drive_file)
+    return index
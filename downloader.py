@@ -0,0 +1,274 @@
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import nullcontext
+from pathlib import Path
+
+from apiclient.errors import HttpError
+from pydrive.files import ApiRequestError
+
+from hashing import HashCache, md5_file
+from metrics import METRICS, Reporter
+from retry import RetryPolicy
+from session import reset_connections
+from snapshot import FOLDER_MIME_TYPE, take_snapshot
+from uploader import TransferProgress, format_bytes
+
+import hashlib, heapq, os, threading, time
+
+CONTENT_URL = "https://www.googleapis.com/drive/v2/files/%s?alt=media"
+DEFAULT_DOWNLOAD_CHUNK_SIZE = 16 * 1024 * 1024
+PARTIAL_SUFFIX = ".part"
+
+# Next to a partial file, the revision of the remote file it holds the start of. Ends like a partial
+# file itself, so it's left out of local scans along with them.
+REVISION_SUFFIX = ".revision" + PARTIAL_SUFFIX
+
+def revision_of(drive_file):
+    return drive_file.get("md5Checksum") or drive_file.get("modifiedDate")
+
+def get_range(http, file_id, offset, end, content_url=CONTENT_URL):
+    """
+    Returns bytes OFFSET to END (inclusive) of the content of FILE_ID, or, if the server ignores
+    the range and sends everything, all of it from OFFSET on.
+    """
+    uri = content_url % file_id
+    with METRICS.timed("files.get_media"):
+        response, content = http.request(uri, "GET", headers={"Range": "bytes=%i-%i" % (offset, end)})
+    if response.status == 200:
+        content = content[offset : ]
+    elif response.status != 206:
+        raise ApiRequestError(HttpError(response, content, uri=uri))
+    return content
+
+def download_file_ranged(http, file_id, download_path, size, chunk_size=DEFAULT_DOWNLOAD_CHUNK_SIZE,
+                         content_url=CONTENT_URL, on_chunk=None, throttle=None, md5=None, revision=None):
+    """
+    Streams the content of FILE_ID (SIZE bytes long) to DOWNLOAD_PATH in ranged reads of
+    CHUNK_SIZE bytes. Bytes go to a partial file next to DOWNLOAD_PATH, which is renamed into place
+    once complete. A partial file left behind by an earlier attempt is picked up where it ended if
+    it holds the same REVISION of the file (its MD5 by default, see revision_of), and started over
+    otherwise. If MD5 is given, a finished file that doesn't match it is thrown away rather than
+    renamed into place. ON_CHUNK, if given, is called with the size of each chunk written. With a
+    THROTTLE, ranges shrink to what the bandwidth limit lets through in about a second, and each
+    waits its turn. Returns the MD5 of what was written.
+    """
+    download_path = Path(download_path)
+    partial_path = download_path.with_name(download_path.name + PARTIAL_SUFFIX)
+    revision_path = download_path.with_name(download_path.name + REVISION_SUFFIX)
+    revision = md5 if revision is None else revision
+
+    offset = partial_path.stat().st_size if partial_path.exists() else 0
+    if offset > 0:
+        saved_revision = revision_path.read_text() if revision_path.exists() else None
+        if offset > size or revision is None or saved_revision != revision:
+            partial_path.unlink()
+            offset = 0
+    if offset == 0 and revision is not None:
+        revision_path.write_text(revision)
+
+    # What's already there is hashed along with the rest, so the whole file gets checked.
+    digest = hashlib.md5()
+    if offset > 0:
+        with open(str(partial_path), "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                digest.update(chunk)
+
+    with open(str(partial_path), "ab") as f:
+        while offset < size:
+            if throttle is None:
+                end = min(offset + chunk_size, size) - 1
+            else:
+                end = min(offset + throttle.chunk_size(chunk_size), size) - 1
+                throttle.consume(end + 1 - offset)
+            content = get_range(http, file_id, offset, end, content_url)[ : size - offset]
+            if not content:
+                raise ApiRequestError("Empty response downloading %s at offset %i" % (file_id, offset))
+
+            f.write(content)
+            f.flush()
+            digest.update(content)
+            offset += len(content)
+            if on_chunk is not None:
+                on_chunk(len(content))
+
+        os.fsync(f.fileno())
+
+    if md5 is not None and digest.hexdigest() != md5:
+        partial_path.unlink()
+        if revision_path.exists():
+            revision_path.unlink()
+        raise ValueError("Downloaded content of %s doesn't match its MD5 %s" % (file_id, md5))
+
+    os.replace(str(partial_path), str(download_path))
+    if revision_path.exists():
+        revision_path.unlink()
+    return digest.hexdigest()
+
+def is_up_to_date(local_path, drive_file, hash_cache=None):
+    """
+    Whether LOCAL_PATH already holds the content of DRIVE_FILE, going by size and then MD5.
+    """
+    if not local_path.exists() or local_path.stat().st_size != int(drive_file.get("fileSize", -1)):
+        return False
+    if drive_file.get("md5Checksum") is None:
+        return True
+
+    md5 = hash_cache.get(local_path) if hash_cache is not None else None
+    if md5 is None:
+        md5 = md5_file(local_path)
+        if hash_cache is not None:
+            hash_cache.put(local_path, md5)
+    return md5 == drive_file["md5Checksum"]
+
+class DownloadScheduler:
+    """
+    Mirrors a remote folder into a local directory with a pool of NUM_WORKERS threads, each with
+    its own GoogleDrive client built by DRIVE_FACTORY (and its own keep-alive HTTP connection).
+    Files already present locally with matching size and MD5 are skipped. Progress is shown through
+    REPORTER (see metrics.py), or a reporter of its own if VERBOSE.
+    """
+
+    def __init__(self, drive_factory, num_workers=4, chunk_size=DEFAULT_DOWNLOAD_CHUNK_SIZE,
+                 content_url=CONTENT_URL, retry_policy=None, hash_cache=None, executor=None, throttle=None,
+                 reporter=None, verbose=True):
+        self.drive_factory = drive_factory
+        self.num_workers = num_workers
+        self.chunk_size = chunk_size
+        self.content_url = content_url
+        self.retry_policy = RetryPolicy() if retry_policy is None else retry_policy
+        self.hash_cache = HashCache() if hash_cache is None else hash_cache
+        self.verbose = verbose
+        self.reporter = reporter
+
+        # As in UploadScheduler, an executor shared with other schedulers.
+        self.executor = executor
+
+        # Bandwidth limit (see throttle.py) on every byte downloaded, if given.
+        self.throttle = throttle
+
+        self.local = threading.local()
+        self.factory_lock = threading.Lock()
+
+    def http(self, reconnect=False):
+        if reconnect or getattr(self.local, "http", None) is None:
+            with self.factory_lock:
+                drive = self.drive_factory()
+            if reconnect:
+                reset_connections(drive)
+            self.local.http = drive.auth.Get_Http_Object()
+        return self.local.http
+
+    def mirror(self, drive, remote_path, local_dir, snapshot=None):
+        """
+        Downloads everything underneath the remote folder REMOTE_PATH into LOCAL_DIR. Uses SNAPSHOT
+        for the remote listing if given, or takes one. Returns a 2-tuple of (downloaded, errored)
+        lists, holding local paths and (local path, exception) pairs respectively.
+        """
+        local_dir = Path(local_dir)
+        if snapshot is None:
+            snapshot = take_snapshot(drive, verbose=self.verbose)
+
+        drive_dir = snapshot.get_file(remote_path)
+        if drive_dir is None or drive_dir["mimeType"] != FOLDER_MIME_TYPE:
+            raise ValueError("Remote path %s is not a folder" % str(remote_path))
+
+        to_download, skipped = [], 0
+        local_dir.mkdir(parents=True, exist_ok=True)
+        for child_path, drive_file in snapshot.walk(drive_dir, "/"):
+            local_path = local_dir / child_path.relative_to("/")
+            if drive_file["mimeType"] == FOLDER_MIME_TYPE:
+                local_path.mkdir(parents=True, exist_ok=True)
+            elif drive_file.get("fileSize") is None:
+                print("Skipping %s, which has no binary content (Google Docs file?)" % str(child_path))
+            elif is_up_to_date(local_path, drive_file, self.hash_cache):
+                skipped += 1
+            else:
+                to_download.append((local_path, drive_file))
+
+        if self.verbose:
+            print("%i files to download, %i already up to date" % (len(to_download), skipped))
+        return self.run(to_download)
+
+    def run(self, to_download):
+        progress = TransferProgress(len(to_download), direction="download")
+        downloaded, errored = [], []
+
+        reporter = self.reporter
+        if reporter is None and self.verbose:
+            reporter = Reporter().start()
+
+        def status():
+            files_per_second, bytes_per_second = progress.rates()
+            return "Downloaded %i / %i - %.2f files/s, %s/s - %i running, %i queued" % (
+                len(downloaded) + len(errored), len(to_download), files_per_second,
+                format_bytes(bytes_per_second), len(pending), len(ready) + len(delayed))
+
+        pending, delayed, ready = {}, [], deque((item, 0) for item in to_download)
+        if reporter is not None:
+            reporter.add(status)
+
+        # A shared executor belongs to the caller, so only one made here gets shut down.
+        executor_context = nullcontext(self.executor) if self.executor is not None else \
+            ThreadPoolExecutor(self.num_workers, thread_name_prefix="download")
+        with executor_context as executor:
+            # At most NUM_WORKERS downloads are handed to the executor at once, so a shared executor
+            # isn't flooded by one scheduler. READY holds (item, attempt) pairs waiting their turn.
+            sequence = 0
+            while pending or delayed or ready:
+                while delayed and delayed[0][0] <= time.time():
+                    _, _, item, attempt = heapq.heappop(delayed)
+                    ready.append((item, attempt))
+
+                while ready and len(pending) < self.num_workers:
+                    item, attempt = ready.popleft()
+                    pending[executor.submit(self.download, item, progress)] = (item, attempt)
+
+                METRICS.set("queued", len(ready) + len(delayed), direction="download")
+                METRICS.set("in_flight", len(pending), direction="download")
+
+                timeout = max(delayed[0][0] - time.time(), 0) if delayed else None
+                done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+                for future in done:
+                    item, attempt = pending.pop(future)
+                    local_path, _ = item
+                    error = future.exception()
+                    if error is None:
+                        self.retry_policy.rate_limiter.on_success()
+                        downloaded.append(local_path)
+                    else:
+                        delay = self.retry_policy.on_failure(attempt, error)
+                        if delay is not None:
+                            print("Retrying %s in %.1fs after error: %s" % (local_path, delay, str(error)))
+                            heapq.heappush(delayed, (time.time() + delay, sequence, item, attempt + 1))
+                            sequence += 1
+                            continue
+                        print("Giving up on %s: %s" % (local_path, str(error)))
+                        errored.append((local_path, error))
+
+        if reporter is not None:
+            reporter.remove(status)
+            if reporter is not self.reporter:
+                reporter.stop()
+        if self.verbose:
+            print(progress.summary())
+            print(self.retry_policy.summary())
+
+        return downloaded, errored
+
+    def download(self, item, progress):
+        local_path, drive_file = item
+        local_path.parent.mkdir(parents=True, exist_ok=True)
+
+        self.retry_policy.rate_limiter.acquire()
+        try:
+            md5 = download_file_ranged(
+                self.http(), drive_file["id"], local_path, int(drive_file["fileSize"]),
+                chunk_size=self.chunk_size, content_url=self.content_url, throttle=self.throttle,
+                md5=drive_file.get("md5Checksum"), revision=revision_of(drive_file))
+        except ConnectionError:
+            self.http(reconnect=True)
+            raise
+
+        progress.record(int(drive_file["fileSize"]))
+        # The MD5 of what was actually written, checked against the remote one where there is one.
+        self.hash_cache.put(local_path, md5)
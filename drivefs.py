@@ -0,0 +1,454 @@
+from argparse import ArgumentParser
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+
+from pydrive.files import ApiRequestError
+
+from downloader import CONTENT_URL, get_range
+from metrics import METRICS
+from retry import RetryPolicy
+from session import reset_connections
+from snapshot import FOLDER_MIME_TYPE, compact
+from syncer import get_children
+from two_way import parse_drive_time
+
+import errno, io, itertools, os, re, stat, threading, time
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+
+# Chunks fetched ahead of a sequential reader, so a player streaming a file never waits on one.
+DEFAULT_READAHEAD = 8
+
+DEFAULT_CACHE_DIR = "./drivefs_cache"
+DEFAULT_CACHE_SIZE = 1024 * 1024 * 1024
+
+# Folder listings kept, and for how many seconds, when they come from Drive rather than a snapshot.
+DEFAULT_METADATA_ENTRIES = 10000
+DEFAULT_METADATA_TTL = 60
+
+class MetadataCache:
+    """
+    LRU cache of up to MAX_ENTRIES folder listings, as folder id -> {title: metadata}, each fetched
+    by LIST_FOLDER (given a folder's metadata) when first asked for, and again once older than TTL
+    seconds (or never, if TTL is None). Of several children with the same title, the first wins.
+    """
+
+    def __init__(self, list_folder, max_entries=DEFAULT_METADATA_ENTRIES, ttl=DEFAULT_METADATA_TTL):
+        self.list_folder = list_folder
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def children(self, folder):
+        with self.lock:
+            entry = self.entries.get(folder["id"])
+            if entry is not None and (self.ttl is None or time.time() - entry[0] < self.ttl):
+                self.entries.move_to_end(folder["id"])
+                METRICS.inc("drivefs_metadata_hits_total")
+                return entry[1]
+
+        METRICS.inc("drivefs_metadata_misses_total")
+        fetched, children = time.time(), {}
+        for child in self.list_folder(folder):
+            children.setdefault(child["title"], compact(child))
+        with self.lock:
+            self.entries[folder["id"]] = (fetched, children)
+            self.entries.move_to_end(folder["id"])
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return children
+
+    def invalidate(self, folder_id=None):
+        with self.lock:
+            if folder_id is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(folder_id, None)
+
+class ChunkCache:
+    """
+    Fixed-size chunks of remote content kept as files under CACHE_DIR, one directory per version of
+    a file, evicting the least recently used once they add up to more than MAX_BYTES. Chunks left
+    by an earlier run are picked up, oldest first in line for eviction.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_CACHE_SIZE):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # (key, index) -> size, least recently used first.
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+
+        existing = []
+        for path in self.cache_dir.glob("*/*"):
+            if path.name.isdigit():
+                existing.append((path.stat().st_mtime, path.parent.name, int(path.name), path.stat().st_size))
+        for _, key, index, size in sorted(existing):
+            self.entries[(key, index)] = size
+            self.total_bytes += size
+
+    def path(self, key, index):
+        return self.cache_dir / key / str(index)
+
+    def __contains__(self, chunk):
+        with self.lock:
+            return chunk in self.entries
+
+    def get(self, key, index):
+        """
+        Returns chunk INDEX of KEY, or None if it isn't cached.
+        """
+        with self.lock:
+            if (key, index) not in self.entries:
+                return None
+            self.entries.move_to_end((key, index))
+        try:
+            with open(str(self.path(key, index)), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            # Evicted in the meantime.
+            return None
+
+    def put(self, key, index, data):
+        path = self.path(key, index)
+        path.parent.mkdir(exist_ok=True)
+        temp_path = path.with_name(path.name + ".tmp%i" % threading.get_ident())
+        with open(str(temp_path), "wb") as f:
+            f.write(data)
+        os.replace(str(temp_path), str(path))
+
+        evicted = []
+        with self.lock:
+            self.total_bytes += len(data) - self.entries.pop((key, index), 0)
+            self.entries[(key, index)] = len(data)
+            while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+                chunk, size = self.entries.popitem(last=False)
+                self.total_bytes -= size
+                evicted.append(chunk)
+        for chunk in evicted:
+            try:
+                self.path(*chunk).unlink()
+            except FileNotFoundError:
+                pass
+
+def chunk_key(drive_file, chunk_size):
+    """
+    Names the cached chunks of DRIVE_FILE, by id, content version and CHUNK_SIZE, so a file changed
+    on Drive never reads back stale chunks.
+    """
+    version = drive_file.get("md5Checksum") or re.sub(r"\W", "", drive_file.get("modifiedDate", "")) or "0"
+    return "%s_%s_%i" % (drive_file["id"], version, chunk_size)
+
+def is_dir(drive_file):
+    return drive_file["mimeType"] == FOLDER_MIME_TYPE
+
+def file_size(drive_file):
+    # Files with no binary content (e.g. Google Docs) read as empty.
+    return int(drive_file.get("fileSize", 0))
+
+class DriveFS:
+    """
+    Read-only view of the remote folder REMOTE_ROOT as a file system, without downloading anything
+    up front. Folder listings come from SNAPSHOT if given, or else from Drive as folders are first
+    looked into, through a MetadataCache. File content is fetched in ranged reads of CHUNK_SIZE
+    bytes as it's read, and kept in a ChunkCache under CACHE_DIR; a reader going through a file in
+    order gets the next READAHEAD chunks fetched ahead of it by a pool of WORKERS threads, so
+    media can be streamed straight off Drive.
+
+    Each thread uses its own GoogleDrive client built by DRIVE_FACTORY.
+    """
+
+    def __init__(self, drive_factory, remote_root="/", snapshot=None, cache_dir=DEFAULT_CACHE_DIR,
+                 cache_size=DEFAULT_CACHE_SIZE, chunk_size=DEFAULT_CHUNK_SIZE, readahead=DEFAULT_READAHEAD,
+                 workers=4, metadata_entries=DEFAULT_METADATA_ENTRIES, metadata_ttl=DEFAULT_METADATA_TTL,
+                 content_url=CONTENT_URL, retry_policy=None):
+        self.drive_factory = drive_factory
+        self.local = threading.local()
+        self.factory_lock = threading.Lock()
+        self.chunk_size = chunk_size
+        self.readahead = readahead
+        self.content_url = content_url
+        self.retry_policy = RetryPolicy() if retry_policy is None else retry_policy
+
+        if snapshot is not None:
+            self.metadata = MetadataCache(snapshot.get_children, metadata_entries, None)
+            drive_root_id = snapshot.root_id
+        else:
+            self.metadata = MetadataCache(lambda folder: get_children(self.drive(), folder), metadata_entries,
+                                          metadata_ttl)
+            drive_root_id = "root"
+        self.root = {"id": drive_root_id, "title": "", "mimeType": FOLDER_MIME_TYPE, "parents": []}
+        self.root = self.stat(remote_root)
+        if not is_dir(self.root):
+            raise NotADirectoryError(errno.ENOTDIR, "Not a remote folder", remote_root)
+
+        self.chunks = ChunkCache(cache_dir, cache_size)
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="readahead")
+        self.lock = threading.Lock()
+        # (key, index) -> Future of every chunk being fetched.
+        self.fetching = {}
+
+    def close(self):
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def drive(self):
+        if getattr(self.local, "drive", None) is None:
+            with self.factory_lock:
+                self.local.drive = self.drive_factory()
+        return self.local.drive
+
+    def http(self, reconnect=False):
+        if reconnect:
+            reset_connections(self.drive())
+        if reconnect or getattr(self.local, "http", None) is None:
+            self.local.http = self.drive().auth.Get_Http_Object()
+        return self.local.http
+
+    def stat(self, path):
+        """
+        Returns the metadata of the file or folder at PATH, relative to the remote root.
+        """
+        drive_file = self.root
+        for name in Path("/", path).parts[1 : ]:
+            if not is_dir(drive_file):
+                raise NotADirectoryError(errno.ENOTDIR, "Not a remote folder", str(path))
+            drive_file = self.metadata.children(drive_file).get(name)
+            if drive_file is None:
+                raise FileNotFoundError(errno.ENOENT, "No such remote file", str(path))
+        return drive_file
+
+    def isdir(self, path):
+        try:
+            return is_dir(self.stat(path))
+        except (FileNotFoundError, NotADirectoryError):
+            return False
+
+    def listdir(self, path="/"):
+        drive_file = self.stat(path)
+        if not is_dir(drive_file):
+            raise NotADirectoryError(errno.ENOTDIR, "Not a remote folder", str(path))
+        return list(self.metadata.children(drive_file))
+
+    def open(self, path):
+        """
+        Returns a binary, seekable file object reading the remote file at PATH.
+        """
+        drive_file = self.stat(path)
+        if is_dir(drive_file):
+            raise IsADirectoryError(errno.EISDIR, "Is a remote folder", str(path))
+        return io.BufferedReader(DriveFileReader(self, drive_file), self.chunk_size)
+
+    def read(self, drive_file, offset, size, readahead=False):
+        """
+        Returns up to SIZE bytes of DRIVE_FILE from OFFSET on, fetching whatever chunks aren't
+        cached yet. With READAHEAD, also starts fetching the chunks after them.
+        """
+        size = max(0, min(size, file_size(drive_file) - offset))
+        if size == 0:
+            return b""
+        first, last = offset // self.chunk_size, (offset + size - 1) // self.chunk_size
+        if readahead and self.readahead > 0:
+            last_in_file = (file_size(drive_file) - 1) // self.chunk_size
+            self.prefetch(drive_file, range(last + 1, min(last + self.readahead, last_in_file) + 1))
+
+        data = b"".join(self.get_chunk(drive_file, index) for index in range(first, last + 1))
+        start = offset - first * self.chunk_size
+        return data[start : start + size]
+
+    def prefetch(self, drive_file, indexes):
+        key = chunk_key(drive_file, self.chunk_size)
+        for index in indexes:
+            if (key, index) in self.chunks:
+                continue
+            with self.lock:
+                if (key, index) in self.fetching:
+                    continue
+                future = self.fetching[(key, index)] = Future()
+            self.executor.submit(self.run_fetch, drive_file, key, index, future)
+
+    def get_chunk(self, drive_file, index):
+        key = chunk_key(drive_file, self.chunk_size)
+        data = self.chunks.get(key, index)
+        if data is not None:
+            METRICS.inc("drivefs_chunk_hits_total")
+            return data
+
+        with self.lock:
+            future = self.fetching.get((key, index))
+            if future is None:
+                future = self.fetching[(key, index)] = Future()
+                owner = True
+            else:
+                owner = False
+        if not owner:
+            # Already on its way, most likely read ahead.
+            METRICS.inc("drivefs_chunk_hits_total")
+            return future.result()
+        METRICS.inc("drivefs_chunk_misses_total")
+        self.run_fetch(drive_file, key, index, future)
+        return future.result()
+
+    def run_fetch(self, drive_file, key, index, future):
+        try:
+            future.set_result(self.fetch(drive_file, key, index))
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            with self.lock:
+                self.fetching.pop((key, index), None)
+
+    def fetch(self, drive_file, key, index):
+        start = index * self.chunk_size
+        end = min(start + self.chunk_size, file_size(drive_file)) - 1
+        data = self.retry_policy.call(self.get_range, drive_file["id"], start, end)[ : end + 1 - start]
+        if len(data) != end + 1 - start:
+            raise ApiRequestError("Short response reading %s at offset %i" % (drive_file["id"], start))
+        self.chunks.put(key, index, data)
+        METRICS.inc("drivefs_bytes_fetched_total", len(data))
+        return data
+
+    def get_range(self, file_id, start, end):
+        try:
+            return get_range(self.http(), file_id, start, end, self.content_url)
+        except ConnectionError:
+            self.http(reconnect=True)
+            raise
+
+    def attributes(self, drive_file):
+        """
+        Returns os.stat style attributes of DRIVE_FILE, for the mount.
+        """
+        mtime = parse_drive_time(drive_file["modifiedDate"]) if drive_file.get("modifiedDate") else time.time()
+        if is_dir(drive_file):
+            mode, links, size = stat.S_IFDIR | 0o555, 2, 0
+        else:
+            mode, links, size = stat.S_IFREG | 0o444, 1, file_size(drive_file)
+        return {"st_mode": mode, "st_nlink": links, "st_size": size, "st_uid": os.getuid(), "st_gid": os.getgid(),
+                "st_atime": mtime, "st_mtime": mtime, "st_ctime": mtime}
+
+class DriveFileReader(io.RawIOBase):
+    """
+    Raw, seekable reads of one remote file through a DriveFS, which reads ahead for as long as
+    each read starts where the one before ended.
+    """
+
+    def __init__(self, fs, drive_file):
+        super().__init__()
+        self.fs = fs
+        self.drive_file = drive_file
+        self.position = 0
+        self.last_end = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += file_size(self.drive_file)
+        if offset < 0:
+            raise ValueError("Negative seek position %i" % offset)
+        self.position = offset
+        return self.position
+
+    def pread(self, offset, size):
+        data = self.fs.read(self.drive_file, offset, size, readahead=offset == self.last_end)
+        self.last_end = offset + len(data)
+        return data
+
+    def readinto(self, buffer):
+        data = self.pread(self.position, len(buffer))
+        buffer[ : len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+def mount(fs, mountpoint, foreground=True):
+    """
+    Mounts the DriveFS FS read-only at MOUNTPOINT through FUSE, until unmounted. Needs fusepy.
+    """
+    try:
+        from fuse import FUSE, FuseOSError, Operations
+    except ImportError as e:
+        raise ImportError("Mounting needs fusepy (pip install fusepy); DriveFS itself works without it") from e
+
+    class DriveOperations(Operations):
+        def __init__(self):
+            self.lock = threading.Lock()
+            self.readers = {}
+            self.handles = itertools.count(1)
+
+        def __call__(self, operation, *args):
+            try:
+                return super().__call__(operation, *args)
+            except FuseOSError:
+                raise
+            except OSError as e:
+                raise FuseOSError(e.errno or errno.EIO)
+            except Exception:
+                raise FuseOSError(errno.EIO)
+
+        def getattr(self, path, fh=None):
+            return fs.attributes(fs.stat(path))
+
+        def readdir(self, path, fh):
+            return [".", ".."] + fs.listdir(path)
+
+        def open(self, path, flags):
+            if flags & (os.O_WRONLY | os.O_RDWR):
+                raise FuseOSError(errno.EROFS)
+            drive_file = fs.stat(path)
+            with self.lock:
+                fh = next(self.handles)
+                self.readers[fh] = DriveFileReader(fs, drive_file)
+            return fh
+
+        def read(self, path, size, offset, fh):
+            return self.readers[fh].pread(offset, size)
+
+        def release(self, path, fh):
+            with self.lock:
+                self.readers.pop(fh, None)
+            return 0
+
+    FUSE(DriveOperations(), str(mountpoint), foreground=foreground, ro=True)
+
+if __name__ == "__main__":
+    import syncer
+    from snapshot import load_snapshot
+
+    parser = ArgumentParser(description="Mount a Drive folder read-only, fetching content as it's read")
+    parser.add_argument("mountpoint")
+    parser.add_argument("--remote", default="/", help="Remote folder to mount")
+    parser.add_argument("--credentials", default=syncer.CREDENTIALS_FILE)
+    parser.add_argument("--snapshot-file", help="Take folder listings from this saved snapshot instead of Drive")
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR)
+    parser.add_argument("--cache-size", type=int, default=DEFAULT_CACHE_SIZE // (1024 * 1024), help="In MB")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE // 1024, help="In KB")
+    parser.add_argument("--readahead", type=int, default=DEFAULT_READAHEAD, help="Chunks to fetch ahead of sequential reads")
+    parser.add_argument("--workers", type=int, default=4, help="Threads fetching chunks ahead")
+    parser.add_argument("--metadata-ttl", type=float, default=DEFAULT_METADATA_TTL,
+                        help="Seconds before a folder listing is fetched again")
+    args = parser.parse_args()
+
+    syncer.CREDENTIALS_FILE = args.credentials
+    snapshot = load_snapshot(args.snapshot_file) if args.snapshot_file is not None else None
+    with DriveFS(syncer.make_drive, args.remote, snapshot, args.cache_dir, args.cache_size * 1024 * 1024,
+                 args.chunk_size * 1024, args.readahead, args.workers, metadata_ttl=args.metadata_ttl) as fs:
+        mount(fs, args.mountpoint)
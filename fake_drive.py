@@ -0,0 +1,784 @@
+from argparse import ArgumentParser
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlsplit
+
+import hashlib, itertools, json, random, re, threading, time, uuid
+
+import httplib2
+from oauth2client.client import AccessTokenCredentials
+
+FOLDER_MIME_TYPE = "application/vnd.google-apps.folder"
+REAL_API_ROOT = "https://www.googleapis.com/"
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+class FakeDriveError(Exception):
+    """
+    An error response, in the shape the Drive API gives them so retry.py classifies it the same way.
+    """
+
+    def __init__(self, status, reason, message=None, domain="global"):
+        super().__init__(message or reason)
+        self.status, self.reason, self.domain = status, reason, domain
+
+    def body(self):
+        message = str(self)
+        return {"error": {
+            "errors": [{"domain": self.domain, "reason": self.reason, "message": message}],
+            "code": self.status,
+            "message": message,
+        }}
+
+def format_date(timestamp):
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(timestamp)) + ".%03iZ" % (int(timestamp * 1000) % 1000)
+
+# A small subset of the Drive v2 search syntax: enough for "'<id>' in parents and title='x' and
+# trashed=false", with or, not, parentheses and contains thrown in.
+QUERY_TOKEN = re.compile(r"\s*(?:('(?:[^'\\]|\\.)*')|(!=|<=|>=|=|<|>|\(|\))|([A-Za-z_][A-Za-z0-9_.]*)|(-?\d+(?:\.\d+)?))")
+
+def tokenize_query(query):
+    tokens, position = [], 0
+    query = query.rstrip()
+    while position < len(query):
+        match = QUERY_TOKEN.match(query, position)
+        if match is None:
+            raise FakeDriveError(400, "invalid", "Invalid query at %i: %s" % (position, query))
+        string, operator, word, number = match.groups()
+        if string is not None:
+            tokens.append(("value", re.sub(r"\\(.)", r"\1", string[1 : -1])))
+        elif operator is not None:
+            tokens.append(("op", operator))
+        elif word is not None and word.lower() in ("and", "or", "not", "in", "contains", "has"):
+            tokens.append(("op", word.lower()))
+        elif word is not None and word.lower() in ("true", "false"):
+            tokens.append(("value", word.lower() == "true"))
+        elif word is not None:
+            tokens.append(("field", word))
+        else:
+            tokens.append(("value", float(number)))
+        position = match.end()
+    return tokens
+
+def get_field(metadata, field):
+    if field == "trashed":
+        return metadata["labels"]["trashed"]
+    elif field == "parents":
+        return [parent["id"] for parent in metadata.get("parents", [])]
+    return metadata.get(field)
+
+def compare(value, operator, operand):
+    if value is None:
+        return operator == "!="
+    if isinstance(operand, float):
+        value = float(value)
+    return {
+        "=": value == operand, "!=": value != operand,
+        "<": value < operand, "<=": value <= operand, ">": value > operand, ">=": value >= operand,
+    }[operator]
+
+def parse_query(query, resolve=lambda file_id: file_id):
+    """
+    Compiles the Drive search QUERY into a predicate on file metadata. RESOLVE maps the ids given
+    in "'<id>' in parents" terms, e.g. the "root" alias, to actual file ids.
+    """
+    tokens = tokenize_query(query)
+    position = [0]
+
+    def peek():
+        return tokens[position[0]] if position[0] < len(tokens) else (None, None)
+
+    def take(kind=None, value=None):
+        token = peek()
+        if token[0] is None or (kind is not None and token[0] != kind) or (value is not None and token[1] != value):
+            raise FakeDriveError(400, "invalid", "Invalid query: %s" % query)
+        position[0] += 1
+        return token[1]
+
+    def parse_or():
+        terms = [parse_and()]
+        while peek() == ("op", "or"):
+            take()
+            terms.append(parse_and())
+        return terms[0] if len(terms) == 1 else lambda metadata: any(term(metadata) for term in terms)
+
+    def parse_and():
+        terms = [parse_unary()]
+        while peek() == ("op", "and"):
+            take()
+            terms.append(parse_unary())
+        return terms[0] if len(terms) == 1 else lambda metadata: all(term(metadata) for term in terms)
+
+    def parse_unary():
+        if peek() == ("op", "not"):
+            take()
+            term = parse_unary()
+            return lambda metadata: not term(metadata)
+        if peek() == ("op", "("):
+            take()
+            term = parse_or()
+            take("op", ")")
+            return term
+        if peek()[0] == "value":
+            value = take()
+            take("op", "in")
+            field = take("field")
+            if field == "parents":
+                value = resolve(value)
+            return lambda metadata: value in (get_field(metadata, field) or [])
+        field = take("field")
+        operator = take("op")
+        operand = take("value")
+        if operator == "contains":
+            return lambda metadata: operand in (get_field(metadata, field) or "")
+        if operator not in ("=", "!=", "<", "<=", ">", ">="):
+            raise FakeDriveError(400, "invalid", "Invalid query: %s" % query)
+        return lambda metadata: compare(get_field(metadata, field), operator, operand)
+
+    if not tokens:
+        return lambda metadata: True
+    predicate = parse_or()
+    if position[0] != len(tokens):
+        raise FakeDriveError(400, "invalid", "Invalid query: %s" % query)
+    return predicate
+
+FIELD_NAME = re.compile(r"\s*([A-Za-z0-9_/*]+)\s*")
+
+def parse_fields(spec):
+    """
+    Parses a partial response selector such as "nextPageToken,items(id,labels/trashed)" into a
+    nested dict of field name -> selector for its subfields, or None for the whole field.
+    """
+    position = [0]
+
+    def parse_list():
+        selector = {}
+        while position[0] < len(spec) and spec[position[0]] != ")":
+            match = FIELD_NAME.match(spec, position[0])
+            if match is None:
+                raise FakeDriveError(400, "invalidParameter", "Invalid field selection %s" % spec)
+            position[0] = match.end()
+            subselector = None
+            if spec[position[0] : position[0] + 1] == "(":
+                position[0] += 1
+                subselector = parse_list()
+                if spec[position[0] : position[0] + 1] != ")":
+                    raise FakeDriveError(400, "invalidParameter", "Invalid field selection %s" % spec)
+                position[0] += 1
+            parts = match.group(1).split("/")
+            current = selector
+            for part in parts[ : -1]:
+                current = current.setdefault(part, {})
+            current[parts[-1]] = subselector
+            if spec[position[0] : position[0] + 1] == ",":
+                position[0] += 1
+        return selector
+
+    selector = parse_list()
+    if position[0] != len(spec):
+        raise FakeDriveError(400, "invalidParameter", "Invalid field selection %s" % spec)
+    return selector
+
+def select_fields(value, selector):
+    if not selector or "*" in selector:
+        return value
+    if isinstance(value, list):
+        return [select_fields(item, selector) for item in value]
+    if isinstance(value, dict):
+        return {key: select_fields(value[key], subselector) for key, subselector in selector.items() if key in value}
+    return value
+
+class FakeDriveStore:
+    """
+    In-memory Drive account: file metadata, content and a changes feed. Files added with only a
+    size hold zeros, like the sparse files of a synthetic tree, which keeps big trees cheap. Unless
+    KEEP_CONTENT, uploaded content is dropped too once its size and MD5 are taken, and reads of it
+    return zeros.
+    """
+
+    def __init__(self, keep_content=True, storage_quota=None):
+        self.lock = threading.Lock()
+        self.keep_content = keep_content
+        self.storage_quota = storage_quota
+        self.ids = itertools.count(1)
+        self.files, self.contents, self.changes = {}, {}, []
+        self.zero_md5s = {}
+        self.root_id = self.new_id()
+        self.files[self.root_id] = self.make_metadata(self.root_id, "My Drive", FOLDER_MIME_TYPE, [])
+
+    def new_id(self):
+        return "fake%08i" % next(self.ids)
+
+    def make_metadata(self, file_id, title, mime_type, parent_ids, modified=None):
+        now = time.time() if modified is None else modified
+        metadata = {
+            "kind": "drive#file",
+            "id": file_id,
+            "title": title,
+            "mimeType": mime_type,
+            "parents": [{"kind": "drive#parentReference", "id": parent_id, "isRoot": parent_id == self.root_id}
+                        for parent_id in parent_ids],
+            "labels": {"trashed": False, "starred": False, "hidden": False, "restricted": False, "viewed": True},
+            "createdDate": format_date(now),
+            "modifiedDate": format_date(now),
+            "version": "1",
+        }
+        return metadata
+
+    def resolve(self, file_id):
+        return self.root_id if file_id == "root" else file_id
+
+    def get(self, file_id):
+        metadata = self.files.get(self.resolve(file_id))
+        if metadata is None:
+            raise FakeDriveError(404, "notFound", "File not found: %s" % file_id)
+        return metadata
+
+    def zero_md5(self, size):
+        if size not in self.zero_md5s:
+            md5, block = hashlib.md5(), bytes(min(size, 1024 * 1024))
+            for start in range(0, size, len(block) or 1):
+                md5.update(block[ : min(len(block), size - start)])
+            self.zero_md5s[size] = md5.hexdigest()
+        return self.zero_md5s[size]
+
+    def used_bytes(self):
+        return sum(int(metadata.get("fileSize", 0)) for metadata in self.files.values())
+
+    def record_change(self, file_id, deleted=False):
+        self.changes.append((file_id, deleted))
+
+    def set_content(self, metadata, content=None, size=None):
+        """
+        Gives the file METADATA the bytes CONTENT, or SIZE zero bytes.
+        """
+        size = len(content) if content is not None else (size or 0)
+        if self.storage_quota is not None and \
+           self.used_bytes() - int(metadata.get("fileSize", 0)) + size > self.storage_quota:
+            raise FakeDriveError(403, "quotaExceeded", "The user's Drive storage quota has been exceeded.",
+                                 domain="usageLimits")
+        metadata["fileSize"] = str(size)
+        metadata["md5Checksum"] = hashlib.md5(content).hexdigest() if content is not None else self.zero_md5(size)
+        metadata["downloadUrl"] = "%sdrive/v2/files/%s?alt=media" % (REAL_API_ROOT, metadata["id"])
+        self.contents[metadata["id"]] = content if self.keep_content else None
+
+    def read(self, file_id, start=0, end=None):
+        metadata = self.get(file_id)
+        if "fileSize" not in metadata:
+            raise FakeDriveError(403, "fileNotDownloadable", "Only files with binary content can be downloaded")
+        size = int(metadata["fileSize"])
+        end = size if end is None else min(end, size)
+        content = self.contents.get(metadata["id"])
+        return content[start : end] if content is not None else bytes(max(0, end - start))
+
+    def insert(self, body, content=None, size=None):
+        with self.lock:
+            parent_ids = [self.resolve(parent["id"]) for parent in body.get("parents") or [{"id": "root"}]]
+            for parent_id in parent_ids:
+                if self.get(parent_id)["mimeType"] != FOLDER_MIME_TYPE:
+                    raise FakeDriveError(400, "invalidParent", "Parent %s is not a folder" % parent_id)
+            file_id = self.new_id()
+            metadata = self.make_metadata(
+                file_id, body.get("title", "Untitled"), body.get("mimeType") or "application/octet-stream", parent_ids)
+            if body.get("modifiedDate"):
+                metadata["modifiedDate"] = body["modifiedDate"]
+            if metadata["mimeType"] != FOLDER_MIME_TYPE:
+                self.set_content(metadata, content, size if content is None else None)
+            self.files[file_id] = metadata
+            self.record_change(file_id)
+            return dict(metadata)
+
+    def update(self, file_id, body, content=None, size=None, add_parents=None, remove_parents=None):
+        with self.lock:
+            metadata = self.get(file_id)
+            for key in ("title", "mimeType", "modifiedDate", "description"):
+                if key in body:
+                    metadata[key] = body[key]
+            parent_ids = [parent["id"] for parent in metadata["parents"]]
+            if "parents" in body:
+                parent_ids = [self.resolve(parent["id"]) for parent in body["parents"]]
+            parent_ids += [self.resolve(parent_id) for parent_id in (add_parents or "").split(",") if parent_id]
+            parent_ids = [parent_id for parent_id in parent_ids if parent_id not in (remove_parents or "").split(",")]
+            metadata["parents"] = [{"kind": "drive#parentReference", "id": parent_id, "isRoot": parent_id == self.root_id}
+                                   for parent_id in dict.fromkeys(parent_ids)]
+            if "labels" in body:
+                metadata["labels"].update(body["labels"])
+            if content is not None or size is not None:
+                self.set_content(metadata, content, size)
+                if "modifiedDate" not in body:
+                    metadata["modifiedDate"] = format_date(time.time())
+            metadata["version"] = str(int(metadata["version"]) + 1)
+            self.record_change(metadata["id"])
+            return dict(metadata)
+
+    def descendants(self, file_id):
+        children = {}
+        for metadata in self.files.values():
+            for parent in metadata["parents"]:
+                children.setdefault(parent["id"], []).append(metadata["id"])
+        found, stack = [], [file_id]
+        while stack:
+            for child_id in children.get(stack.pop(), []):
+                found.append(child_id)
+                stack.append(child_id)
+        return found
+
+    def trash(self, file_id, trashed=True):
+        with self.lock:
+            metadata = self.get(file_id)
+            # Trashing a folder trashes everything underneath it too.
+            for other_id in [metadata["id"]] + self.descendants(metadata["id"]):
+                self.files[other_id]["labels"]["trashed"] = trashed
+                self.record_change(other_id)
+            return dict(metadata)
+
+    def delete(self, file_id):
+        with self.lock:
+            metadata = self.get(file_id)
+            for other_id in [metadata["id"]] + self.descendants(metadata["id"]):
+                del self.files[other_id]
+                self.contents.pop(other_id, None)
+                self.record_change(other_id, deleted=True)
+
+    def copy(self, file_id, body):
+        with self.lock:
+            source = self.get(file_id)
+            if source["mimeType"] == FOLDER_MIME_TYPE:
+                raise FakeDriveError(400, "invalid", "Folders can't be copied")
+            parent_ids = [self.resolve(parent["id"]) for parent in body.get("parents") or source["parents"]]
+            metadata = self.make_metadata(
+                self.new_id(), body.get("title", "Copy of %s" % source["title"]), source["mimeType"], parent_ids)
+            self.set_content(metadata, self.contents.get(source["id"]), int(source["fileSize"]))
+            # The copy shares its source's bytes, so no content is held twice.
+            self.contents[metadata["id"]] = self.contents.get(source["id"])
+            self.files[metadata["id"]] = metadata
+            self.record_change(metadata["id"])
+            return dict(metadata)
+
+    def list(self, query="", page_token=None, max_results=DEFAULT_PAGE_SIZE):
+        predicate = parse_query(query, self.resolve)
+        with self.lock:
+            matches = [dict(metadata) for file_id, metadata in sorted(self.files.items())
+                       if file_id != self.root_id and predicate(metadata)]
+        start = int(page_token or 0)
+        max_results = max(1, min(int(max_results or DEFAULT_PAGE_SIZE), MAX_PAGE_SIZE))
+        response = {"kind": "drive#fileList", "items": matches[start : start + max_results]}
+        if start + max_results < len(matches):
+            response["nextPageToken"] = str(start + max_results)
+        return response
+
+    def start_page_token(self):
+        with self.lock:
+            return str(len(self.changes) + 1)
+
+    def list_changes(self, page_token, max_results=DEFAULT_PAGE_SIZE):
+        max_results = max(1, min(int(max_results or DEFAULT_PAGE_SIZE), MAX_PAGE_SIZE))
+        with self.lock:
+            start = int(page_token) - 1
+            items = []
+            for change_id, (file_id, deleted) in enumerate(self.changes[start : start + max_results], start + 1):
+                item = {"kind": "drive#change", "id": str(change_id), "fileId": file_id,
+                        "deleted": deleted or file_id not in self.files}
+                if not item["deleted"]:
+                    item["file"] = dict(self.files[file_id])
+                items.append(item)
+            response = {"kind": "drive#changeList", "items": items}
+            if start + max_results < len(self.changes):
+                response["nextPageToken"] = str(start + max_results + 1)
+            else:
+                response["newStartPageToken"] = str(len(self.changes) + 1)
+            return response
+
+    def about(self):
+        with self.lock:
+            return {
+                "kind": "drive#about",
+                "name": "Fake Drive",
+                "rootFolderId": self.root_id,
+                "permissionId": "fake-permission",
+                "quotaBytesTotal": str(self.storage_quota or 15 * 1024 ** 3),
+                "quotaBytesUsed": str(self.used_bytes()),
+                "largestChangeId": str(len(self.changes)),
+            }
+
+    def add_folder(self, parent_id, title):
+        return self.insert({"title": title, "mimeType": FOLDER_MIME_TYPE, "parents": [{"id": parent_id}]})
+
+    def add_file(self, parent_id, title, content=None, size=0):
+        return self.insert({"title": title, "parents": [{"id": parent_id}]}, content, size)
+
+    def add_tree(self, local_root, parent_id="root", with_content=False, include=None):
+        """
+        Mirrors the directory LOCAL_ROOT under the folder PARENT_ID, directly into the store. Files
+        hold zeros of their local size, or their actual bytes if WITH_CONTENT. If INCLUDE is given,
+        only the files it's true for (called with their path relative to LOCAL_ROOT) are added.
+        Returns the number of files added.
+        """
+        local_root = Path(local_root)
+        folder_ids, added = {Path("."): parent_id}, 0
+        for local_path in sorted(local_root.rglob("*")):
+            relative_path = local_path.relative_to(local_root)
+            if local_path.is_dir():
+                folder_ids[relative_path] = self.add_folder(folder_ids[relative_path.parent], local_path.name)["id"]
+            elif include is None or include(relative_path):
+                content = local_path.read_bytes() if with_content else None
+                self.add_file(folder_ids[relative_path.parent], local_path.name, content, local_path.stat().st_size)
+                added += 1
+        return added
+
+class FaultInjector:
+    """
+    Makes a FakeDriveServer behave more like the real thing: each call waits LATENCY seconds (give
+    or take JITTER of it), media moves at BANDWIDTH bytes per second, a fraction ERROR_RATE of calls
+    fail with a 500 or 503, and calls beyond RATE_LIMIT per second are refused with the 403
+    userRateLimitExceeded Drive sends when a client goes too fast.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, bandwidth=None, error_rate=0.0, rate_limit=None, seed=0):
+        self.latency, self.jitter, self.bandwidth = latency, jitter, bandwidth
+        self.error_rate, self.rate_limit = error_rate, rate_limit
+        self.lock = threading.Lock()
+        self.random = random.Random(seed)
+        self.window_start, self.window_calls = time.monotonic(), 0
+
+    def delay(self, num_bytes=0):
+        with self.lock:
+            delay = self.latency * (1 + self.jitter * (2 * self.random.random() - 1))
+        if self.bandwidth:
+            delay += num_bytes / self.bandwidth
+        if delay > 0:
+            time.sleep(delay)
+
+    def check(self):
+        with self.lock:
+            now = time.monotonic()
+            if now - self.window_start >= 1.0:
+                self.window_start, self.window_calls = now, 0
+            self.window_calls += 1
+            if self.rate_limit is not None and self.window_calls > self.rate_limit:
+                raise FakeDriveError(403, "userRateLimitExceeded", "User Rate Limit Exceeded", domain="usageLimits")
+            if self.random.random() < self.error_rate:
+                if self.random.random() < 0.5:
+                    raise FakeDriveError(500, "backendError", "Backend Error")
+                raise FakeDriveError(503, "backendError", "Service Unavailable")
+
+class UploadSessions:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sessions = {}
+
+    def start(self, file_id, body, size):
+        upload_id = uuid.uuid4().hex
+        with self.lock:
+            self.sessions[upload_id] = {"file_id": file_id, "body": body, "size": size, "chunks": []}
+        return upload_id
+
+    def get(self, upload_id):
+        with self.lock:
+            session = self.sessions.get(upload_id)
+        if session is None:
+            raise FakeDriveError(404, "notFound", "No such upload session")
+        return session
+
+    def finish(self, upload_id):
+        with self.lock:
+            return self.sessions.pop(upload_id)
+
+def parse_content_range(header):
+    """
+    Parses "bytes START-END/TOTAL", "bytes */TOTAL" or "bytes START-END/*". Returns (start, end
+    exclusive, total), with None for the parts left out.
+    """
+    match = re.match(r"bytes (?:(\d+)-(\d+)|\*)/(\d+|\*)", header or "")
+    if match is None:
+        return None, None, None
+    start, end, total = match.groups()
+    return (int(start) if start else None, int(end) + 1 if end else None, int(total) if total != "*" else None)
+
+def parse_multipart(content_type, body):
+    message = BytesParser().parsebytes(b"Content-Type: " + content_type.encode("ascii") + b"\r\n\r\n" + body)
+    return message.get_payload()
+
+class FakeDriveServer:
+    """
+    Local HTTP server speaking the part of the Drive v2 API this repo uses (files list, get, insert,
+    update, patch, trash, delete and copy, simple, multipart and resumable media uploads, ranged
+    media downloads, batches, changes and about), backed by a FakeDriveStore. FAULTS (a
+    FaultInjector) adds latency, errors and quotas. Counts every API call by operation, batched
+    calls included, so runs can be compared by how many requests they need.
+    """
+
+    def __init__(self, store=None, faults=None, host="127.0.0.1", port=0):
+        self.store = FakeDriveStore() if store is None else store
+        self.faults = FaultInjector() if faults is None else faults
+        self.sessions = UploadSessions()
+        self.calls_lock = threading.Lock()
+        self.calls = {}
+        self.httpd = ThreadingHTTPServer((host, port), self.make_handler())
+        self.httpd.daemon_threads = True
+        self.url = "http://%s:%i/" % self.httpd.server_address[ : 2]
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="fake-drive", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def count(self, operation):
+        with self.calls_lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+
+    def stats(self):
+        with self.calls_lock:
+            return dict(self.calls)
+
+    def reset_stats(self):
+        with self.calls_lock:
+            self.calls = {}
+
+    def make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Responses go out as headers and body separately, which Nagle's algorithm would hold up.
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def handle_method(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                status, headers, content = server.handle(self.command, self.path, self.headers, body)
+                server.faults.delay(len(body) + len(content))
+                self.send_response(status)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = handle_method
+
+        return Handler
+
+    def handle(self, method, path, headers, body):
+        """
+        Serves one request. Returns a 3-tuple of (status, headers, content bytes).
+        """
+        url = urlsplit(path)
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        if headers.get("X-HTTP-Method-Override"):
+            # The client library turns requests with URLs too long into POSTs with a form body.
+            method = headers["X-HTTP-Method-Override"]
+            params.update((key, values[-1]) for key, values in parse_qs(body.decode("utf-8")).items())
+            body = b""
+        try:
+            if url.path.startswith("/batch"):
+                self.count("batch")
+                return self.handle_batch(headers, body)
+            self.faults.check()
+            status, response_headers, response = self.route(method, url.path, params, headers, body)
+        except Exception as e:
+            if not isinstance(e, FakeDriveError):
+                e = FakeDriveError(500, "internalError", "%s: %s" % (type(e).__name__, str(e)))
+            return e.status, {"Content-Type": "application/json; charset=UTF-8"}, json.dumps(e.body()).encode("utf-8")
+        if isinstance(response, bytes):
+            return status, response_headers, response
+        if "fields" in params and response is not None:
+            response = select_fields(response, parse_fields(params["fields"]))
+        content = json.dumps(response).encode("utf-8") if response is not None else b""
+        return status, dict({"Content-Type": "application/json; charset=UTF-8"}, **response_headers), content
+
+    def route(self, method, path, params, headers, body):
+        store = self.store
+        match = re.match(r"^/(upload/)?drive/v2/(files|about|changes)(?:/([^/]+))?(?:/([^/]+))?$", path)
+        if match is None:
+            raise FakeDriveError(404, "notFound", "Unknown endpoint %s %s" % (method, path))
+        upload, collection, file_id, action = match.groups()
+
+        if upload:
+            return self.route_upload(method, file_id, params, headers, body)
+        elif collection == "about":
+            self.count("about.get")
+            return 200, {}, store.about()
+        elif collection == "changes" and file_id == "startPageToken":
+            self.count("changes.start_token")
+            return 200, {}, {"startPageToken": store.start_page_token()}
+        elif collection == "changes":
+            self.count("changes.list")
+            return 200, {}, store.list_changes(params.get("pageToken", "1"), params.get("maxResults"))
+        elif file_id is None and method == "GET":
+            self.count("files.list")
+            return 200, {}, store.list(params.get("q", ""), params.get("pageToken"), params.get("maxResults"))
+        elif file_id is None and method == "POST":
+            self.count("files.insert")
+            return 200, {}, store.insert(json.loads(body or b"{}"))
+        elif action == "trash" or action == "untrash":
+            self.count("files.%s" % action)
+            return 200, {}, store.trash(file_id, trashed=action == "trash")
+        elif action == "copy":
+            self.count("files.copy")
+            return 200, {}, store.copy(file_id, json.loads(body or b"{}"))
+        elif method == "GET" and params.get("alt") == "media":
+            self.count("files.get_media")
+            start, end = 0, None
+            match = re.match(r"bytes=(\d+)-(\d*)", headers.get("Range") or "")
+            if match is not None:
+                start, end = int(match.group(1)), int(match.group(2)) + 1 if match.group(2) else None
+                size = int(store.get(file_id)["fileSize"])
+                content = store.read(file_id, start, end)
+                return 206, {"Content-Type": "application/octet-stream",
+                             "Content-Range": "bytes %i-%i/%i" % (start, start + len(content) - 1, size)}, content
+            return 200, {"Content-Type": "application/octet-stream"}, store.read(file_id)
+        elif method == "GET":
+            self.count("files.get")
+            return 200, {}, dict(store.get(file_id))
+        elif method in ("PUT", "PATCH"):
+            self.count("files.update" if method == "PUT" else "files.patch")
+            return 200, {}, store.update(file_id, json.loads(body or b"{}"),
+                                         add_parents=params.get("addParents"), remove_parents=params.get("removeParents"))
+        elif method == "DELETE":
+            self.count("files.delete")
+            store.delete(file_id)
+            return 204, {}, None
+        raise FakeDriveError(404, "notFound", "Unknown endpoint %s %s" % (method, path))
+
+    def route_upload(self, method, file_id, params, headers, body):
+        upload_type = params.get("uploadType", "media")
+        store = self.store
+
+        if "upload_id" in params:
+            self.count("resumable.chunk")
+            return self.upload_chunk(params["upload_id"], headers, body)
+
+        if upload_type == "resumable":
+            self.count("resumable.start")
+            metadata = json.loads(body or b"{}")
+            size = headers.get("X-Upload-Content-Length")
+            upload_id = self.sessions.start(file_id, metadata, int(size) if size is not None else None)
+            location = "%supload/drive/v2/files%s?uploadType=resumable&upload_id=%s" % (
+                REAL_API_ROOT, "/" + file_id if file_id else "", upload_id)
+            return 200, {"Location": location}, None
+
+        if upload_type == "multipart":
+            parts = parse_multipart(headers.get("Content-Type"), body)
+            metadata = json.loads(parts[0].get_payload(decode=True) or b"{}")
+            content = parts[1].get_payload(decode=True)
+        else:
+            metadata, content = {}, body
+        if file_id is None:
+            self.count("files.insert")
+            return 200, {}, store.insert(metadata, content)
+        self.count("files.update")
+        return 200, {}, store.update(file_id, metadata, content)
+
+    def upload_chunk(self, upload_id, headers, body):
+        session = self.sessions.get(upload_id)
+        start, end, total = parse_content_range(headers.get("Content-Range"))
+        received = sum(len(chunk) for chunk in session["chunks"])
+        if total is not None:
+            session["size"] = total
+
+        if start is not None:
+            if start != received:
+                raise FakeDriveError(400, "badContent", "Chunk starts at %i, but %i bytes were received" % (start, received))
+            session["chunks"].append(body)
+            received += len(body)
+
+        if session["size"] is None or received < session["size"]:
+            # 308 Resume Incomplete, with no Location header, as Drive sends it.
+            response_headers = {"Range": "bytes=0-%i" % (received - 1)} if received else {}
+            return 308, response_headers, None
+
+        session = self.sessions.finish(upload_id)
+        content = b"".join(session["chunks"])
+        if session["file_id"] is None:
+            return 200, {}, self.store.insert(session["body"], content)
+        return 200, {}, self.store.update(session["file_id"], session["body"], content)
+
+    def handle_batch(self, headers, body):
+        boundary = "batch_%s" % uuid.uuid4().hex
+        parts = []
+        for part in parse_multipart(headers.get("Content-Type"), body):
+            request = part.get_payload(decode=True)
+            head, request_body = re.split(b"\r?\n\r?\n", request, 1) if re.search(b"\r?\n\r?\n", request) \
+                else (request, b"")
+            lines = head.decode("utf-8").splitlines()
+            method, path = lines[0].split(" ")[ : 2]
+            request_headers = dict(line.split(": ", 1) for line in lines[1 : ] if ": " in line)
+            status, response_headers, content = self.handle(method, urlsplit(path)._replace(
+                scheme="", netloc="").geturl(), request_headers, request_body)
+            content_id = (part.get("Content-ID") or "").strip("<>")
+            response = "HTTP/1.1 %i %s\r\n" % (status, "OK" if status < 300 else "Error")
+            response += "".join("%s: %s\r\n" % item for item in response_headers.items())
+            response += "Content-Length: %i\r\n\r\n" % len(content)
+            parts.append(("--%s\r\nContent-Type: application/http\r\nContent-ID: <response-%s>\r\n\r\n" % (
+                boundary, content_id)).encode("utf-8") + response.encode("utf-8") + content + b"\r\n")
+        content = b"".join(parts) + ("--%s--\r\n" % boundary).encode("utf-8")
+        return 200, {"Content-Type": "multipart/mixed; boundary=%s" % boundary}, content
+
+class RedirectingHttp(httplib2.Http):
+    """
+    httplib2.Http that sends whatever is addressed to the real Drive API to BASE_URL instead, so
+    the hardcoded URLs in resumable.py and downloader.py reach a FakeDriveServer too.
+    """
+
+    def __init__(self, base_url, **kwargs):
+        super().__init__(**kwargs)
+        self.base_url = base_url
+        # Drive answers unfinished resumable chunks with a 308 that isn't a redirect.
+        self.redirect_codes = self.redirect_codes - {308}
+
+    def request(self, uri, *args, **kwargs):
+        if uri.startswith(REAL_API_ROOT):
+            uri = self.base_url + uri[len(REAL_API_ROOT) : ]
+        return super().request(uri, *args, **kwargs)
+
+def make_fake_drive(base_url):
+    """
+    Returns a GoogleDrive talking to the FakeDriveServer at BASE_URL, with a made-up access token,
+    through a session.DriveSession of its own.
+    """
+    from session import DriveSession
+
+    session = DriveSession(
+        credentials=AccessTokenCredentials("fake-access-token", "drivesync-fake"),
+        http_factory=lambda **kwargs: RedirectingHttp(base_url, **kwargs))
+    return session.drive
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Serve a fake Drive v2 API locally, for offline testing and benchmarks")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--seed-tree", help="Local directory to mirror into the fake Drive's root at startup")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every request")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Latency varies by up to this fraction")
+    parser.add_argument("--bandwidth", type=float, help="Media bytes per second")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of calls failing with a 5xx")
+    parser.add_argument("--rate-limit", type=int, help="Calls per second allowed before rate limit errors")
+    parser.add_argument("--storage-quota", type=int, help="Storage quota in bytes")
+    args = parser.parse_args()
+
+    store = FakeDriveStore(storage_quota=args.storage_quota)
+    if args.seed_tree is not None:
+        print("Seeded %i files" % store.add_tree(args.seed_tree, with_content=True))
+    faults = FaultInjector(args.latency, args.jitter, args.bandwidth, args.error_rate, args.rate_limit)
+    server = FakeDriveServer(store, faults, port=args.port)
+    print("Fake Drive listening at %s" % server.url)
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
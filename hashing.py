@@ -0,0 +1,106 @@
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import hashlib, os, sqlite3, threading
+
+HASH_CHUNK_SIZE = 4 * 1024 * 1024
+
+def md5_file(path, chunk_size=HASH_CHUNK_SIZE):
+    md5 = hashlib.md5()
+    with open(str(path), "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+class HashCache:
+    """
+    Remembers local MD5s keyed by (path, size, mtime), so a file is only hashed again once it
+    changes. Kept in memory, and in SQLite at DB_PATH if given.
+    """
+
+    def __init__(self, db_path=None):
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.db = None
+        if db_path is not None:
+            self.db = sqlite3.connect(str(db_path), check_same_thread=False)
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS hashes "
+                "(path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, md5 TEXT)")
+            self.db.commit()
+
+    @staticmethod
+    def key(path):
+        stat = os.stat(str(path))
+        return str(Path(path).absolute()), stat.st_size, stat.st_mtime_ns
+
+    def get(self, path):
+        path_key, size, mtime_ns = self.key(path)
+        with self.lock:
+            if path_key in self.entries:
+                cached_size, cached_mtime_ns, md5 = self.entries[path_key]
+            elif self.db is not None:
+                row = self.db.execute(
+                    "SELECT size, mtime_ns, md5 FROM hashes WHERE path = ?", (path_key,)).fetchone()
+                if row is None:
+                    return None
+                cached_size, cached_mtime_ns, md5 = row
+            else:
+                return None
+
+        if (cached_size, cached_mtime_ns) != (size, mtime_ns):
+            return None
+        return md5
+
+    def put(self, path, md5, size=None, mtime_ns=None):
+        path_key, current_size, current_mtime_ns = self.key(path)
+        size = current_size if size is None else size
+        mtime_ns = current_mtime_ns if mtime_ns is None else mtime_ns
+
+        with self.lock:
+            self.entries[path_key] = (size, mtime_ns, md5)
+            if self.db is not None:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?)", (path_key, size, mtime_ns, md5))
+
+    def commit(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.commit()
+
+def hash_with_stat(path):
+    # Stat before reading, so a file modified mid-hash is cached under its old mtime and rehashed.
+    stat = os.stat(path)
+    return path, stat.st_size, stat.st_mtime_ns, md5_file(path)
+
+def hash_files(paths, cache=None, workers=None, verbose=True):
+    """
+    Returns a dict of path -> MD5 hex digest for every file in PATHS, taking hashes from CACHE
+    where they're still valid and hashing the rest in parallel across WORKERS processes (one per
+    core by default).
+    """
+    cache = HashCache() if cache is None else cache
+
+    hashes, to_hash = {}, []
+    for path in paths:
+        md5 = cache.get(path)
+        if md5 is None:
+            to_hash.append(str(path))
+        else:
+            hashes[Path(path)] = md5
+
+    if to_hash:
+        from syncer import print_on_same_line
+
+        with ProcessPoolExecutor(workers) as executor:
+            for i, (path, size, mtime_ns, md5) in enumerate(executor.map(hash_with_stat, to_hash, chunksize=16)):
+                hashes[Path(path)] = md5
+                cache.put(path, md5, size, mtime_ns)
+                if verbose:
+                    print_on_same_line("Hashed %i / %i files" % (i + 1, len(to_hash)))
+        if verbose:
+            print_on_same_line("")
+            print("Hashed %i files" % len(to_hash))
+        cache.commit()
+
+    return hashes
@@ -0,0 +1,253 @@
+from pathlib import Path
+
+import json, sqlite3, threading, time
+
+PLANNED, IN_FLIGHT, DONE, FAILED = 0, 1, 2, 3
+STATE_NAMES = {PLANNED: "planned", IN_FLIGHT: "in-flight", DONE: "done", FAILED: "failed"}
+
+UPLOAD, UPDATE, MOVE = 0, 1, 2
+KIND_NAMES = {UPLOAD: "upload", UPDATE: "update", MOVE: "move"}
+
+class Journal:
+    """
+    Append-mostly record of every item a sync run plans to transfer and what became of it, kept in
+    SQLite in WAL mode so that each state change is durable as soon as it's committed and a crash
+    never loses more than the item in flight. A run whose items weren't all settled can be picked
+    up again without diffing.
+
+    Items are stored compactly (integer kinds and states, paths relative to the run's local root)
+    so that runs with millions of items stay manageable.
+    """
+
+    def __init__(self, db_path):
+        self.db = sqlite3.connect(str(db_path), check_same_thread=False)
+        self.lock = threading.Lock()
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS runs (
+                id INTEGER PRIMARY KEY, local_root TEXT, remote_root TEXT,
+                started REAL, finished REAL);
+            CREATE TABLE IF NOT EXISTS items (
+                run INTEGER, path TEXT, kind INTEGER, size INTEGER, extra TEXT,
+                state INTEGER, attempts INTEGER DEFAULT 0, error TEXT, updated REAL,
+                PRIMARY KEY (run, path));
+            CREATE INDEX IF NOT EXISTS items_by_state ON items (run, state);
+        """)
+        # When each item's last attempt started, for measuring throughput. Journals from before it
+        # was recorded get the column added.
+        if "started" not in [row[1] for row in self.db.execute("PRAGMA table_info(items)")]:
+            self.db.execute("ALTER TABLE items ADD COLUMN started REAL")
+        # Which saved plan (see planner.py) a run carries out, if any, and when its diff finished,
+        # which a streamed diff does well after the first items are planned.
+        run_columns = [row[1] for row in self.db.execute("PRAGMA table_info(runs)")]
+        if "plan" not in run_columns:
+            self.db.execute("ALTER TABLE runs ADD COLUMN plan TEXT")
+        if "diffed" not in run_columns:
+            self.db.execute("ALTER TABLE runs ADD COLUMN diffed REAL")
+        self.db.commit()
+
+        self.run_id, self.local_root = None, None
+
+    def find_unfinished_run(self, local_root, remote_root):
+        row = self.db.execute(
+            "SELECT id FROM runs WHERE local_root = ? AND remote_root = ? AND finished IS NULL "
+            "ORDER BY id DESC LIMIT 1", (str(Path(local_root).absolute()), str(remote_root))).fetchone()
+        return None if row is None else row[0]
+
+    def find_plan_run(self, plan_key):
+        row = self.db.execute(
+            "SELECT id FROM runs WHERE plan = ? ORDER BY id DESC LIMIT 1", (plan_key,)).fetchone()
+        return None if row is None else row[0]
+
+    def start_run(self, local_root, remote_root, run_id=None, plan_key=None):
+        """
+        Starts recording a new run, carrying out the plan PLAN_KEY if given, or resumes RUN_ID if
+        given.
+        """
+        self.local_root = Path(local_root).absolute()
+        with self.lock:
+            if run_id is None:
+                cursor = self.db.execute(
+                    "INSERT INTO runs (local_root, remote_root, started, plan) VALUES (?, ?, ?, ?)",
+                    (str(self.local_root), str(remote_root), time.time(), plan_key))
+                run_id = cursor.lastrowid
+                self.db.commit()
+        self.run_id = run_id
+        return run_id
+
+    def is_diffed(self, run_id):
+        """
+        Whether every item of RUN_ID was planned, i.e. its diff ran to the end.
+        """
+        row = self.db.execute("SELECT diffed FROM runs WHERE id = ?", (run_id,)).fetchone()
+        return row is not None and row[0] is not None
+
+    def finish_diff(self):
+        with self.lock:
+            self.db.execute("UPDATE runs SET diffed = ? WHERE id = ?", (time.time(), self.run_id))
+            self.db.commit()
+
+    def finish_run(self):
+        with self.lock:
+            self.db.execute("UPDATE runs SET finished = ? WHERE id = ?", (time.time(), self.run_id))
+            self.db.commit()
+
+    def relative(self, local_path):
+        return Path(local_path).absolute().relative_to(self.local_root).as_posix()
+
+    def plan(self, to_upload, to_update=(), to_move=()):
+        """
+        Records every item of a freshly diffed run as planned, in one transaction. TO_UPLOAD holds
+        UploadItems (see syncer.py).
+        """
+        rows = [(item.path, UPLOAD, item.size, item.parent_id) for item in to_upload]
+        for local_path, drive_file in to_update:
+            extra = {key: drive_file[key] for key in ("id", "title", "mimeType") if key in drive_file}
+            rows.append((self.relative(local_path), UPDATE, local_path.stat().st_size, json.dumps(extra)))
+        for local_path, old_remote_path in to_move:
+            rows.append((self.relative(local_path), MOVE, local_path.stat().st_size, json.dumps(str(old_remote_path))))
+        self.insert_planned(rows)
+
+    def planning(self, to_upload, batch_size=500):
+        """
+        Streaming counterpart of plan for uploads: records the UploadItems of TO_UPLOAD as planned
+        BATCH_SIZE at a time, and yields each one only once its batch is durable. Once TO_UPLOAD runs
+        out, the run's diff is recorded as finished.
+        """
+        batch = []
+        for item in to_upload:
+            batch.append(item)
+            if len(batch) >= batch_size:
+                self.plan(batch)
+                yield from batch
+                batch = []
+        self.plan(batch)
+        self.finish_diff()
+        yield from batch
+
+    def insert_planned(self, rows):
+        now = time.time()
+        with self.lock:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO items (run, path, kind, size, extra, state, updated) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(self.run_id, path, kind, size, extra, PLANNED, now) for path, kind, size, extra in rows])
+            self.db.commit()
+
+    def forget_unfinished(self):
+        """
+        Drops the current run's items that haven't gone through, before diffing it again.
+        """
+        with self.lock:
+            self.db.execute("DELETE FROM items WHERE run = ? AND state != ?", (self.run_id, DONE))
+            self.db.commit()
+
+    def unfinished(self):
+        """
+        Returns the (to_upload, to_update, to_move) lists of the current run's items that haven't
+        settled, in the shape UploadScheduler.run takes. Drive objects are reduced to the fields the
+        journal keeps.
+        """
+        from syncer import UploadItem
+
+        to_upload, to_update, to_move = [], [], []
+        rows = self.db.execute(
+            "SELECT path, kind, size, extra FROM items WHERE run = ? AND state IN (?, ?)",
+            (self.run_id, PLANNED, IN_FLIGHT))
+        for path, kind, size, extra in rows:
+            if kind == UPLOAD:
+                to_upload.append(UploadItem(extra, path, size))
+            elif kind == UPDATE:
+                to_update.append((self.local_root / path, json.loads(extra)))
+            else:
+                to_move.append((self.local_root / path, Path(json.loads(extra))))
+        return to_upload, to_update, to_move
+
+    def done(self):
+        """
+        Returns the set of paths (relative to the local root) of the current run's items that went
+        through.
+        """
+        return {
+            path for path, in self.db.execute(
+                "SELECT path FROM items WHERE run = ? AND state = ?", (self.run_id, DONE))
+        }
+
+    def set_state(self, local_path, state, error=None, retried=False):
+        with self.lock:
+            self.db.execute(
+                "UPDATE items SET state = ?, error = ?, updated = ?, attempts = attempts + ? "
+                "WHERE run = ? AND path = ?",
+                (state, None if error is None else str(error), time.time(), int(retried),
+                 self.run_id, self.relative(local_path)))
+            self.db.commit()
+
+    def started(self, local_path):
+        with self.lock:
+            now = time.time()
+            self.db.execute(
+                "UPDATE items SET state = ?, error = NULL, updated = ?, started = ? WHERE run = ? AND path = ?",
+                (IN_FLIGHT, now, now, self.run_id, self.relative(local_path)))
+            self.db.commit()
+
+    def retrying(self, local_path, error):
+        self.set_state(local_path, PLANNED, error, retried=True)
+
+    def finished(self, local_path, error=None):
+        self.set_state(local_path, DONE if error is None else FAILED, error)
+
+    def throughput(self, limit=10000, min_samples=20):
+        """
+        Fits the durations of the last LIMIT uploads and updates that went through (of any run) to
+        a fixed cost per file plus a transfer rate, by least squares. Returns a 3-tuple of (seconds
+        per file, bytes per second per worker, number of samples), or None with fewer than
+        MIN_SAMPLES to go by.
+        """
+        samples = self.db.execute(
+            "SELECT size, updated - started FROM items WHERE state = ? AND kind IN (?, ?) AND size IS NOT NULL "
+            "AND started IS NOT NULL ORDER BY updated DESC LIMIT ?", (DONE, UPLOAD, UPDATE, limit)).fetchall()
+        if len(samples) < min_samples:
+            return None
+
+        mean_size = sum(size for size, _ in samples) / len(samples)
+        mean_seconds = sum(seconds for _, seconds in samples) / len(samples)
+        variance = sum((size - mean_size) ** 2 for size, _ in samples)
+        covariance = sum((size - mean_size) * (seconds - mean_seconds) for size, seconds in samples)
+        if variance == 0 or covariance <= 0:
+            # Sizes alike, or no sign of size mattering: put it all down to the per-file cost.
+            return mean_seconds, None, len(samples)
+        seconds_per_byte = covariance / variance
+        return max(0.0, mean_seconds - seconds_per_byte * mean_size), 1 / seconds_per_byte, len(samples)
+
+    def report(self, run_id=None):
+        """
+        Returns a printable summary of RUN_ID (the latest run by default): item counts and bytes
+        by kind and state, followed by every failure.
+        """
+        if run_id is None:
+            run_id = self.db.execute("SELECT MAX(id) FROM runs").fetchone()[0]
+        if run_id is None:
+            return "No runs recorded"
+
+        local_root, remote_root, started, finished = self.db.execute(
+            "SELECT local_root, remote_root, started, finished FROM runs WHERE id = ?", (run_id,)).fetchone()
+        lines = ["Run %i: %s -> %s, started %s, %s" % (
+            run_id, local_root, remote_root, time.ctime(started),
+            "finished %s" % time.ctime(finished) if finished is not None else "unfinished")]
+
+        rows = self.db.execute(
+            "SELECT kind, state, COUNT(*), SUM(size), SUM(attempts) FROM items WHERE run = ? "
+            "GROUP BY kind, state ORDER BY kind, state", (run_id,))
+        for kind, state, count, size, attempts in rows:
+            lines.append("  %-6s %-9s %8i items %14i bytes %6i retries" % (
+                KIND_NAMES[kind], STATE_NAMES[state], count, size or 0, attempts or 0))
+
+        for path, error in self.db.execute(
+                "SELECT path, error FROM items WHERE run = ? AND state = ?", (run_id, FAILED)):
+            lines.append("  FAILED %s: %s" % (path, error))
+
+        return "\n".join(lines)
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,218 @@
+import os, sqlite3, threading
+from pathlib import Path
+
+def relative_parent(rel_path):
+    return rel_path.rpartition("/")[0]
+
+def join_relative(rel_dir, name):
+    return name if rel_dir == "" else rel_dir + "/" + name
+
+class LocalScan:
+    """
+    Result of LocalIndex.scan. DIRTY holds the relative paths of directories whose listing changed
+    since the last commit (or which weren't indexed yet); everything else was taken from the
+    index without being read.
+    """
+
+    def __init__(self, index, local_root, full_rescan):
+        self.index = index
+        self.local_root = Path(local_root)
+        self.full_rescan = full_rescan
+        self.dirty = set()
+        self.changed_files = set()
+
+        # Freshly read state of the dirty directories, waiting to be committed.
+        self.dir_stats = {}
+        self.listings = {}
+
+        self.to_visit = set()
+
+    def mark_visits(self):
+        for rel_dir in self.dirty:
+            while rel_dir not in self.to_visit:
+                self.to_visit.add(rel_dir)
+                if rel_dir == "":
+                    break
+                rel_dir = relative_parent(rel_dir)
+
+    def relative(self, local_path):
+        rel_path = Path(local_path).absolute().relative_to(self.local_root).as_posix()
+        return "" if rel_path == "." else rel_path
+
+    def needs_visit(self, local_path):
+        """
+        Whether the diff has to look at LOCAL_PATH at all, i.e. whether it or something underneath
+        it changed.
+        """
+        return self.relative(local_path) in self.to_visit
+
+    def list_dir(self, local_path):
+        """
+        Returns the (name, is_dir, size) entries of LOCAL_PATH without touching the disk.
+        """
+        rel_dir = self.relative(local_path)
+        listing = self.listings.get(rel_dir)
+        if listing is None:
+            listing = self.index.get_entries(self.local_root, rel_dir)
+        return [(name, is_dir, size) for name, (is_dir, size, _, _) in listing.items()]
+
+    def files_under(self, local_path):
+        """
+        Yields (path, size) for every file underneath LOCAL_PATH, from fresh listings where there
+        are some and from the index elsewhere, as a directory that didn't change locally may still
+        be missing remotely.
+        """
+        stack = [self.relative(local_path)]
+        while stack:
+            rel_dir = stack.pop()
+            listing = self.listings.get(rel_dir)
+            if listing is None:
+                listing = self.index.get_entries(self.local_root, rel_dir)
+            for name, (is_dir, size, _, _) in listing.items():
+                if is_dir:
+                    stack.append(join_relative(rel_dir, name))
+                else:
+                    yield self.local_root / join_relative(rel_dir, name), size
+
+class LocalIndex:
+    """
+    SQLite record of the local tree as of the last successful sync: the (size, mtime, inode) of
+    every entry, plus the mtime of every directory. A directory's mtime only changes when entries
+    are added to, removed from or renamed within it, so a directory whose mtime is unchanged can be
+    reused from the index without listing or statting its contents. Edits to a file's contents do
+    not change its directory's mtime, which is what a full rescan is for.
+
+    Listings are read from whichever thread runs the diff, so queries go through a lock.
+    """
+
+    def __init__(self, db_path):
+        self.db = sqlite3.connect(str(db_path), check_same_thread=False)
+        self.lock = threading.Lock()
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS dirs (
+                root TEXT, path TEXT, mtime_ns INTEGER, inode INTEGER,
+                PRIMARY KEY (root, path));
+            CREATE TABLE IF NOT EXISTS entries (
+                root TEXT, parent TEXT, name TEXT, is_dir INTEGER,
+                size INTEGER, mtime_ns INTEGER, inode INTEGER,
+                PRIMARY KEY (root, parent, name));
+        """)
+        self.db.commit()
+
+    def get_dir_stat(self, local_root, rel_dir):
+        with self.lock:
+            return self.db.execute(
+                "SELECT mtime_ns, inode FROM dirs WHERE root = ? AND path = ?",
+                (str(local_root), rel_dir)).fetchone()
+
+    def list_dir(self, local_root, rel_dir):
+        with self.lock:
+            return [
+                (name, bool(is_dir)) for name, is_dir in self.db.execute(
+                    "SELECT name, is_dir FROM entries WHERE root = ? AND parent = ?",
+                    (str(local_root), rel_dir))
+            ]
+
+    def get_entries(self, local_root, rel_dir):
+        with self.lock:
+            return {
+                name: (bool(is_dir), size, mtime_ns, inode)
+                for name, is_dir, size, mtime_ns, inode in self.db.execute(
+                    "SELECT name, is_dir, size, mtime_ns, inode FROM entries WHERE root = ? AND parent = ?",
+                    (str(local_root), rel_dir))
+            }
+
+    def scan(self, local_root, full_rescan=False):
+        """
+        Walks LOCAL_ROOT, only reading directories whose mtime or inode differ from the index (or
+        every directory, if FULL_RESCAN). Nothing is written until the scan is committed.
+        """
+        local_root = Path(local_root).absolute()
+        scan = LocalScan(self, local_root, full_rescan)
+
+        stack = [""]
+        while stack:
+            rel_dir = stack.pop()
+            stat = os.stat(str(local_root / rel_dir))
+            dir_stat = (stat.st_mtime_ns, stat.st_ino)
+
+            if not full_rescan and self.get_dir_stat(local_root, rel_dir) == dir_stat:
+                stack.extend(
+                    join_relative(rel_dir, name)
+                    for name, is_dir in self.list_dir(local_root, rel_dir) if is_dir)
+                continue
+
+            indexed = self.get_entries(local_root, rel_dir)
+            listing = {}
+            with os.scandir(str(local_root / rel_dir)) as entries:
+                for entry in entries:
+                    is_dir = entry.is_dir()
+                    entry_stat = entry.stat()
+                    listing[entry.name] = (is_dir, entry_stat.st_size, entry_stat.st_mtime_ns, entry_stat.st_ino)
+
+                    if is_dir:
+                        stack.append(join_relative(rel_dir, entry.name))
+                    elif indexed.get(entry.name) != listing[entry.name]:
+                        scan.changed_files.add(join_relative(rel_dir, entry.name))
+
+            scan.dirty.add(rel_dir)
+            scan.dir_stats[rel_dir] = dir_stat
+            scan.listings[rel_dir] = listing
+
+        scan.mark_visits()
+        return scan
+
+    def commit(self, scan, failed_dirs=()):
+        """
+        Records the state read by SCAN as synced, except for the directories in FAILED_DIRS (local
+        paths) and their ancestors. Those are forgotten, whether SCAN read them or took them from
+        the index, so that the next scan reads them and the diff looks at them again.
+        """
+        local_root = str(scan.local_root)
+        failed = set()
+        for local_path in failed_dirs:
+            rel_dir = scan.relative(local_path)
+            while rel_dir not in failed:
+                failed.add(rel_dir)
+                if rel_dir == "":
+                    break
+                rel_dir = relative_parent(rel_dir)
+
+        for rel_dir, listing in scan.listings.items():
+            if rel_dir in failed:
+                continue
+
+            # Forget about subtrees that disappeared since the last commit.
+            gone = [
+                join_relative(rel_dir, name)
+                for name, (is_dir, _, _, _) in self.get_entries(local_root, rel_dir).items()
+                if is_dir and name not in listing
+            ]
+            with self.lock:
+                for rel_path in gone:
+                    prefix = rel_path + "/"
+                    self.db.execute(
+                        "DELETE FROM dirs WHERE root = ? AND (path = ? OR substr(path, 1, ?) = ?)",
+                        (local_root, rel_path, len(prefix), prefix))
+                    self.db.execute(
+                        "DELETE FROM entries WHERE root = ? AND (parent = ? OR substr(parent, 1, ?) = ?)",
+                        (local_root, rel_path, len(prefix), prefix))
+
+                self.db.execute("DELETE FROM entries WHERE root = ? AND parent = ?", (local_root, rel_dir))
+                self.db.executemany(
+                    "INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    [
+                        (local_root, rel_dir, name, int(is_dir), size, mtime_ns, inode)
+                        for name, (is_dir, size, mtime_ns, inode) in listing.items()
+                    ])
+                self.db.execute(
+                    "INSERT OR REPLACE INTO dirs VALUES (?, ?, ?, ?)",
+                    (local_root, rel_dir) + scan.dir_stats[rel_dir])
+
+        with self.lock:
+            self.db.executemany(
+                "DELETE FROM dirs WHERE root = ? AND path = ?", [(local_root, rel_dir) for rel_dir in failed])
+            self.db.commit()
+
+    def close(self):
+        self.db.close()
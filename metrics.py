@@ -0,0 +1,244 @@
+from contextlib import contextmanager
+from pathlib import Path
+
+import bisect, json, os, shutil, sys, threading, time
+
+PREFIX = "drivesync_"
+
+# Upper bounds in seconds, spanning a cached metadata call to a multi-minute chunk upload.
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count, self.sum, self.max = 0, 0.0, 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """
+        Estimates the Q quantile by interpolating within the bucket it falls in.
+        """
+        if self.count == 0:
+            return 0.0
+        rank, seen = q * self.count, 0
+        for i, count in enumerate(self.counts):
+            if seen + count >= rank and count > 0:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.max
+                return min(self.max, lower + (upper - lower) * (rank - seen) / count)
+            seen += count
+        return self.max
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (key, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                             for key, value in labels)
+
+class Metrics:
+    """
+    Thread-safe registry of counters, gauges and latency histograms, each keyed by a name and a set
+    of labels, which can be exported in the Prometheus text format or as JSON lines.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters, self.gauges, self.histograms = {}, {}, {}
+        self.started = time.time()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    @contextmanager
+    def timed(self, operation):
+        """
+        Times the Drive API call made inside the block as OPERATION, noting whether it raised.
+        """
+        started, status = time.time(), "ok"
+        try:
+            yield
+        except BaseException:
+            status = "error"
+            raise
+        finally:
+            self.observe("request_seconds", time.time() - started, operation=operation, status=status)
+
+    def clear(self):
+        with self.lock:
+            self.counters, self.gauges, self.histograms = {}, {}, {}
+            self.started = time.time()
+
+    def prometheus_text(self):
+        lines = []
+        with self.lock:
+            for kind, values in (("counter", self.counters), ("gauge", self.gauges)):
+                for name in sorted({name for name, _ in values}):
+                    lines.append("# TYPE %s%s %s" % (PREFIX, name, kind))
+                    for (other, labels), value in sorted(values.items()):
+                        if other == name:
+                            lines.append("%s%s%s %s" % (PREFIX, name, format_labels(labels), value))
+
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append("# TYPE %s%s histogram" % (PREFIX, name))
+                for (other, labels), histogram in sorted(self.histograms.items()):
+                    if other != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(list(histogram.buckets) + ["+Inf"], histogram.counts):
+                        cumulative += count
+                        lines.append("%s%s_bucket%s %i" % (
+                            PREFIX, name, format_labels(labels + (("le", bound),)), cumulative))
+                    lines.append("%s%s_sum%s %f" % (PREFIX, name, format_labels(labels), histogram.sum))
+                    lines.append("%s%s_count%s %i" % (PREFIX, name, format_labels(labels), histogram.count))
+        return "\n".join(lines) + "\n"
+
+    def json_line(self):
+        with self.lock:
+            record = {
+                "time": time.time(),
+                "counters": [dict(labels, name=name, value=value) for (name, labels), value in self.counters.items()],
+                "gauges": [dict(labels, name=name, value=value) for (name, labels), value in self.gauges.items()],
+                "histograms": [
+                    dict(labels, name=name, count=histogram.count, sum=histogram.sum, max=histogram.max,
+                         p50=histogram.quantile(0.5), p95=histogram.quantile(0.95), buckets=histogram.counts)
+                    for (name, labels), histogram in self.histograms.items()
+                ],
+            }
+        return json.dumps(record)
+
+    def summary(self):
+        """
+        Returns a printable table of where the time went: calls, total and typical latency per
+        Drive operation, busiest first.
+        """
+        totals = {}
+        with self.lock:
+            for (name, labels), histogram in self.histograms.items():
+                if name == "request_seconds":
+                    labels = dict(labels)
+                    totals.setdefault(labels["operation"], []).append((labels["status"], histogram))
+            counters = dict(self.counters)
+
+        lines = ["%-18s %8s %7s %10s %8s %8s %8s" % ("operation", "calls", "errors", "total s", "mean s", "p95 s", "max s")]
+        for operation, histograms in sorted(totals.items(), key=lambda item: -sum(h.sum for _, h in item[1])):
+            merged = Histogram()
+            for _, histogram in histograms:
+                merged.counts = [a + b for a, b in zip(merged.counts, histogram.counts)]
+                merged.count += histogram.count
+                merged.sum += histogram.sum
+                merged.max = max(merged.max, histogram.max)
+            errors = sum(histogram.count for status, histogram in histograms if status == "error")
+            lines.append("%-18s %8i %7i %10.1f %8.3f %8.3f %8.3f" % (
+                operation, merged.count, errors, merged.sum, merged.sum / merged.count, merged.quantile(0.95),
+                merged.max))
+
+        for (name, labels), value in sorted(counters.items()):
+            lines.append("%s%s %s" % (name, format_labels(labels), value))
+        return "\n".join(lines)
+
+METRICS = Metrics()
+
+class Reporter:
+    """
+    Background thread that, every INTERVAL seconds, shows the status line of everything registered
+    with it and exports METRICS, appending a JSON line to METRICS_FILE and rewriting PROMETHEUS_FILE
+    (e.g. for node_exporter's textfile collector). Nothing it does holds up the transfers.
+
+    On a terminal the status is redrawn in place every second by default; otherwise it's printed
+    as plain timestamped lines every 30 seconds, which reads fine in a cron log.
+    """
+
+    def __init__(self, interval=None, metrics=METRICS, metrics_file=None, prometheus_file=None, stream=None):
+        self.stream = sys.stdout if stream is None else stream
+        self.is_terminal = self.stream.isatty()
+        self.interval = interval if interval is not None else (1.0 if self.is_terminal else 30.0)
+        self.metrics = metrics
+        self.metrics_file, self.prometheus_file = metrics_file, prometheus_file
+
+        self.lock = threading.Lock()
+        self.statuses = []
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def add(self, status):
+        """
+        Registers STATUS, a function returning a one-line description of some work in progress.
+        """
+        with self.lock:
+            self.statuses.append(status)
+
+    def remove(self, status):
+        with self.lock:
+            self.statuses.remove(status)
+        if self.is_terminal:
+            self.stream.write("\r\033[K")
+            self.stream.flush()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="reporter", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.report()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.report()
+
+    def report(self):
+        with self.lock:
+            statuses = list(self.statuses)
+        try:
+            lines = [status() for status in statuses]
+        except Exception as e:
+            lines = ["Status unavailable: %s" % str(e)]
+
+        if lines and self.is_terminal:
+            line = " | ".join(lines)
+            self.stream.write("\r\033[K" + line[ : shutil.get_terminal_size().columns - 1])
+            self.stream.flush()
+        elif lines:
+            for line in lines:
+                self.stream.write("%s %s\n" % (time.strftime("%Y-%m-%d %H:%M:%S"), line))
+            self.stream.flush()
+
+        self.export()
+
+    def export(self):
+        if self.metrics_file is not None:
+            with open(str(self.metrics_file), "a") as f:
+                f.write(self.metrics.json_line() + "\n")
+        if self.prometheus_file is not None:
+            temp_path = Path(str(self.prometheus_file) + ".tmp")
+            with open(str(temp_path), "w") as f:
+                f.write(self.metrics.prometheus_text())
+            os.replace(str(temp_path), str(self.prometheus_file))
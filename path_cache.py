@@ -0,0 +1,127 @@
+import json, sqlite3, threading
+from pathlib import Path
+
+# Metadata fields kept for each cached path. Everything else is dropped so that the persistent
+# store stays small and cached objects don't pin whole API responses in memory.
+CACHED_FIELDS = ("id", "title", "mimeType", "fileSize", "md5Checksum", "modifiedDate", "parents")
+
+# Written-through entries are committed this many at a time (and by commit()), rather than each
+# paying for a sync to disk while warming the cache for a large tree.
+COMMIT_INTERVAL = 1000
+
+def normalize_path(path):
+    parts = Path(str(path)).parts
+    if parts and parts[0] == "/":
+        parts = parts[1 : ]
+    return "/".join(parts)
+
+class PathCache:
+    """
+    Maps remote paths (relative to the drive root) to file metadata, so that repeated path
+    resolutions under a warm prefix cost no API calls. Paths known not to exist are remembered as
+    None for the lifetime of the process, but are never persisted.
+
+    If DB_PATH is given, entries are also written through to an SQLite database, keyed by ACCOUNT,
+    and loaded back on construction. Writes are committed in batches, so call commit() at the end
+    of a run.
+    """
+
+    def __init__(self, db_path=None, account=None):
+        self.entries = {}
+        self.hits, self.misses = 0, 0
+        self.lock = threading.RLock()
+
+        self.db, self.account = None, account
+        self.uncommitted = 0
+        if db_path is not None:
+            self.attach(db_path, account)
+
+    def attach(self, db_path, account):
+        """
+        Starts writing entries through to the SQLite database at DB_PATH, and loads whatever was
+        persisted there for ACCOUNT.
+        """
+        with self.lock:
+            self.close()
+            self.db, self.account = sqlite3.connect(str(db_path), check_same_thread=False), account
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS paths "
+                "(account TEXT, path TEXT, metadata TEXT, PRIMARY KEY (account, path))")
+            self.db.commit()
+            rows = self.db.execute(
+                "SELECT path, metadata FROM paths WHERE account = ?", (self.account,))
+            for path, metadata in rows:
+                self.entries[path] = json.loads(metadata)
+
+    def lookup(self, path):
+        """
+        Returns a 2-tuple (found, metadata). If FOUND is False, nothing is known about PATH. If
+        FOUND is True, METADATA is either the cached metadata dict or None, meaning that PATH is
+        known not to exist.
+        """
+        path = normalize_path(path)
+        with self.lock:
+            if path in self.entries:
+                self.hits += 1
+                return True, self.entries[path]
+            else:
+                self.misses += 1
+                return False, None
+
+    def put(self, path, drive_file):
+        path = normalize_path(path)
+        metadata = None
+        if drive_file is not None:
+            metadata = {key: drive_file[key] for key in CACHED_FIELDS if key in drive_file}
+
+        with self.lock:
+            self.entries[path] = metadata
+            if self.db is not None and metadata is not None:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO paths VALUES (?, ?, ?)",
+                    (self.account, path, json.dumps(metadata)))
+                self.uncommitted += 1
+                if self.uncommitted >= COMMIT_INTERVAL:
+                    self.commit()
+
+    def invalidate(self, path):
+        """
+        Drops PATH and everything underneath it.
+        """
+        path = normalize_path(path)
+        prefix = path + "/"
+        with self.lock:
+            for cached_path in [p for p in self.entries if p == path or p.startswith(prefix)]:
+                del self.entries[cached_path]
+            if self.db is not None:
+                self.db.execute(
+                    "DELETE FROM paths WHERE account = ? AND (path = ? OR substr(path, 1, ?) = ?)",
+                    (self.account, path, len(prefix), prefix))
+                self.db.commit()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            if self.db is not None:
+                self.db.execute("DELETE FROM paths WHERE account = ?", (self.account,))
+                self.db.commit()
+
+    def commit(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.commit()
+            self.uncommitted = 0
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self.entries)}
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.commit()
+                self.db.close()
+                self.db = None
+
+# Cache shared by every module that resolves remote paths.
+PATH_CACHE = PathCache()
@@ -0,0 +1,318 @@
+from pathlib import Path
+
+from batch import MAX_BATCH_SIZE
+from hashing import HashCache
+from journal import Journal
+from path_cache import PATH_CACHE
+from resumable import CHUNK_ALIGNMENT
+from scanner import ParallelScanner, scan
+from scheduling import DEFAULT_BYTES_PER_SECOND, DEFAULT_FILE_OVERHEAD, estimate_makespan, format_duration
+from syncer import UploadItem, diff_upload, load_remote_snapshot, make_policy, run_upload, validate_arguments
+from uploader import format_bytes
+
+import gzip, json, math, os, time
+
+PLAN_VERSION = 1
+
+class Plan:
+    """
+    Everything an upload of LOCAL_ROOT to REMOTE_ROOT is going to do, worked out by the diff ahead of
+    time, so it can be looked over (and scheduled) before anything on Drive changes:
+
+    - UPLOADS, [parent id, path, size, mtime_ns] for each UploadItem (size and mtime None for an
+      empty directory),
+    - UPDATES, [path, drive file, size, mtime_ns] for each file whose remote content differs,
+    - MOVES, [path, old remote path, size, mtime_ns] for each file relocated rather than uploaded,
+    - FOLDERS, the remote folders that will have to be created,
+    - BUNDLED, [path, files, bytes] for each directory going up as bundles (see bundles.py),
+
+    with paths relative to LOCAL_ROOT, plus ESTIMATE, as worked out by estimate_plan. Saved as
+    gzipped JSON.
+    """
+
+    def __init__(self, local_root, remote_root, uploads=(), updates=(), moves=(), folders=(), bundled=(),
+                 estimate=None, created=None, path=None):
+        self.local_root = Path(local_root).absolute()
+        self.remote_root = str(remote_root)
+        self.uploads, self.updates, self.moves = list(uploads), list(updates), list(moves)
+        self.folders, self.bundled_dirs = list(folders), list(bundled)
+        self.estimate = {} if estimate is None else estimate
+        self.created = time.time() if created is None else created
+        self.path = path
+        self.changed = []
+
+    @property
+    def key(self):
+        """
+        Identifies the plan in the journal: where it was saved and when it was made, so each
+        plan is carried out at most once however often it's applied.
+        """
+        return "%s@%r" % (Path(self.path).absolute(), self.created)
+
+    @property
+    def bundled(self):
+        return [path for path, _, _ in self.bundled_dirs]
+
+    def sizes(self):
+        return [entry[2] for entry in self.uploads + self.updates + self.moves if entry[2] is not None]
+
+    def save(self, path):
+        self.path = path
+        with gzip.open(str(path), "wt") as f:
+            json.dump({
+                "version": PLAN_VERSION,
+                "created": self.created,
+                "local_root": str(self.local_root),
+                "remote_root": self.remote_root,
+                "uploads": self.uploads,
+                "updates": self.updates,
+                "moves": self.moves,
+                "folders": self.folders,
+                "bundled": self.bundled_dirs,
+                "estimate": self.estimate,
+            }, f)
+
+    def is_unchanged(self, path, size, mtime_ns):
+        if size is None:
+            return (self.local_root / path).is_dir()
+        try:
+            stat = os.stat(str(self.local_root / path))
+        except FileNotFoundError:
+            return False
+        return (stat.st_size, stat.st_mtime_ns) == (size, mtime_ns)
+
+    def items(self, done=()):
+        """
+        Returns the (to_upload, to_update, to_move) lists of the plan, in the shape
+        UploadScheduler.run takes, less the paths in DONE, which an earlier apply already carried
+        out. Files changed or gone since the plan was made are left out, and listed in CHANGED, as
+        what's on Drive may no longer be what they need.
+        """
+        to_upload, to_update, to_move, self.changed = [], [], [], []
+        for parent_id, path, size, mtime_ns in self.uploads:
+            if path in done:
+                continue
+            if self.is_unchanged(path, size, mtime_ns):
+                to_upload.append(UploadItem(parent_id, path, size))
+            else:
+                self.changed.append(path)
+        for path, drive_file, size, mtime_ns in self.updates:
+            if path in done:
+                continue
+            if self.is_unchanged(path, size, mtime_ns):
+                to_update.append((self.local_root / path, drive_file))
+            else:
+                self.changed.append(path)
+        for path, old_remote_path, size, mtime_ns in self.moves:
+            if path in done:
+                continue
+            if self.is_unchanged(path, size, mtime_ns):
+                to_move.append((self.local_root / path, Path(old_remote_path)))
+            else:
+                self.changed.append(path)
+        return to_upload, to_update, to_move
+
+    def summary(self):
+        lines = ["Plan for %s -> %s, made %s:" % (self.local_root, self.remote_root, time.ctime(self.created)),
+                 "  %i folders to create" % len(self.folders),
+                 "  %i files to upload, %i to update, %i to move, %s in all" % (
+                     len([entry for entry in self.uploads if entry[2] is not None]), len(self.updates),
+                     len(self.moves), format_bytes(sum(self.sizes())))]
+        if self.bundled_dirs:
+            lines.append("  %i directories to bundle, holding %i files, %s" % (
+                len(self.bundled_dirs), sum(files for _, files, _ in self.bundled_dirs),
+                format_bytes(sum(size for _, _, size in self.bundled_dirs))))
+        if self.estimate:
+            lines.append("  About %i API calls (%s)" % (
+                sum(self.estimate["calls"].values()),
+                ", ".join("%s %i" % item for item in sorted(self.estimate["calls"].items(), key=lambda item: -item[1]))))
+            lines.append("  Estimated duration %s on %i workers, going by %s" % (
+                format_duration(self.estimate["seconds"]), self.estimate["workers"], self.estimate["basis"]))
+        return "\n".join(lines)
+
+def load_plan(path):
+    with gzip.open(str(path), "rt") as f:
+        saved = json.load(f)
+    if saved.get("version") != PLAN_VERSION:
+        raise ValueError("%s is a plan of an unsupported version" % path)
+    return Plan(saved["local_root"], saved["remote_root"], saved["uploads"], saved["updates"], saved["moves"],
+                saved["folders"], saved["bundled"], saved["estimate"], saved["created"], path)
+
+def folders_to_create(to_upload, remote_root):
+    """
+    Returns the remote folders the UploadItems of TO_UPLOAD need that aren't known to exist, going
+    by what the diff put in the path cache, parents first.
+    """
+    remote_root, needed = Path(remote_root), set()
+    for item in to_upload:
+        rel_path = Path(item.path)
+        rel_dirs = list(rel_path.parents)[ : -1] if item.size is not None else [rel_path] + list(rel_path.parents)[ : -1]
+        for rel_dir in rel_dirs:
+            remote_dir_path = remote_root / rel_dir
+            if remote_dir_path in needed:
+                break
+            found, metadata = PATH_CACHE.lookup(remote_dir_path)
+            if found and metadata is not None:
+                break
+            needed.add(remote_dir_path)
+    return sorted(needed, key=lambda path: (len(path.parts), str(path)))
+
+def transfer_calls(size, resumable_threshold, chunk_size, simple_operation, calls):
+    """
+    Adds the requests an upload of SIZE bytes takes to CALLS, by operation.
+    """
+    if resumable_threshold is not None and size >= max(resumable_threshold, 1):
+        calls["resumable.start"] = calls.get("resumable.start", 0) + 1
+        calls["resumable.chunk"] = calls.get("resumable.chunk", 0) + math.ceil(size / chunk_size)
+    else:
+        calls[simple_operation] = calls.get(simple_operation, 0) + 1
+
+def estimate_plan(plan, args, journal=None):
+    """
+    Works out how many API calls PLAN will take with ARGS' settings, by operation, and how long,
+    simulating ARGS.workers workers with the throughput measured over recent runs in JOURNAL (or
+    rough defaults, without enough history). Returns a dict of the estimate, which also goes in the
+    plan.
+    """
+    resumable_threshold = args.resumable_threshold * 1024 * 1024
+    chunk_size = max(CHUNK_ALIGNMENT, args.chunk_size * 1024 * 1024)
+    calls = {}
+
+    levels = {}
+    for remote_dir_path in plan.folders:
+        levels.setdefault(len(Path(remote_dir_path).parts), []).append(remote_dir_path)
+    created, folder_rounds = set(plan.folders), 0
+    for level in levels.values():
+        # Folders under ones created in this run needn't be looked up first.
+        lookups = len([path for path in level if str(Path(path).parent) not in created])
+        if args.no_batch:
+            calls["files.list"] = calls.get("files.list", 0) + lookups
+            calls["files.insert"] = calls.get("files.insert", 0) + len(level)
+            folder_rounds += math.ceil((lookups + len(level)) / args.workers)
+        else:
+            batches = math.ceil(lookups / MAX_BATCH_SIZE) + math.ceil(len(level) / MAX_BATCH_SIZE)
+            calls["batch"] = calls.get("batch", 0) + batches
+            folder_rounds += batches
+
+    sizes = []
+    for _, _, size, _ in plan.uploads:
+        if size is not None:
+            transfer_calls(size, resumable_threshold, chunk_size, "files.insert", calls)
+            sizes.append(size)
+    for _, _, size, _ in plan.updates:
+        transfer_calls(size, resumable_threshold, chunk_size, "files.update", calls)
+        sizes.append(size)
+    if plan.moves:
+        # The old and new parents are usually in the path cache by then.
+        calls["files.update"] = calls.get("files.update", 0) + len(plan.moves)
+        sizes.extend([0] * len(plan.moves))
+
+    bundle_size = args.bundle_size * 1024 * 1024
+    for _, files, size in plan.bundled_dirs:
+        # A lookup of the bundle folder and its index, the index itself, and each bundle.
+        calls["files.list"] = calls.get("files.list", 0) + 2
+        calls["files.insert"] = calls.get("files.insert", 0) + 1
+        num_bundles = max(math.ceil(size / bundle_size), math.ceil(files / args.bundle_max_files), 1)
+        for _ in range(num_bundles):
+            transfer_calls(size // num_bundles, 0, chunk_size, "files.insert", calls)
+            sizes.append(size // num_bundles)
+
+    throughput = journal.throughput() if journal is not None else None
+    file_overhead, bytes_per_second = DEFAULT_FILE_OVERHEAD, DEFAULT_BYTES_PER_SECOND
+    basis = "rough defaults (no transfer history yet)"
+    if throughput is not None:
+        file_overhead, measured_rate, samples = throughput
+        if measured_rate is not None:
+            bytes_per_second = measured_rate
+        basis = "%i recent transfers" % samples
+    basis += ": %.2fs per file plus %s/s per worker" % (file_overhead, format_bytes(bytes_per_second))
+
+    seconds = estimate_makespan(sizes, make_policy(args), args.workers, file_overhead, bytes_per_second)
+    # Each level of folders is created before any file under it, with nothing else going on.
+    seconds += folder_rounds * file_overhead
+    if args.request_rate:
+        # The request budget caps how fast calls can go, however many workers there are.
+        seconds = max(seconds, sum(calls.values()) / args.request_rate)
+
+    plan.estimate = {
+        "calls": calls,
+        "seconds": seconds,
+        "workers": args.workers,
+        "file_overhead": file_overhead,
+        "bytes_per_second": bytes_per_second,
+        "basis": basis,
+    }
+    return plan.estimate
+
+def make_plan(drive, args, snapshot=None):
+    """
+    Runs the diff of an upload of ARGS.local to ARGS.remote, from SNAPSHOT and ARGS.local_index
+    where available, and returns what it found as an estimated Plan. Nothing is changed on Drive.
+    """
+    hash_cache = HashCache(args.hash_cache)
+    to_upload, to_update, to_move, local_index, local_scan, bundling = diff_upload(drive, args, snapshot, hash_cache)
+    to_upload = list(to_upload)
+    print()
+    hash_cache.commit()
+    PATH_CACHE.commit()
+    if isinstance(local_scan, ParallelScanner):
+        local_scan.close()
+
+    local_root = Path(args.local).absolute()
+    mtime_ns = lambda local_path: os.stat(str(local_path)).st_mtime_ns
+    uploads = [
+        [item.parent_id, item.path, item.size, None if item.size is None else mtime_ns(local_root / item.path)]
+        for item in to_upload
+    ]
+    updates = [
+        [Path(local_path).absolute().relative_to(local_root).as_posix(),
+         {key: drive_file[key] for key in ("id", "title", "mimeType") if key in drive_file},
+         local_path.stat().st_size, mtime_ns(local_path)]
+        for local_path, drive_file in to_update
+    ]
+    moves = [
+        [Path(local_path).absolute().relative_to(local_root).as_posix(), str(old_remote_path),
+         Path(local_path).stat().st_size, mtime_ns(local_path)]
+        for local_path, old_remote_path in to_move
+    ]
+    bundled = []
+    for rel_dir in (bundling.bundled if bundling is not None else ()):
+        entries = [entry for entry in scan(local_root / rel_dir) if not entry.is_dir]
+        bundled.append([rel_dir, len(entries), sum(entry.size for entry in entries)])
+    folders = [str(path) for path in folders_to_create(to_upload, args.remote)]
+
+    plan = Plan(local_root, args.remote, uploads, updates, moves, folders, bundled)
+    estimate_plan(plan, args, Journal(args.journal))
+    return plan
+
+def run_plan(drive, args):
+    """
+    The plan command: diffs, then saves the plan to ARGS.plan_file and prints a summary of it.
+    Returns the Plan.
+    """
+    validate_arguments(drive, args.local, args.remote)
+    plan = make_plan(drive, args, load_remote_snapshot(drive, args))
+    plan.save(args.plan_file)
+    print(plan.summary())
+    print("Saved plan to %s; carry it out with the apply command" % args.plan_file)
+    return plan
+
+def run_apply(drive, args, drive_factory=None, reporter=None):
+    """
+    The apply command: uploads exactly what the plan in ARGS.plan_file says, through the same
+    concurrent engine as an upload, skipping files changed since. DRIVE_FACTORY and REPORTER are
+    as in run_upload. Returns what run_upload does, with the skipped files among the errors.
+    """
+    plan = load_plan(args.plan_file)
+    print(plan.summary())
+    args.local, args.remote = str(plan.local_root), plan.remote_root
+
+    started = time.time()
+    errored, created = run_upload(drive, args, drive_factory=drive_factory, reporter=reporter, plan=plan)
+    for path in plan.changed:
+        print("Skipped %s, which changed since the plan was made" % path)
+        errored.append((plan.local_root / path, None, ValueError("Changed since the plan was made")))
+    if plan.estimate:
+        print("Took %s against an estimated %s" % (
+            format_duration(time.time() - started), format_duration(plan.estimate["seconds"])))
+    return errored, created
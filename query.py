@@ -0,0 +1,106 @@
+from metrics import METRICS
+
+FOLDER_MIME_TYPE = "application/vnd.google-apps.folder"
+
+# The most items Drive returns per page of files.list.
+MAX_PAGE_SIZE = 1000
+
+# Drive rejects overly long search queries, and they have to fit in a URL, so OR-chains of titles are
+# cut to this many characters.
+MAX_QUERY_LENGTH = 4000
+
+# Past this many OR-chained queries for one folder, listing the whole folder is likely cheaper.
+MAX_TITLE_QUERIES = 2
+
+# Everything the diff, the snapshot and the path cache look at, and only that.
+ITEM_FIELDS = "id,title,mimeType,fileSize,md5Checksum,modifiedDate,parents(id)"
+# Just enough to tell files from folders and recurse into the latter.
+NAME_FIELDS = "id,title,mimeType,parents(id)"
+
+def quote(value):
+    """
+    Returns VALUE as a string literal for a Drive search query.
+    """
+    return "'%s'" % value.replace("\\", "\\\\").replace("'", "\\'")
+
+def children_query(parent_id, titles=None, folders_only=False):
+    """
+    Returns a query for the non-trashed children of PARENT_ID, only those named one of TITLES if
+    given, and only folders if FOLDERS_ONLY.
+    """
+    query = "%s in parents and trashed=false" % quote(parent_id)
+    if folders_only:
+        query += " and mimeType=%s" % quote(FOLDER_MIME_TYPE)
+    if titles is not None:
+        query += " and (%s)" % " or ".join("title=%s" % quote(title) for title in titles)
+    return query
+
+def chunk_titles(parent_id, titles, folders_only=False, max_length=MAX_QUERY_LENGTH):
+    """
+    Splits TITLES into runs whose children_query stays within MAX_LENGTH characters. Yields a
+    query for each run.
+    """
+    base_length = len(children_query(parent_id, [], folders_only))
+    run, length = [], base_length
+    for title in titles:
+        term_length = len(" or title=") + len(quote(title))
+        if run and length + term_length > max_length:
+            yield children_query(parent_id, run, folders_only)
+            run, length = [], base_length
+        run.append(title)
+        length += term_length
+    if run:
+        yield children_query(parent_id, run, folders_only)
+
+def list_files(drive, query, fields=ITEM_FIELDS, max_results=MAX_PAGE_SIZE, all_pages=True):
+    """
+    Returns every file matching QUERY (or only the first page of them, unless ALL_PAGES), fetched
+    MAX_RESULTS at a time with only FIELDS of each.
+    """
+    file_list = drive.ListFile({
+        "q": query,
+        "fields": ("nextPageToken,items(%s)" if all_pages else "items(%s)") % fields,
+        "maxResults": max_results,
+    })
+    # With maxResults given, GetList fetches a single page, so go through them one by one.
+    pages, drive_files = iter(file_list), []
+    while True:
+        with METRICS.timed("files.list"):
+            page = next(pages, None)
+        if page is None:
+            return drive_files
+        drive_files.extend(page)
+        if not all_pages:
+            return drive_files
+
+def list_children(drive, parent_id, fields=ITEM_FIELDS, folders_only=False):
+    return list_files(drive, children_query(parent_id, folders_only=folders_only), fields)
+
+def find_child(drive, parent_id, title, fields=ITEM_FIELDS):
+    """
+    Returns the child of PARENT_ID named TITLE, or None if there's none.
+    """
+    drive_files = list_files(drive, children_query(parent_id, [title]), fields, max_results=1, all_pages=False)
+    return drive_files[0] if drive_files else None
+
+def find_children(drive, parent_id, titles, fields=ITEM_FIELDS):
+    """
+    Looks up which of TITLES exist under PARENT_ID, with a few OR-chained queries rather than one
+    per title, fetching only FIELDS. Returns a dict of title -> drive file for those that do.
+
+    Past MAX_TITLE_QUERIES queries' worth of titles, this lists all of PARENT_ID's children
+    instead: a full page holds several times more files than an OR-chain can name, so that's fewer
+    requests unless the folder holds many more files than are being looked for.
+    """
+    titles = list(dict.fromkeys(titles))
+    queries = list(chunk_titles(parent_id, titles))
+    if len(queries) > MAX_TITLE_QUERIES:
+        wanted = set(titles)
+        return {drive_file["title"]: drive_file for drive_file in list_children(drive, parent_id, fields)
+                if drive_file["title"] in wanted}
+
+    found = {}
+    for query in queries:
+        for drive_file in list_files(drive, query, fields):
+            found[drive_file["title"]] = drive_file
+    return found
@@ -0,0 +1,175 @@
+from apiclient.errors import HttpError
+from pydrive.files import ApiRequestError, GoogleDriveFile
+
+from pathlib import Path
+
+from metrics import METRICS
+
+import hashlib, json, mimetypes, mmap, os, re
+
+UPLOAD_URL = "https://www.googleapis.com/upload/drive/v2/files"
+
+# Chunk sizes have to be multiples of 256 KB, except for the last chunk.
+CHUNK_ALIGNMENT = 256 * 1024
+DEFAULT_CHUNK_SIZE = 32 * 1024 * 1024
+DEFAULT_STATE_DIR = "./upload_sessions"
+
+class UploadSession:
+    """
+    On-disk record of one resumable upload session, so that an interrupted upload can carry on
+    from the last byte the server acknowledged, even from a different process. The session is tied
+    to the source file and to TARGET, a string naming where it goes (see session_target), and to
+    the size and mtime of the source file. It is thrown away if any of them changes.
+    """
+
+    def __init__(self, state_dir, source_path, target):
+        self.source_path = Path(source_path).absolute()
+        self.target = target
+        stat = self.source_path.stat()
+        self.size, self.mtime_ns = stat.st_size, stat.st_mtime_ns
+
+        name = hashlib.md5(("%s\n%s" % (self.source_path, target)).encode("utf-8")).hexdigest()
+        self.state_path = Path(state_dir) / (name + ".json")
+        self.session_uri, self.offset = None, 0
+
+        if self.state_path.exists():
+            with open(str(self.state_path)) as f:
+                state = json.load(f)
+            if (state.get("target"), state["size"], state["mtime_ns"]) == (target, self.size, self.mtime_ns):
+                self.session_uri, self.offset = state["session_uri"], state["offset"]
+
+    def save(self):
+        self.state_path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = self.state_path.with_suffix(".tmp")
+        with open(str(temp_path), "w") as f:
+            json.dump({
+                "source_path": str(self.source_path),
+                "target": self.target,
+                "size": self.size,
+                "mtime_ns": self.mtime_ns,
+                "session_uri": self.session_uri,
+                "offset": self.offset,
+            }, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(str(temp_path), str(self.state_path))
+
+    def discard(self):
+        self.session_uri, self.offset = None, 0
+        if self.state_path.exists():
+            self.state_path.unlink()
+
+def session_target(title, drive_parent_dir, file_id=None):
+    """
+    Names where an upload goes: new content for FILE_ID, or a new file TITLE under
+    DRIVE_PARENT_DIR.
+    """
+    if file_id is not None:
+        return "file %s" % file_id
+    return "%s/%s" % (drive_parent_dir["id"], title)
+
+def raise_for_status(response, content, uri):
+    raise ApiRequestError(HttpError(response, content, uri=uri))
+
+def parse_range(response):
+    # A 308 carries "Range: bytes=0-N" once at least one byte has been stored.
+    match = re.match(r"bytes=0-(\d+)", response.get("range", ""))
+    return int(match.group(1)) + 1 if match else 0
+
+def start_session(http, metadata, size, mime_type, file_id=None, upload_url=UPLOAD_URL):
+    if file_id is None:
+        method, uri = "POST", upload_url + "?uploadType=resumable"
+    else:
+        method, uri = "PUT", "%s/%s?uploadType=resumable" % (upload_url, file_id)
+
+    with METRICS.timed("resumable.start"):
+        response, content = http.request(uri, method, body=json.dumps(metadata), headers={
+            "Content-Type": "application/json; charset=UTF-8",
+            "X-Upload-Content-Type": mime_type,
+            "X-Upload-Content-Length": str(size),
+        })
+    if response.status != 200 or "location" not in response:
+        raise_for_status(response, content, uri)
+    return response["location"]
+
+def query_offset(http, session):
+    """
+    Asks the server how much of SESSION it has. Returns the confirmed offset, the uploaded file's
+    metadata if the upload already completed, or None for the offset if the session expired.
+    """
+    with METRICS.timed("resumable.query"):
+        response, content = http.request(session.session_uri, "PUT", body=b"", headers={
+            "Content-Length": "0",
+            "Content-Range": "bytes */%i" % session.size,
+        })
+    if response.status in (200, 201):
+        return session.size, json.loads(content)
+    elif response.status == 308:
+        return parse_range(response), None
+    elif response.status in (404, 410):
+        return None, None
+    raise_for_status(response, content, session.session_uri)
+
+def upload_file_resumable(drive, source_path, upload_path, drive_parent_dir, file_id=None,
+                          chunk_size=DEFAULT_CHUNK_SIZE, state_dir=DEFAULT_STATE_DIR,
+                          upload_url=UPLOAD_URL, on_chunk=None, throttle=None):
+    """
+    Uploads SOURCE_PATH as UPLOAD_PATH's name under DRIVE_PARENT_DIR (or as new content for
+    FILE_ID, if given) through a resumable session, CHUNK_SIZE bytes at a time. Chunks are sliced
+    out of a memory map of the file, so only one chunk is ever held in memory. ON_CHUNK, if given,
+    is called with the size of each acknowledged chunk. With a THROTTLE, chunks shrink to what
+    the bandwidth limit lets through in about a second, and each waits its turn.
+    """
+    source_path, upload_path = Path(source_path), Path(upload_path)
+    chunk_size = max(CHUNK_ALIGNMENT, chunk_size - chunk_size % CHUNK_ALIGNMENT)
+    mime_type = mimetypes.guess_type(str(source_path))[0] or "application/octet-stream"
+
+    session = UploadSession(state_dir, source_path, session_target(upload_path.name, drive_parent_dir, file_id))
+    if session.size == 0:
+        raise ValueError("Resumable uploads need a non-empty file: %s" % str(source_path))
+
+    http = drive.auth.Get_Http_Object()
+    metadata = None
+    if session.session_uri is not None:
+        session.offset, metadata = query_offset(http, session)
+        if session.offset is None:
+            session.discard()
+
+    if session.session_uri is None:
+        body = {"title": upload_path.name, "mimeType": mime_type}
+        if file_id is None:
+            body["parents"] = [{"kind": "drive#fileLink", "id": drive_parent_dir["id"]}]
+        session.session_uri = start_session(
+            http, body, session.size, mime_type, file_id=file_id, upload_url=upload_url)
+        session.save()
+
+    with open(str(source_path), "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as contents:
+        while metadata is None:
+            if throttle is None:
+                end = min(session.offset + chunk_size, session.size)
+            else:
+                end = min(session.offset + throttle.chunk_size(chunk_size, CHUNK_ALIGNMENT), session.size)
+                throttle.consume(end - session.offset)
+            with METRICS.timed("resumable.chunk"):
+                response, content = http.request(
+                    session.session_uri, "PUT", body=contents[session.offset : end], headers={
+                        "Content-Length": str(end - session.offset),
+                        "Content-Range": "bytes %i-%i/%i" % (session.offset, end - 1, session.size),
+                    })
+
+            if response.status in (200, 201):
+                metadata = json.loads(content)
+                confirmed = session.size
+            elif response.status == 308:
+                confirmed = parse_range(response)
+            else:
+                raise_for_status(response, content, session.session_uri)
+
+            if on_chunk is not None:
+                on_chunk(confirmed - session.offset)
+            session.offset = confirmed
+            session.save()
+
+    session.discard()
+
+    return GoogleDriveFile(auth=drive.auth, metadata=metadata, uploaded=True)
@@ -0,0 +1,191 @@
+from apiclient.errors import HttpError
+from pydrive.files import ApiRequestError
+
+import json, random, socket, threading, time
+
+import httplib2
+
+from metrics import METRICS
+
+RATE_LIMIT, SERVER, CONNECTION, FATAL = "rate_limit", "server", "connection", "fatal"
+RETRYABLE = (RATE_LIMIT, SERVER, CONNECTION)
+
+RATE_LIMIT_REASONS = {"rateLimitExceeded", "userRateLimitExceeded", "sharingRateLimitExceeded"}
+
+def get_http_error(error):
+    if isinstance(error, HttpError):
+        return error
+    if isinstance(error, ApiRequestError) and error.args and isinstance(error.args[0], HttpError):
+        return error.args[0]
+    return None
+
+def get_error_reasons(http_error):
+    try:
+        content = http_error.content.decode("utf-8") if isinstance(http_error.content, bytes) \
+            else http_error.content
+        errors = json.loads(content)["error"].get("errors", [])
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return set()
+    return {error.get("reason") for error in errors}
+
+def classify_error(error):
+    """
+    Sorts ERROR into one of RATE_LIMIT (403 rate limit reasons, 429), SERVER (5xx), CONNECTION
+    (resets, timeouts, DNS failures) or FATAL (anything else, which is not worth retrying).
+    """
+    http_error = get_http_error(error)
+    if http_error is not None and http_error.resp is not None:
+        status = http_error.resp.status
+        if status == 429 or (status == 403 and get_error_reasons(http_error) & RATE_LIMIT_REASONS):
+            return RATE_LIMIT
+        elif 500 <= status < 600:
+            return SERVER
+        return FATAL
+    elif isinstance(error, (ConnectionError, socket.timeout, socket.gaierror, httplib2.ServerNotFoundError)):
+        return CONNECTION
+    return FATAL
+
+def get_retry_after(error):
+    """
+    Returns the number of seconds the server asked us to wait, if it did.
+    """
+    http_error = get_http_error(error)
+    if http_error is None or http_error.resp is None:
+        return None
+    try:
+        return float(http_error.resp.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+class RetryMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.retries = {}
+        self.throttle_events = 0
+        self.gave_up = 0
+
+    def record_retry(self, error_class):
+        with self.lock:
+            self.retries[error_class] = self.retries.get(error_class, 0) + 1
+        METRICS.inc("retries_total", error_class=error_class)
+
+    def record_throttle(self):
+        with self.lock:
+            self.throttle_events += 1
+        METRICS.inc("rate_limited_total")
+
+    def record_give_up(self):
+        with self.lock:
+            self.gave_up += 1
+        METRICS.inc("gave_up_total")
+
+    def stats(self):
+        with self.lock:
+            return {
+                "retries": dict(self.retries),
+                "throttle_events": self.throttle_events,
+                "gave_up": self.gave_up,
+            }
+
+class RateLimiter:
+    """
+    Paces requests across every worker sharing this limiter, adapting the rate AIMD-style: each
+    success adds INCREASE / rate requests per second (so roughly INCREASE per second of clean
+    traffic), and each throttling response multiplies the rate by DECREASE.
+    """
+
+    def __init__(self, rate=10.0, min_rate=0.5, max_rate=100.0, increase=1.0, decrease=0.5):
+        self.rate = rate
+        self.min_rate, self.max_rate = min_rate, max_rate
+        self.increase, self.decrease = increase, decrease
+
+        self.lock = threading.Lock()
+        self.next_slot = time.time()
+        self.started = time.time()
+        self.num_requests = 0
+
+    def acquire(self):
+        with self.lock:
+            now = time.time()
+            slot = max(self.next_slot, now)
+            self.next_slot = slot + 1 / self.rate
+            self.num_requests += 1
+        if slot > now:
+            time.sleep(slot - now)
+
+    def on_success(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.increase / self.rate)
+
+    def on_throttle(self, retry_after=None):
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            if retry_after is not None:
+                # Hold everyone back, not just the worker that got throttled.
+                self.next_slot = max(self.next_slot, time.time() + retry_after)
+
+    def effective_rate(self):
+        with self.lock:
+            return self.num_requests / max(time.time() - self.started, 1e-6)
+
+class RetryPolicy:
+    """
+    Exponential backoff with full jitter, capped at MAX_DELAY seconds, which defers to the
+    server's Retry-After when given. Keeps the shared RATE_LIMITER and METRICS informed.
+    """
+
+    def __init__(self, max_attempts=5, base_delay=1.0, max_delay=64.0, rate_limiter=None, metrics=None):
+        self.max_attempts = max_attempts
+        self.base_delay, self.max_delay = base_delay, max_delay
+        self.rate_limiter = RateLimiter() if rate_limiter is None else rate_limiter
+        self.metrics = RetryMetrics() if metrics is None else metrics
+
+    def get_delay(self, attempt, error):
+        retry_after = get_retry_after(error)
+        if retry_after is not None:
+            return retry_after
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def on_failure(self, attempt, error):
+        """
+        Records a failed ATTEMPT (counting from 0). Returns how many seconds to wait before trying
+        again, or None if the error isn't retryable or attempts have run out.
+        """
+        error_class = classify_error(error)
+        if error_class == RATE_LIMIT:
+            self.metrics.record_throttle()
+            self.rate_limiter.on_throttle(get_retry_after(error))
+
+        if error_class not in RETRYABLE or attempt + 1 >= self.max_attempts:
+            self.metrics.record_give_up()
+            return None
+
+        self.metrics.record_retry(error_class)
+        return self.get_delay(attempt, error)
+
+    def call(self, function, *args, **kwargs):
+        """
+        Calls FUNCTION until it succeeds, waiting between attempts, and re-raises the last error
+        once it isn't worth trying again.
+        """
+        attempt = 0
+        while True:
+            self.rate_limiter.acquire()
+            try:
+                result = function(*args, **kwargs)
+            except Exception as e:
+                delay = self.on_failure(attempt, e)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                attempt += 1
+            else:
+                self.rate_limiter.on_success()
+                return result
+
+    def summary(self):
+        stats = self.metrics.stats()
+        retries = ", ".join("%s: %i" % item for item in sorted(stats["retries"].items())) or "none"
+        return "Retries: %s; throttle events: %i; gave up: %i; request rate: %.2f/s (now pacing at %.2f/s)" % (
+            retries, stats["throttle_events"], stats["gave_up"],
+            self.rate_limiter.effective_rate(), self.rate_limiter.rate)
@@ -0,0 +1,231 @@
+from argparse import ArgumentParser
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import os, shutil, tempfile, threading, time
+
+DEFAULT_SCAN_WORKERS = 8
+
+# Listings read ahead of the diff are held in memory until it gets to them, so cap how many.
+DEFAULT_MAX_PREFETCHED = 4096
+
+# An entry of the local tree: its path relative to the root of the scan, with forward slashes,
+# and its size in bytes and mtime in nanoseconds (both None for directories, which aren't statted).
+ScanEntry = namedtuple("ScanEntry", ["path", "size", "mtime_ns", "is_dir"])
+
+def join_relative(rel_dir, name):
+    return name if rel_dir == "" else rel_dir + "/" + name
+
+class ParallelScanner:
+    """
+    Reads the directories under LOCAL_ROOT with os.scandir on a pool of WORKERS threads. Every
+    directory read also queues reads of its subdirectories, so by the time a walk (or a diff)
+    gets to a directory its listing is usually in memory already, and on network mounts or
+    spinning disks many directory reads are waited on at once. At most MAX_PREFETCHED listings
+    are held ahead of the reader; past that, directories are read when asked for.
+
+    Entry types come from the directory entries themselves, so only files get statted.
+
+    Also stands in for a local_index.LocalScan in the diff (see syncer.iter_missing_remote_files),
+    with every directory needing a visit.
+    """
+
+    def __init__(self, local_root, workers=DEFAULT_SCAN_WORKERS, max_prefetched=DEFAULT_MAX_PREFETCHED):
+        self.local_root = Path(local_root).absolute()
+        self.max_prefetched = max_prefetched
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="scan")
+        self.lock = threading.Lock()
+        self.futures = {}
+        self.closed = False
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            for future in self.futures.values():
+                future.cancel()
+            self.futures = {}
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def read_dir(self, rel_dir):
+        entries = []
+        with os.scandir(str(self.local_root / rel_dir)) as dir_entries:
+            for dir_entry in dir_entries:
+                rel_path = join_relative(rel_dir, dir_entry.name)
+                try:
+                    if dir_entry.is_dir():
+                        entries.append(ScanEntry(rel_path, None, None, True))
+                    else:
+                        stat = dir_entry.stat()
+                        entries.append(ScanEntry(rel_path, stat.st_size, stat.st_mtime_ns, False))
+                except FileNotFoundError:
+                    # Deleted since the directory was read, or a dangling symlink.
+                    continue
+        self.prefetch(entry.path for entry in entries if entry.is_dir)
+        return entries
+
+    def prefetch(self, rel_dirs):
+        with self.lock:
+            if self.closed:
+                return
+            for rel_dir in rel_dirs:
+                if len(self.futures) >= self.max_prefetched:
+                    return
+                if rel_dir not in self.futures:
+                    self.futures[rel_dir] = self.executor.submit(self.read_dir, rel_dir)
+
+    def list(self, rel_dir=""):
+        """
+        Returns the ScanEntries of the directory REL_DIR (relative to the root). Each listing is
+        handed out once.
+        """
+        with self.lock:
+            future = self.futures.pop(rel_dir, None)
+        # A read that hasn't started yet is quicker done here than waited for behind the others.
+        if future is None or future.cancel():
+            return self.read_dir(rel_dir)
+        return future.result()
+
+    def walk(self, rel_dir=""):
+        """
+        Yields a ScanEntry for everything underneath REL_DIR, depth first.
+        """
+        stack = [rel_dir]
+        while stack:
+            entries = self.list(stack.pop())
+            for entry in entries:
+                yield entry
+            stack.extend(entry.path for entry in reversed(entries) if entry.is_dir)
+
+    def relative(self, local_path):
+        rel_path = Path(local_path).absolute().relative_to(self.local_root).as_posix()
+        return "" if rel_path == "." else rel_path
+
+    def needs_visit(self, local_path):
+        return True
+
+    def list_dir(self, local_path):
+        """
+        Returns the (name, is_dir, size) entries of LOCAL_PATH.
+        """
+        return [
+            (entry.path.rpartition("/")[2], entry.is_dir, entry.size)
+            for entry in self.list(self.relative(local_path))
+        ]
+
+    def files_under(self, local_path):
+        """
+        Yields (path, size) for every file underneath LOCAL_PATH.
+        """
+        rel_dir = self.relative(local_path)
+        for entry in self.walk(rel_dir):
+            if not entry.is_dir:
+                # Under LOCAL_PATH as given, which may be relative where the root isn't.
+                yield Path(local_path) / entry.path[len(rel_dir) + 1 if rel_dir else 0 : ], entry.size
+
+def scan(local_root, workers=DEFAULT_SCAN_WORKERS):
+    """
+    Yields a ScanEntry for everything underneath LOCAL_ROOT.
+    """
+    with ParallelScanner(local_root, workers) as scanner:
+        yield from scanner.walk()
+
+def make_synthetic_tree(root, num_entries, fan_out=10, files_per_dir=100):
+    """
+    Creates about NUM_ENTRIES empty files and directories under ROOT, FILES_PER_DIR files and
+    FAN_OUT subdirectories to a directory, breadth first. Returns the number created.
+    """
+    root = Path(root)
+    root.mkdir(parents=True, exist_ok=True)
+    created, queue = 0, [root]
+    while queue and created < num_entries:
+        next_queue = []
+        for directory in queue:
+            for i in range(files_per_dir):
+                if created >= num_entries:
+                    return created
+                open(str(directory / ("file%04i" % i)), "wb").close()
+                created += 1
+            for i in range(fan_out):
+                if created >= num_entries:
+                    return created
+                subdirectory = directory / ("dir%03i" % i)
+                subdirectory.mkdir()
+                next_queue.append(subdirectory)
+                created += 1
+        queue = next_queue
+    return created
+
+def scan_serially(local_root):
+    """
+    The diff's old way of reading the tree, for comparison: iterdir, then a stat per entry to
+    tell directories from files, then another for the size.
+    """
+    stack, count = [Path(local_root)], 0
+    while stack:
+        for child in stack.pop().iterdir():
+            count += 1
+            if child.is_dir():
+                stack.append(child)
+            else:
+                child.stat()
+    return count
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Benchmark scanning a large local tree serially and in parallel")
+    parser.add_argument("--root", help="Scan this tree, creating a synthetic one there first if it doesn't exist "
+                                       "(default a temporary directory)")
+    parser.add_argument("--entries", type=int, default=1000000, help="Size of the synthetic tree")
+    parser.add_argument("--fan-out", type=int, default=10)
+    parser.add_argument("--files-per-dir", type=int, default=100)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4, 8, 16, 32])
+    parser.add_argument("--dir-latency", type=float, default=0.0,
+                        help="Seconds added to every directory read, as on a network mount")
+    args = parser.parse_args()
+
+    temp_dir = None
+    root = args.root
+    if root is None:
+        temp_dir = tempfile.mkdtemp(prefix="scan_bench")
+        root = Path(temp_dir) / "tree"
+    root = Path(root)
+    try:
+        if not root.exists():
+            started = time.time()
+            created = make_synthetic_tree(root, args.entries, args.fan_out, args.files_per_dir)
+            print("Created %i entries in %.1fs" % (created, time.time() - started))
+
+        if args.dir_latency > 0:
+            original_scandir, original_iterdir = os.scandir, Path.iterdir
+
+            def slow_scandir(path):
+                time.sleep(args.dir_latency)
+                return original_scandir(path)
+
+            def slow_iterdir(path):
+                time.sleep(args.dir_latency)
+                return original_iterdir(path)
+
+            os.scandir, Path.iterdir = slow_scandir, slow_iterdir
+
+        started = time.time()
+        count = scan_serially(root)
+        serial_seconds = time.time() - started
+        print("%-20s %10i entries %8.2fs %10.0f entries/s" % ("serial iterdir", count, serial_seconds,
+                                                            count / serial_seconds))
+
+        for workers in args.workers:
+            started = time.time()
+            count = sum(1 for _ in scan(root, workers))
+            seconds = time.time() - started
+            print("%-20s %10i entries %8.2fs %10.0f entries/s  %.1fx" % (
+                "scandir, %i workers" % workers, count, seconds, count / seconds, serial_seconds / seconds))
+    finally:
+        if temp_dir is not None:
+            shutil.rmtree(temp_dir)
@@ -0,0 +1,208 @@
+from argparse import ArgumentParser
+from collections import deque
+from pathlib import Path
+
+import heapq, itertools, random, tempfile, time
+
+DEFAULT_LARGE_THRESHOLD = 64 * 1024 * 1024
+
+# Rough per-connection figures for estimates when nothing better is known: a fixed cost per file
+# (metadata round trips, connection setup) plus the transfer itself.
+DEFAULT_FILE_OVERHEAD = 0.5
+DEFAULT_BYTES_PER_SECOND = 8 * 1024 * 1024
+
+class FifoPolicy:
+    """
+    Hands out tasks in the order they were queued.
+    """
+
+    name = "fifo"
+
+    def __init__(self):
+        self.queue = deque()
+
+    def __len__(self):
+        return len(self.queue)
+
+    def push(self, task, size):
+        self.queue.append(task)
+
+    def pop(self, running_sizes):
+        return self.queue.popleft()
+
+class SizeOrderPolicy:
+    """
+    Hands out the smallest queued task first, or the largest if LARGEST_FIRST. Largest first is
+    the classic longest-processing-time heuristic, which keeps a big file from starting last.
+    """
+
+    def __init__(self, largest_first=False):
+        self.name = "largest" if largest_first else "smallest"
+        self.sign = -1 if largest_first else 1
+        self.heap, self.sequence = [], itertools.count()
+
+    def __len__(self):
+        return len(self.heap)
+
+    def push(self, task, size):
+        heapq.heappush(self.heap, (self.sign * size, next(self.sequence), task))
+
+    def pop(self, running_sizes):
+        return heapq.heappop(self.heap)[2]
+
+class LargeFileLanesPolicy:
+    """
+    Keeps LARGE_LANES workers for tasks of at least LARGE_THRESHOLD bytes, largest first, so long
+    transfers start early and run alongside the small files draining through the other workers,
+    instead of all landing at the end of the run. Large tasks only take more workers than that once
+    no small task is queued, so no worker is left idle while anything is queued.
+    """
+
+    name = "lanes"
+
+    def __init__(self, large_threshold=DEFAULT_LARGE_THRESHOLD, large_lanes=1):
+        self.large_threshold = large_threshold
+        self.large_lanes = large_lanes
+        self.small, self.large = deque(), SizeOrderPolicy(largest_first=True)
+
+    def __len__(self):
+        return len(self.small) + len(self.large)
+
+    def push(self, task, size):
+        if size >= self.large_threshold:
+            self.large.push((task, size), size)
+        else:
+            self.small.append((task, size))
+
+    def pop(self, running_sizes):
+        large_running = sum(1 for size in running_sizes if size >= self.large_threshold)
+        if len(self.large) and (large_running < self.large_lanes or not self.small):
+            task, _ = self.large.pop(running_sizes)
+        else:
+            task, _ = self.small.popleft()
+        return task
+
+POLICIES = ["lanes", "fifo", "smallest", "largest"]
+
+def make_policy(name, large_threshold=DEFAULT_LARGE_THRESHOLD, large_lanes=1):
+    if name == "lanes":
+        return LargeFileLanesPolicy(large_threshold, large_lanes)
+    elif name == "fifo":
+        return FifoPolicy()
+    elif name in ("smallest", "largest"):
+        return SizeOrderPolicy(largest_first=name == "largest")
+    raise ValueError("Unknown scheduling policy %s" % name)
+
+def transfer_time(size, file_overhead=DEFAULT_FILE_OVERHEAD, bytes_per_second=DEFAULT_BYTES_PER_SECOND):
+    return file_overhead + size / bytes_per_second
+
+def estimate_makespan(sizes, policy, num_workers, file_overhead=DEFAULT_FILE_OVERHEAD,
+                      bytes_per_second=DEFAULT_BYTES_PER_SECOND):
+    """
+    Simulates NUM_WORKERS workers taking files of the given SIZES from POLICY (which must be empty,
+    and is drained), each file costing FILE_OVERHEAD seconds plus its size over BYTES_PER_SECOND.
+    Returns the estimated number of seconds until the last file is done.
+    """
+    for size in sizes:
+        policy.push(size, size)
+
+    now, running = 0.0, []
+    while len(policy) or running:
+        while len(running) < num_workers and len(policy):
+            size = policy.pop([size for _, size in running])
+            heapq.heappush(running, (now + transfer_time(size, file_overhead, bytes_per_second), size))
+        now, _ = heapq.heappop(running)
+    return now
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return "%i:%02i:%02i" % (hours, minutes, seconds)
+
+class SimulatedDriveFile(dict):
+    def __init__(self, drive, metadata):
+        super().__init__(metadata)
+        self.drive = drive
+        self.size = 0
+
+    def SetContentFile(self, filename):
+        self.size = Path(filename).stat().st_size
+
+    def Upload(self):
+        if self.get("mimeType") != "application/vnd.google-apps.folder":
+            time.sleep(transfer_time(self.size, self.drive.file_overhead, self.drive.bytes_per_second))
+        self["id"] = "simulated%i" % next(self.drive.ids)
+
+class SimulatedFileList:
+    def GetList(self):
+        return []
+
+    def __iter__(self):
+        yield self.GetList()
+
+class SimulatedDrive:
+    """
+    Just enough of GoogleDrive for UploadScheduler to upload to with batching and resumable
+    sessions off: nothing exists remotely, and each upload takes FILE_OVERHEAD seconds plus its size
+    over BYTES_PER_SECOND.
+    """
+
+    auth = None
+
+    def __init__(self, file_overhead, bytes_per_second):
+        self.file_overhead, self.bytes_per_second = file_overhead, bytes_per_second
+        self.ids = itertools.count()
+
+    def CreateFile(self, metadata):
+        return SimulatedDriveFile(self, metadata)
+
+    def ListFile(self, param):
+        return SimulatedFileList()
+
+def make_workload(num_small, num_large, large_size, seed=0):
+    rng = random.Random(seed)
+    sizes = [int(rng.lognormvariate(13, 1.5)) for _ in range(num_small)]
+    sizes += [int(large_size * rng.uniform(0.5, 1.5)) for _ in range(num_large)]
+    rng.shuffle(sizes)
+    return sizes
+
+if __name__ == "__main__":
+    from retry import RateLimiter, RetryPolicy
+    from syncer import UploadItem
+    from uploader import UploadScheduler
+
+    parser = ArgumentParser(description="Compare upload scheduling policies against a simulated Drive")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--small-files", type=int, default=400)
+    parser.add_argument("--large-files", type=int, default=3)
+    parser.add_argument("--large-size", type=int, default=512, help="Typical large file size in MB")
+    parser.add_argument("--file-overhead", type=float, default=0.02, help="Simulated seconds per file")
+    parser.add_argument("--bandwidth", type=float, default=256, help="Simulated MB/s per connection")
+    args = parser.parse_args()
+
+    bytes_per_second = args.bandwidth * 1024 * 1024
+    sizes = make_workload(args.small_files, args.large_files, args.large_size * 1024 * 1024)
+    large_threshold = args.large_size * 1024 * 1024 // 4
+
+    with tempfile.TemporaryDirectory() as local_root:
+        items = []
+        for i, size in enumerate(sizes):
+            # Sparse files, so their sizes cost nothing on disk.
+            path = Path(local_root) / ("file%05i" % i)
+            with open(str(path), "wb") as f:
+                f.truncate(size)
+            items.append(UploadItem("root", path.name, size))
+
+        print("%i files, %.1f MB, %i workers" % (len(sizes), sum(sizes) / 1024 / 1024, args.workers))
+        for name in POLICIES:
+            estimate = estimate_makespan(
+                sizes, make_policy(name, large_threshold), args.workers, args.file_overhead, bytes_per_second)
+
+            drive = SimulatedDrive(args.file_overhead, bytes_per_second)
+            scheduler = UploadScheduler(
+                lambda: drive, num_workers=args.workers, batch_folders=False,
+                retry_policy=RetryPolicy(rate_limiter=RateLimiter(rate=1e6, max_rate=1e6)),
+                policy=make_policy(name, large_threshold), verbose=False)
+            started = time.time()
+            scheduler.run(local_root, "/benchmark", items)
+            print("%-9s estimated %7.2fs, measured %7.2fs" % (name, estimate, time.time() - started))
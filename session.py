@@ -0,0 +1,216 @@
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from apiclient.discovery import build
+from pydrive.auth import GoogleAuth
+from pydrive.drive import GoogleDrive
+
+import httplib2, os, threading
+
+# Refresh the access token this many seconds before it expires, so no request ever finds it expired.
+REFRESH_MARGIN = 300
+
+# The refresher wakes up at least this often, to save a token oauth2client refreshed on a 401.
+CHECK_INTERVAL = 60
+
+# And tries again this long after a refresh fails.
+RETRY_INTERVAL = 10
+
+def keep_308(http):
+    """
+    Makes HTTP leave 308 responses alone: Drive answers every unfinished chunk of a resumable upload
+    with one, which httplib2 would otherwise take for a redirect. Returns HTTP.
+    """
+    http.redirect_codes = http.redirect_codes - {308}
+    return http
+
+class SessionAuth(GoogleAuth):
+    """
+    GoogleAuth of a DriveSession. PyDrive asks for a new HTTP object (so a new connection and TLS
+    handshake) on every call; this hands out the calling thread's keep-alive one instead, and
+    checks the token against the session's refresh margin rather than its expiry.
+    """
+
+    def __init__(self, session):
+        super().__init__()
+        self.session = session
+
+    def Get_Http_Object(self):
+        return self.session.http()
+
+    def Authorize(self):
+        self.service = build("drive", "v2", http=self.session.http())
+
+    @property
+    def access_token_expired(self):
+        if self.credentials is None:
+            return True
+        self.session.refresh_if_due()
+        return self.credentials.access_token_expired
+
+class DriveSession:
+    """
+    An authenticated Drive session shared by all worker threads: one set of credentials, loaded
+    once from CREDENTIALS_FILE (going through the browser flow if there are none) or given as
+    CREDENTIALS, and one keep-alive HTTP object per thread made by HTTP_FACTORY, all sending the
+    same token.
+
+    The token is refreshed REFRESH_MARGIN seconds before it expires, by a background thread once
+    started, or else by the first request to notice. Either way it's done under a lock that only
+    requests with an already expired token wait on; the rest carry on with the old token, which is
+    still good. The credentials file is rewritten, atomically, only when the credentials change.
+    """
+
+    def __init__(self, credentials_file=None, credentials=None, http_factory=httplib2.Http,
+                 refresh_margin=REFRESH_MARGIN):
+        self.credentials_file = credentials_file
+        self.http_factory = http_factory
+        self.refresh_margin = timedelta(seconds=refresh_margin)
+        self.local = threading.local()
+        self.refresh_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.refresher = None
+        self.saved = None
+
+        self.auth = SessionAuth(self)
+        if credentials is None:
+            path = Path(credentials_file)
+            if path.exists():
+                self.saved = path.read_text()
+            self.auth.LoadCredentialsFile(credentials_file)
+            if self.auth.credentials is None: # Failed to load from cached credentials
+                self.auth.LocalWebserverAuth() # Creates local webserver and auto handles authentication
+            credentials = self.auth.credentials
+        self.auth.credentials = credentials
+        # Refreshes are saved by save() below, not rewritten in place by oauth2client's storage.
+        credentials.set_store(None)
+
+        self.refresh_if_due()
+        self.save()
+        self.auth.Authorize()
+        self.drive = GoogleDrive(self.auth)
+
+    @property
+    def credentials(self):
+        return self.auth.credentials
+
+    def http(self):
+        """
+        Returns the calling thread's authorized HTTP object, which keeps its connections open.
+        """
+        http = getattr(self.local, "http", None)
+        if http is None:
+            http = self.local.http = self.credentials.authorize(
+                keep_308(self.http_factory(timeout=self.auth.http_timeout)))
+        return http
+
+    def reconnect(self):
+        """
+        Drops the calling thread's connections, after one was reset, so its next call opens new ones.
+        Nothing else is redone: the credentials and the service are still good.
+        """
+        self.local.http = None
+
+    def refresh_due_at(self):
+        expiry = self.credentials.token_expiry
+        return None if expiry is None else expiry - self.refresh_margin
+
+    def refresh_if_due(self):
+        """
+        Refreshes the access token if it's within the refresh margin of expiring. Only waits for a
+        refresh already in progress if the token has actually expired.
+        """
+        due_at = self.refresh_due_at()
+        if due_at is None or datetime.utcnow() < due_at:
+            return
+        if not self.refresh_lock.acquire(blocking=self.credentials.access_token_expired):
+            return
+        refreshed = False
+        try:
+            # Someone else may have refreshed it while this waited.
+            due_at = self.refresh_due_at()
+            if due_at is not None and datetime.utcnow() >= due_at:
+                self.credentials.refresh(keep_308(self.http_factory(timeout=self.auth.http_timeout)))
+                refreshed = True
+        finally:
+            self.refresh_lock.release()
+        if refreshed:
+            self.save()
+
+    def save(self):
+        """
+        Writes the credentials to the credentials file if they changed since it was read or last
+        written, atomically, so a crash never leaves it half written. Returns whether it wrote.
+        """
+        if self.credentials_file is None:
+            return False
+        with self.refresh_lock:
+            data = self.credentials.to_json()
+            if data == self.saved:
+                return False
+            path = Path(self.credentials_file)
+            temp_path = path.with_name(path.name + ".tmp")
+            path.parent.mkdir(parents=True, exist_ok=True)
+            fd = os.open(str(temp_path), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(str(temp_path), str(path))
+            self.saved = data
+            return True
+
+    def start(self):
+        """
+        Starts refreshing the token in the background, ahead of any request needing it.
+        """
+        if self.refresher is None:
+            self.refresher = threading.Thread(target=self.keep_fresh, name="token-refresher", daemon=True)
+            self.refresher.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.refresher is not None:
+            self.refresher.join()
+            self.refresher = None
+        self.save()
+
+    def keep_fresh(self):
+        while True:
+            wait = CHECK_INTERVAL
+            due_at = self.refresh_due_at()
+            if due_at is not None:
+                wait = max(0, min(wait, (due_at - datetime.utcnow()).total_seconds()))
+            if self.stopped.wait(wait):
+                return
+            try:
+                self.refresh_if_due()
+                self.save()
+            except Exception as e:
+                # Requests will still refresh it themselves, if it comes to that.
+                print("Failed to refresh access token: %s" % e)
+                if self.stopped.wait(RETRY_INTERVAL):
+                    return
+
+SESSIONS = {}
+SESSIONS_LOCK = threading.Lock()
+
+def get_session(credentials_file):
+    """
+    Returns the process's DriveSession for CREDENTIALS_FILE, authenticating and starting its
+    refresher the first time.
+    """
+    key = str(Path(credentials_file).absolute())
+    with SESSIONS_LOCK:
+        if key not in SESSIONS:
+            SESSIONS[key] = DriveSession(credentials_file).start()
+        return SESSIONS[key]
+
+def reset_connections(drive):
+    """
+    Drops the calling thread's connections to Drive after one was reset. PyDrive's own auth opens
+    new ones for every call anyway, so there's only something to do for a session's.
+    """
+    if isinstance(drive.auth, SessionAuth):
+        drive.auth.session.reconnect()
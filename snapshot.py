@@ -0,0 +1,152 @@
+import gzip, json, time
+from pathlib import Path
+
+from metrics import METRICS
+from query import ITEM_FIELDS
+
+FOLDER_MIME_TYPE = "application/vnd.google-apps.folder"
+
+# Only the fields the diff needs; everything else in a files resource is dead weight on the wire.
+SNAPSHOT_ITEM_FIELDS = ITEM_FIELDS
+SNAPSHOT_FIELDS = "nextPageToken,items(%s)" % SNAPSHOT_ITEM_FIELDS
+
+def compact(drive_file):
+    metadata = {key: drive_file[key] for key in ("id", "title", "mimeType") if key in drive_file}
+    for key in ("fileSize", "md5Checksum", "modifiedDate"):
+        if drive_file.get(key) is not None:
+            metadata[key] = drive_file[key]
+    metadata["parents"] = [
+        parent["id"] if isinstance(parent, dict) else parent for parent in drive_file.get("parents", [])
+    ]
+    return metadata
+
+class RemoteSnapshot:
+    """
+    In-memory copy of every non-trashed file the account can see, indexed by id and by parent id,
+    so that the remote side of a diff can be walked without going back to the network.
+    """
+
+    def __init__(self, root_id, files=(), taken=None, page_token=None):
+        self.root_id = root_id
+        self.taken = time.time() if taken is None else taken
+
+        # Changes feed token from which this snapshot can be brought up to date (see changes.py).
+        self.page_token = page_token
+        self.files, self.children = {}, {}
+        for metadata in files:
+            self.add(metadata)
+
+    def add(self, drive_file):
+        metadata = compact(drive_file)
+        if metadata["id"] in self.files:
+            self.remove(metadata["id"])
+
+        self.files[metadata["id"]] = metadata
+        for parent_id in metadata["parents"]:
+            self.children.setdefault(parent_id, {})[metadata["id"]] = metadata
+        return metadata
+
+    def remove(self, file_id):
+        metadata = self.files.pop(file_id, None)
+        if metadata is not None:
+            for parent_id in metadata["parents"]:
+                self.children.get(parent_id, {}).pop(file_id, None)
+
+    def get_children(self, drive_file):
+        if drive_file["mimeType"] != FOLDER_MIME_TYPE:
+            raise ValueError("Trying to obtain children of non-folder file")
+
+        return list(self.children.get(drive_file["id"], {}).values())
+
+    def walk(self, drive_dir, path):
+        """
+        Yields (path, metadata) for every file and folder underneath DRIVE_DIR, whose own path is
+        PATH.
+        """
+        stack = [(Path(path), drive_dir)]
+        while stack:
+            dir_path, drive_dir = stack.pop()
+            for child in self.children.get(drive_dir["id"], {}).values():
+                child_path = dir_path / child["title"]
+                yield child_path, child
+                if child["mimeType"] == FOLDER_MIME_TYPE:
+                    stack.append((child_path, child))
+
+    def get_path(self, file_id):
+        """
+        Returns the path of FILE_ID relative to the drive root, following first parents, or None if
+        the file doesn't hang off the root.
+        """
+        names = []
+        while file_id != self.root_id:
+            metadata = self.files.get(file_id)
+            if metadata is None or not metadata["parents"]:
+                return None
+            names.append(metadata["title"])
+            file_id = metadata["parents"][0]
+        return Path("/", *reversed(names))
+
+    def get_file(self, path):
+        parts = Path(path).parts
+        if parts and parts[0] == "/":
+            parts = parts[1 : ]
+
+        drive_file = {"id": self.root_id, "title": "", "mimeType": FOLDER_MIME_TYPE, "parents": []}
+        for name in parts:
+            matches = [
+                child for child in self.children.get(drive_file["id"], {}).values()
+                if child["title"] == name
+            ]
+            if not matches:
+                return None # File does not exist
+            drive_file = matches[0]
+
+        return drive_file
+
+    def __len__(self):
+        return len(self.files)
+
+    def save(self, path):
+        with gzip.open(str(path), "wt") as f:
+            json.dump({
+                "root_id": self.root_id,
+                "taken": self.taken,
+                "page_token": self.page_token,
+                "files": list(self.files.values()),
+            }, f)
+
+def load_snapshot(path):
+    with gzip.open(str(path), "rt") as f:
+        saved = json.load(f)
+    return RemoteSnapshot(saved["root_id"], saved["files"], saved["taken"], saved.get("page_token"))
+
+def take_snapshot(drive, page_size=1000, feed=None, verbose=True):
+    """
+    Lists every non-trashed item visible to the account in as few paginated requests as the API
+    allows, and rebuilds the folder tree locally. If a changes FEED is given, its start page token
+    is recorded before listing, so no change made during the listing is missed later.
+    """
+    page_token = feed.get_start_page_token() if feed is not None else None
+    with METRICS.timed("about.get"):
+        snapshot = RemoteSnapshot(drive.GetAbout()["rootFolderId"], page_token=page_token)
+
+    file_list = drive.ListFile({
+        "q": "trashed=false",
+        "fields": SNAPSHOT_FIELDS,
+        "maxResults": page_size,
+    })
+    pages = iter(file_list)
+    while True:
+        # Each page is fetched as the iteration reaches it.
+        with METRICS.timed("files.list"):
+            page = next(pages, None)
+        if page is None:
+            break
+        for drive_file in page:
+            snapshot.add(drive_file)
+        if verbose:
+            print("\rListed %i remote files" % len(snapshot), end="")
+    if verbose:
+        print()
+
+    return snapshot
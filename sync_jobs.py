@@ -0,0 +1,195 @@
+from argparse import ArgumentParser, Namespace
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import METRICS
+from path_cache import PATH_CACHE
+
+import os, sys, traceback
+
+import yaml
+
+# Settings that apply to the whole process rather than to any one job.
+SHARED_SETTINGS = {
+    "workers": 8,
+    "max_jobs": None,
+    "request_rate": 10.0,
+    "total_bandwidth": None,
+    "max_attempts": 5,
+    "credentials": None,
+    "path_cache": None,
+    "clear_path_cache": False,
+    "snapshot": False,
+    "snapshot_file": None,
+    "refresh_snapshot": False,
+    "metrics_file": None,
+    "prometheus_file": None,
+    "report_interval": None,
+}
+
+def make_job_args(job, defaults, shared):
+    """
+    Returns the syncer arguments for JOB, a dict of syncer option names (with underscores or
+    dashes) to values, on top of DEFAULTS and syncer's own defaults. A job gets at most its
+    "workers" of the shared workers, or all of them.
+    """
+    from syncer import make_parser
+
+    args = make_parser().parse_args([])
+    args.workers = shared.workers
+    for settings in (defaults, job):
+        for key, value in settings.items():
+            key = key.replace("-", "_")
+            if key == "name":
+                continue
+            # A job's own "workers" caps its share of the shared pool.
+            if key in SHARED_SETTINGS and key != "workers":
+                raise ValueError("%s applies to every job and can't be set per job" % key)
+            if not hasattr(args, key):
+                raise ValueError("Unknown setting %s" % key)
+            setattr(args, key, value)
+
+    if args.local is None or args.remote is None:
+        raise ValueError("Every job needs a local and a remote path")
+    args.workers = min(args.workers, shared.workers)
+    args.name = job.get("name", args.remote)
+    return args
+
+def load_jobs(path):
+    """
+    Reads the job file at PATH. Returns a 2-tuple of (1) the shared settings, and (2) the arguments
+    of every job, in file order.
+    """
+    with open(str(path)) as f:
+        config = yaml.safe_load(f) or {}
+
+    unknown = set(config) - set(SHARED_SETTINGS) - {"defaults", "jobs"}
+    if unknown:
+        raise ValueError("Unknown settings in %s: %s" % (path, ", ".join(sorted(unknown))))
+
+    shared = Namespace(**dict(SHARED_SETTINGS, **{key: config[key] for key in SHARED_SETTINGS if key in config}))
+    jobs = []
+    for job in config.get("jobs") or []:
+        try:
+            jobs.append(make_job_args(job, config.get("defaults") or {}, shared))
+        except ValueError as e:
+            raise ValueError("In job %s of %s: %s" % (job.get("name", len(jobs) + 1), path, str(e)))
+    return shared, jobs
+
+def open_hash_caches(jobs):
+    """
+    Returns a hashing.HashCache for each of JOBS, the same one for jobs naming the same file: a
+    second SQLite connection can't write to it while the first holds uncommitted hashes.
+    """
+    from hashing import HashCache
+
+    caches, job_caches = {}, []
+    for args in jobs:
+        path = None if args.hash_cache is None else os.path.abspath(str(args.hash_cache))
+        if path not in caches:
+            caches[path] = HashCache(path)
+        job_caches.append(caches[path])
+    return job_caches
+
+def run_job(drive, args, snapshot, retry_policy, executor, throttle, reporter, hash_cache):
+    """
+    Returns a 3-tuple of (errored, created, trashed), the last two for keeping SNAPSHOT in step.
+    """
+    from syncer import run_download, run_sync, run_upload
+
+    print("Starting job %s: %s %s %s" % (
+        args.name, args.local, {"download": "<-", "sync": "<->"}.get(args.command, "->"), args.remote))
+    drive_factory = lambda: drive
+    if args.command == "download":
+        return run_download(drive, args, snapshot, retry_policy, executor, drive_factory, throttle, reporter,
+                            hash_cache=hash_cache), [], []
+    if args.command == "sync":
+        return run_sync(drive, args, snapshot, retry_policy, executor, drive_factory, throttle, reporter,
+                        hash_cache=hash_cache)
+    return run_upload(drive, args, snapshot, retry_policy, executor, drive_factory, throttle, reporter,
+                      hash_cache=hash_cache) + ([],)
+
+def run_jobs(drive, shared, jobs):
+    """
+    Runs JOBS concurrently, at most SHARED.max_jobs at a time, on one session (DRIVE), one path
+    cache, one hash cache per hash cache file, one remote snapshot if asked for, one pool of
+    SHARED.workers workers, one request budget and one SHARED.total_bandwidth limit, inside which
+    each job's own bandwidth applies, with one progress report covering them all. Returns a dict of job name -> exception for the jobs that
+    failed outright, and a dict of job name -> number of items that couldn't be transferred.
+    """
+    from syncer import load_remote_snapshot, make_reporter, make_retry_policy
+    from throttle import make_throttle
+
+    snapshot = load_remote_snapshot(drive, shared)
+    retry_policy = make_retry_policy(shared)
+    throttle = make_throttle(shared.total_bandwidth)
+    hash_caches = open_hash_caches(jobs)
+
+    failed, errored, created, trashed = {}, {}, [], []
+    with make_reporter(shared) as reporter, \
+         ThreadPoolExecutor(shared.workers, thread_name_prefix="transfer") as executor, \
+         ThreadPoolExecutor(shared.max_jobs or len(jobs) or 1, thread_name_prefix="job") as job_executor:
+        futures = {
+            job_executor.submit(
+                run_job, drive, args, snapshot, retry_policy, executor, throttle, reporter, hash_cache): args.name
+            for args, hash_cache in zip(jobs, hash_caches)
+        }
+        for future, name in futures.items():
+            try:
+                job_errored, job_created, job_trashed = future.result()
+            except Exception as e:
+                traceback.print_exc()
+                failed[name] = e
+            else:
+                errored[name] = len(job_errored)
+                created.extend(job_created)
+                trashed.extend(job_trashed)
+
+    # Only now that no job is reading the snapshot can it take in what they uploaded and trashed.
+    if snapshot is not None and shared.snapshot_file is not None:
+        for drive_file in created:
+            snapshot.add(drive_file)
+        for file_id in trashed:
+            snapshot.remove(file_id)
+        snapshot.save(shared.snapshot_file)
+
+    print(retry_policy.summary())
+    return failed, errored
+
+if __name__ == "__main__":
+    import syncer
+
+    parser = ArgumentParser(description="Run every sync job listed in a job file in one process")
+    parser.add_argument("job_file", nargs="?", default="./jobs.yaml")
+    parser.add_argument("--only", nargs="+", metavar="NAME", help="Only run the jobs with these names")
+    parser.add_argument("--dry-run", action="store_true", help="Only print what each job would transfer")
+    args = parser.parse_args()
+
+    shared, jobs = load_jobs(args.job_file)
+    if args.only is not None:
+        missing = set(args.only) - {job.name for job in jobs}
+        if missing:
+            parser.error("No such job: %s" % ", ".join(sorted(missing)))
+        jobs = [job for job in jobs if job.name in args.only]
+    for job in jobs:
+        job.dry_run = job.dry_run or args.dry_run
+
+    if shared.credentials is not None:
+        syncer.CREDENTIALS_FILE = shared.credentials
+    drive = syncer.make_drive()
+    if shared.path_cache is not None:
+        PATH_CACHE.attach(shared.path_cache, drive.GetAbout()["permissionId"])
+        if shared.clear_path_cache:
+            PATH_CACHE.clear()
+
+    failed, errored = run_jobs(drive, shared, jobs)
+    PATH_CACHE.commit()
+    for job in jobs:
+        if job.name in failed:
+            print("%s: failed: %s" % (job.name, str(failed[job.name])))
+        else:
+            print("%s: done, %i items errored" % (job.name, errored[job.name]))
+    print("Path cache: %(hits)i hits, %(misses)i misses, %(entries)i entries" % PATH_CACHE.stats())
+    print(METRICS.summary())
+
+    if failed or any(errored.values()):
+        sys.exit(1)
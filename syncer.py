@@ -1,44 +1,42 @@
 from argparse import ArgumentParser
+from collections import namedtuple
 from pathlib import Path
 
-from pydrive.auth import GoogleAuth
-from pydrive.drive import GoogleDrive
-from pydrive.files import ApiRequestError, GoogleDriveFile
+from pydrive.files import GoogleDriveFile
 
-import os, time
+from metrics import METRICS
+from path_cache import PATH_CACHE
+from query import ITEM_FIELDS, NAME_FIELDS, find_child, find_children, list_children
+from session import get_session
 
-CREDENTIALS_FILE = "./authentication/credentials.json"
-
-def authenticate(credentials_file):
-    gauth = GoogleAuth()
-    gauth.LoadCredentialsFile(credentials_file)
-
-    if gauth.credentials is None: # Failed to load from cached credentials
-        gauth.LocalWebserverAuth() # Creates local webserver and auto handles authentication
-    elif gauth.access_token_expired:
-        gauth.Refresh()
-    else:
-        gauth.Authorize()
-
-    gauth.SaveCredentialsFile(credentials_file)
+import resource, shutil, sys, time, tracemalloc
 
-    return gauth
+CREDENTIALS_FILE = "./authentication/credentials.json"
 
 def get_root(drive):
-    return drive.ListFile({"q": "'root' in parents and trashed=false"}).GetList()
+    return list_children(drive, "root")
 
-def download_file(drive, source_path, download_path=None):
+def download_file(drive, source_path, download_path=None, throttle=None):
     source_path = Path(source_path)
     if download_path is None:
-        download_path = Path.home() / source_path
+        download_path = Path.home() / source_path.relative_to(source_path.anchor)
+    download_path = Path(download_path)
 
     download_dir, download_file_name = download_path.parent, download_path.name
     if not download_dir.exists():
         download_dir.mkdir(parents=True)
 
     drive_file = get_file(drive, str(source_path))
-    downloaded_drive_file = drive.CreateFile({"id": drive_file["id"]})
-    downloaded_drive_file.GetContentFile(str(download_path))
+    if drive_file.get("fileSize") is None:
+        # No binary content to stream (e.g. Google Docs), so let PyDrive deal with it.
+        downloaded_drive_file = drive.CreateFile({"id": drive_file["id"]})
+        with METRICS.timed("files.get_media"):
+            downloaded_drive_file.GetContentFile(str(download_path))
+    else:
+        from downloader import download_file_ranged, revision_of
+        download_file_ranged(
+            drive.auth.Get_Http_Object(), drive_file["id"], download_path, int(drive_file["fileSize"]),
+            throttle=throttle, md5=drive_file.get("md5Checksum"), revision=revision_of(drive_file))
 
 def upload_file(drive, source_path, upload_path):
     source_path, upload_path = Path(source_path), Path(upload_path)
@@ -76,9 +74,10 @@ def upload_file(drive, source_path, upload_path):
         "title": str(source_file_name)
     })
     drive_file.SetContentFile(str(source_path))
-    drive_file.Upload()
+    with METRICS.timed("files.insert"):
+        drive_file.Upload()
 
-def upload_file_fast(drive, source_path, upload_path, drive_parent_dir):
+def upload_file_fast(drive, source_path, upload_path, drive_parent_dir, throttle=None):
     upload_dir, upload_file_name = upload_path.parent, upload_path.name
 
     drive_file = drive.CreateFile({
@@ -86,7 +85,29 @@ def upload_file_fast(drive, source_path, upload_path, drive_parent_dir):
         "parents": [{"kind": "drive#fileLink", "id": drive_parent_dir["id"]}]
     })
     drive_file.SetContentFile(str(source_path))
-    drive_file.Upload()
+    throttle_content(drive_file, throttle)
+    with METRICS.timed("files.insert"):
+        drive_file.Upload()
+
+    return drive_file
+
+def update_file(drive, source_path, drive_file, throttle=None):
+    """
+    Replaces the content of the existing remote file DRIVE_FILE with that of SOURCE_PATH.
+    """
+    drive_file = GoogleDriveFile(auth=drive.auth, metadata=dict(drive_file), uploaded=True)
+    drive_file.SetContentFile(str(source_path))
+    throttle_content(drive_file, throttle)
+    with METRICS.timed("files.update"):
+        drive_file.Upload()
+
+    return drive_file
+
+def throttle_content(drive_file, throttle):
+    # PyDrive streams the upload body out of drive_file.content, so pace the reads from it.
+    if throttle is not None:
+        from throttle import ThrottledReader
+        drive_file.content = ThrottledReader(drive_file.content, throttle)
 
 def upload_directory_fast(drive, source_path, upload_path, drive_parent_dir):
     source_path, upload_path = Path(source_path), Path(upload_path)
@@ -133,7 +154,10 @@ def create_remote_folder(drive, path, drive_parent_dir=None):
         "parents": [{"id": drive_parent_dir["id"]}],
         "mimeType": "application/vnd.google-apps.folder"
     })
-    drive_folder.Upload()
+    with METRICS.timed("files.insert"):
+        drive_folder.Upload()
+
+    PATH_CACHE.put(path, drive_folder)
 
     return drive_folder
 
@@ -144,88 +168,214 @@ def get_file(drive, path):
         parts = parts[1 : ]
 
     parent_id = "root"
-    for directory in parts:
-        query = "'%s' in parents and title='%s' and trashed=false" % (parent_id, directory)
-        drive_file = drive.ListFile({"q": query}).GetList()
-        if len(drive_file) == 0:
-            return None # File does not exist
+    for i, directory in enumerate(parts):
+        sub_path = "/".join(parts[ : i + 1])
+        found, metadata = PATH_CACHE.lookup(sub_path)
+        if found:
+            if metadata is None:
+                return None # File is known not to exist
+            drive_file = GoogleDriveFile(auth=drive.auth, metadata=metadata, uploaded=True)
         else:
-            drive_file = drive_file[0]
+            drive_file = find_child(drive, parent_id, directory)
+            PATH_CACHE.put(sub_path, drive_file)
+            if drive_file is None:
+                return None # File does not exist
         parent_id = drive_file["id"]
 
     return drive_file
 
-# TODO(piyush) optimize this
 def file_exists(drive, path):
-    try:
-        get_file(drive, path)
-        return True
-    except ValueError:
+    path = Path(path)
+    found, metadata = PATH_CACHE.lookup(path)
+    if found or len(path.parts) <= 2:
+        return get_file(drive, path) is not None
+
+    drive_parent_dir = get_file(drive, path.parent)
+    if drive_parent_dir is None:
         return False
+    # Only a folder will be looked up again by path, so a file's metadata isn't worth fetching.
+    drive_file = find_child(drive, drive_parent_dir["id"], path.name, NAME_FIELDS)
+    if drive_file is None or is_folder(drive_file):
+        PATH_CACHE.put(path, drive_file)
+    return drive_file is not None
+
+def trash_file(drive, path):
+    drive_file = get_file(drive, path)
+    if drive_file is None:
+        raise ValueError("Trying to trash nonexistent file %s" % str(path))
+
+    with METRICS.timed("files.trash"):
+        drive_file.Trash()
+    PATH_CACHE.invalidate(path)
+
+def move_file(drive, source_path, destination_path):
+    source_path, destination_path = Path(source_path), Path(destination_path)
+
+    drive_file = get_file(drive, str(source_path))
+    if drive_file is None:
+        raise ValueError("Trying to move nonexistent file %s" % str(source_path))
+    drive_parent_dir = get_file(drive, str(destination_path.parent))
+    if drive_parent_dir is None:
+        drive_parent_dir = create_remote_path(drive, str(destination_path.parent))
+
+    drive_file["title"] = destination_path.name
+    drive_file["parents"] = [{"kind": "drive#fileLink", "id": drive_parent_dir["id"]}]
+    with METRICS.timed("files.update"):
+        drive_file.Upload()
+
+    PATH_CACHE.invalidate(source_path)
+    PATH_CACHE.invalidate(destination_path)
+    PATH_CACHE.put(destination_path, drive_file)
+
+    return drive_file
 
 def get_children(drive, drive_file):
     if not is_folder(drive_file):
         raise ValueError("Trying to obtain children of non-folder file")
 
-    return drive.ListFile({"q": "'%s' in parents and trashed=false" % drive_file["id"]}).GetList()
+    return list_children(drive, drive_file["id"])
 
 def is_folder(drive_file):
     return drive_file["mimeType"] == "application/vnd.google-apps.folder"
 
-def get_missing_remote_files(drive, local_path, remote_dir_path, drive_dir):
+# A unit of upload work, kept small since a diff can find millions of them: the id of the nearest
+# remote ancestor folder that already exists, the path relative to the local root of the sync, and
+# the size in bytes (None for an empty directory, which only needs its folder created).
+UploadItem = namedtuple("UploadItem", ["parent_id", "path", "size"])
+
+def get_missing_remote_files(drive, local_path, remote_dir_path, drive_dir, snapshot=None, local_scan=None,
+                             existing=None):
     """
     Returns files underneath the directory LOCAL_PATH which are not present (based on the same
-    relative path) under REMOTE_DIR_PATH remotely. The files are returned as a list of 2-tuples,
-    with each tuple composed of (1) a local file path, and (2) a drive object pointing to the
-    parent directory of the intended upload location.
+    relative path) under REMOTE_DIR_PATH remotely, as a list of UploadItems with paths relative to
+    LOCAL_PATH. See iter_missing_remote_files for the other arguments.
+    """
+    return list(iter_missing_remote_files(
+        drive, local_path, remote_dir_path, drive_dir, snapshot, local_scan, existing))
+
+def iter_missing_remote_files(drive, local_path, remote_dir_path, drive_dir, snapshot=None, local_scan=None,
+                              existing=None, local_root=None):
+    """
+    Yields an UploadItem for every file underneath the directory LOCAL_PATH which is not present
+    (based on the same relative path) under REMOTE_DIR_PATH remotely, as soon as it's found, with
+    paths relative to LOCAL_ROOT (LOCAL_PATH by default). Only the listings of the directories
+    being compared are held onto, so memory doesn't grow with the size of the tree.
+
+    If SNAPSHOT is given, remote children are read from it. Otherwise only the remote children
+    named like local ones are looked up, a directory at a time, fetching no more fields than the
+    comparison needs (see query.find_children). Local listings come from LOCAL_SCAN, either a
+    local_index.LocalScan, in which case subtrees it didn't see change are skipped entirely, or a
+    scanner.ParallelScanner, which is used by default and reads directories ahead of the diff while
+    it waits on the remote side. If EXISTING is given, (local path, drive file) pairs for files
+    that do exist remotely are appended to it, for comparing their contents afterwards.
     """
     local_path, remote_dir_path = Path(local_path), Path(remote_dir_path)
+    local_root = local_path if local_root is None else Path(local_root)
+    relative = lambda path: path.relative_to(local_root).as_posix()
+
+    if local_scan is None:
+        from scanner import ParallelScanner
+        with ParallelScanner(local_path) as scanner:
+            yield from iter_missing_remote_files(
+                drive, local_path, remote_dir_path, drive_dir, snapshot, scanner, existing, local_root)
+        return
 
-    print_on_same_line("Processing %s" % str(local_path)) # TODO(piyush) remove
+    if not local_scan.needs_visit(local_path):
+        return
+
+    print_on_same_line("Processing %s" % str(local_path))
 
     assert local_path.name == remote_dir_path.name
     assert local_path.exists()
     assert local_path.is_dir()
     assert drive_dir is not None
 
-    to_upload = []
-    drive_children_names = {child["title"]: child for child in get_children(drive, drive_dir)}
-    for local_child in local_path.iterdir():
+    local_children = [(local_path / name, is_dir, size) for name, is_dir, size in local_scan.list_dir(local_path)]
+
+    if snapshot is not None:
+        drive_children_names = {child["title"]: child for child in snapshot.get_children(drive_dir)}
+    elif local_children:
+        # Contents are only compared when EXISTING is asked for.
+        drive_children_names = find_children(
+            drive, drive_dir["id"], [local_child.name for local_child, _, _ in local_children],
+            NAME_FIELDS if existing is None else ITEM_FIELDS)
+    else:
+        drive_children_names = {}
+    for title, child in drive_children_names.items():
+        # Only folders get looked up by path later on, so don't let files bloat the cache.
+        if is_folder(child):
+            PATH_CACHE.put(remote_dir_path / title, child)
+
+    for local_child, local_child_is_dir, size in local_children:
         # If matching file (or directory) doesn't exist remotely, mark it for upload.
         if local_child.name not in drive_children_names or \
-           local_child.is_dir() != is_folder(drive_children_names[local_child.name]):
-            if local_child.is_dir():
-                file_paths = [
-                    Path(file_name)
-                    for _, _, file_names in os.walk(str(local_child))
-                    for file_name in file_names
-                ]
-
-                if file_paths:
-                    print_on_same_line("Adding all files in directory %s" % str(local_child)) # TODO(piyush) remtoe
-
-                    to_upload.extend([(file_path, drive_dir) for file_path in file_paths])
-                    # to_upload.extend([(file_path, False) for file_path in file_paths])
-                else:
-                    print_on_same_line("Adding empty directory %s" % str(local_child)) # TODO(piyush) remove
-
-                    # to_upload.append((local_child, True))
-                    to_upload.append((local_child, drive_dir))
+           local_child_is_dir != is_folder(drive_children_names[local_child.name]):
+            if local_child_is_dir:
+                empty = True
+                for file_path, file_size in local_scan.files_under(local_child):
+                    empty = False
+                    yield UploadItem(drive_dir["id"], relative(file_path), file_size)
+                if empty:
+                    yield UploadItem(drive_dir["id"], relative(local_child), None)
             else:
-                print_on_same_line("Adding file %s" % str(local_child)) # TODO(piyush) remove
-
-                # to_upload.append((local_child, False))
-                to_upload.append((local_child, drive_dir))
+                yield UploadItem(drive_dir["id"], relative(local_child), size)
         # Otherwise, if matching file does exist remotely, then assuming it's a directory, recurse.
-        elif local_child.is_dir():
-            to_upload.extend(
-                get_missing_remote_files(
-                    drive,
-                    local_child,
-                    remote_dir_path / local_child.name,
-                    drive_children_names[local_child.name]))
+        elif local_child_is_dir:
+            yield from iter_missing_remote_files(
+                drive,
+                local_child,
+                remote_dir_path / local_child.name,
+                drive_children_names[local_child.name],
+                snapshot,
+                local_scan,
+                existing,
+                local_root)
+        elif existing is not None:
+            existing.append((local_child, drive_children_names[local_child.name]))
+
+def get_changed_and_moved_files(existing, to_upload, local_root, remote_root, snapshot=None,
+                                hash_cache=None):
+    """
+    Compares contents by MD5 instead of trusting names. EXISTING holds the (local path, drive file)
+    pairs whose names matched during the diff, and TO_UPLOAD the UploadItems it found missing.
 
-    return to_upload
+    Returns a 3-tuple of (1) (local path, drive file) pairs whose remote content differs and must be
+    updated in place, (2) (local path, old remote path) pairs for new local files whose exact
+    content already sits elsewhere under REMOTE_ROOT at a path that no longer exists locally, which
+    are relocated rather than re-uploaded (this needs SNAPSHOT), and (3) what's left to upload.
+    """
+    from hashing import hash_files
+
+    local_root, remote_root = Path(local_root), Path(remote_root)
+    new_files = [local_root / item.path for item in to_upload if item.size is not None]
+    hashes = hash_files([local_path for local_path, _ in existing] + new_files, hash_cache)
+
+    to_update = [
+        (local_path, drive_file) for local_path, drive_file in existing
+        if drive_file.get("md5Checksum") is not None and drive_file["md5Checksum"] != hashes[local_path]
+    ]
+
+    to_move = []
+    if snapshot is not None:
+        # Remote files whose local counterpart is gone are candidates for having been moved.
+        orphans = {}
+        for remote_path, drive_file in snapshot.walk(snapshot.get_file(remote_root), remote_root):
+            if drive_file.get("md5Checksum") is not None and \
+               not (local_root / remote_path.relative_to(remote_root)).exists():
+                orphans.setdefault((drive_file["md5Checksum"], int(drive_file["fileSize"])), []).append(remote_path)
+
+        remaining = []
+        for item in to_upload:
+            candidates = None
+            if item.size is not None:
+                candidates = orphans.get((hashes[local_root / item.path], item.size))
+            if candidates:
+                to_move.append((local_root / item.path, candidates.pop()))
+            else:
+                remaining.append(item)
+        to_upload = remaining
+
+    return to_update, to_move, to_upload
 
 def validate_arguments(drive, local_path, remote_path):
     local_path, remote_path = Path(local_path), Path(remote_path)
@@ -237,79 +387,512 @@ def validate_arguments(drive, local_path, remote_path):
     assert file_exists(drive, remote_path)
 
 def print_on_same_line(s):
-    if "TERM_WIDTH" not in globals():
-        global TERM_WIDTH
-        TERM_WIDTH = int(os.popen("stty size", "r").read().split()[1])
-
-    # if len(s) <= TERM_WIDTH:
-        # print(s + " " * (TERM_WIDTH - len(s)), end="\r")
-    # else:
-        # print(s, end="\r")
-
-    # Useful ANSI escape sequences
-    mul = "\033[1A" # Move up line
-    mdl = "\n"      # Move down line
-    rts = "\033[1G" # Return to start
-    cl = "\033[K"   # Clear line
-
-    print(cl + s, end="")
-    if len(s) <= TERM_WIDTH:
-        print("\r", end="")
+    # A line that's about to be overwritten is only useful on a terminal; in a log (e.g. from cron)
+    # it'd be noise, and metrics.Reporter prints proper progress lines there instead.
+    if not sys.stdout.isatty():
+        return
+
+    # Clear the line and stay on it, cutting S short rather than letting it wrap onto the next one.
+    width = shutil.get_terminal_size().columns
+    print("\r\033[K" + s[ : width - 1], end="", flush=True)
+
+def load_remote_snapshot(drive, args):
+    """
+    Returns the remote snapshot asked for on the command line (or None), bringing a saved one up
+    to date through the changes feed.
+    """
+    from changes import DriveChangesFeed, apply_changes
+    from snapshot import load_snapshot, take_snapshot
+
+    if not args.snapshot and args.snapshot_file is None:
+        return None
+
+    feed = DriveChangesFeed(drive)
+    if args.snapshot_file is not None and Path(args.snapshot_file).exists() and not args.refresh_snapshot:
+        snapshot = load_snapshot(args.snapshot_file)
+        print("Loaded snapshot of %i remote files taken at %s" % (len(snapshot), time.ctime(snapshot.taken)))
+        if snapshot.page_token is not None:
+            apply_changes(snapshot, feed)
     else:
-        print(mul + "\r", end="")
+        snapshot = take_snapshot(drive, feed=feed)
+    if args.snapshot_file is not None:
+        snapshot.save(args.snapshot_file)
 
-if __name__ == "__main__":
-    parser = ArgumentParser()
-    parser.add_argument("--local")
-    parser.add_argument("--remote")
+    return snapshot
+
+def make_retry_policy(args):
+    from retry import RateLimiter, RetryPolicy
+
+    return RetryPolicy(args.max_attempts, rate_limiter=RateLimiter(args.request_rate))
+
+def make_policy(args):
+    from scheduling import make_policy
+
+    return make_policy(args.policy, args.resumable_threshold * 1024 * 1024, args.large_lanes)
+
+def make_dedup_index(drive, args, snapshot=None):
+    """
+    Returns the dedup.DedupIndex asked for on the command line (or None), built from SNAPSHOT if
+    there is one.
+    """
+    from dedup import build_index
+
+    if args.dedup is None:
+        return None
+    index = build_index(drive, snapshot, args.dedup)
+    print("Indexed %i distinct remote contents for deduplication" % len(index))
+    return index
+
+def print_estimate(sizes, args):
+    from scheduling import estimate_makespan, format_duration
+
+    print("Estimated upload time with the %s policy on %i workers: %s" % (
+        args.policy, args.workers, format_duration(estimate_makespan(sizes, make_policy(args), args.workers))))
+
+def diff_upload(drive, args, snapshot=None, hash_cache=None):
+    """
+    Diffs ARGS.local against ARGS.remote (or SNAPSHOT of the remote side, if given) for an upload,
+    through ARGS.local_index if there is one. Returns a 6-tuple of (1) the UploadItems missing
+    remotely, streamed unless ARGS.compare is md5, (2) the (local path, drive file) pairs to
+    update and (3) the (local path, old remote path) pairs to move, then (4) the LocalIndex (or
+    None) and (5) the scan of the local tree, which the caller commits or closes, and (6) the
+    bundles.BundlingScan collecting directories left for bundling (or None).
+    """
+    from bundles import BundlingScan
+    from local_index import LocalIndex
+    from scanner import ParallelScanner
 
-    args = parser.parse_args()
+    if snapshot is not None:
+        top_drive_dir = snapshot.get_file(args.remote)
+    else:
+        top_drive_dir = get_file(drive, args.remote)
+
+    local_index, bundling = None, None
+    if args.local_index is not None:
+        local_index = LocalIndex(args.local_index)
+        local_scan = local_index.scan(args.local, full_rescan=args.full_rescan)
+        print("%i local directories changed since the last sync" % len(local_scan.dirty))
+    else:
+        local_scan = ParallelScanner(args.local, args.scan_workers)
+
+    existing = [] if args.compare == "md5" else None
+    if args.bundle:
+        bundling = BundlingScan(local_scan, args.local, args.bundle)
+    to_upload = iter_missing_remote_files(
+        drive, args.local, args.remote, top_drive_dir, snapshot, local_scan if bundling is None else bundling,
+        existing)
+
+    to_update, to_move = [], []
+    if args.compare == "md5":
+        # Moves can only be told apart from uploads once the whole diff is in.
+        to_upload = list(to_upload)
+        print()
+        to_update, to_move, to_upload = get_changed_and_moved_files(
+            existing, to_upload, args.local, args.remote, snapshot, hash_cache)
+
+    return to_upload, to_update, to_move, local_index, local_scan, bundling
+
+def run_upload(drive, args, snapshot=None, retry_policy=None, executor=None, drive_factory=None,
+               throttle=None, reporter=None, plan=None, hash_cache=None):
+    """
+    Uploads what's missing (or changed, or moved) under ARGS.local to ARGS.remote. SNAPSHOT,
+    RETRY_POLICY, EXECUTOR, DRIVE_FACTORY and HASH_CACHE let several runs share a remote snapshot,
+    a request budget, a worker pool, a session and a hashing.HashCache; otherwise each run gets its
+    own. A SNAPSHOT passed in is
+    left alone, and kept in step with the upload by the caller. THROTTLE is a bandwidth limit
+    shared with other runs, inside which ARGS.bandwidth applies. Progress goes to REPORTER if given.
+    Directories matching ARGS.bundle are left out of the diff and go up as bundles instead (see
+    bundles.py). Given a planner.Plan, carries out exactly that instead of diffing.
+
+    Returns a 2-tuple of (errored, created), as in UploadScheduler.
+    """
+    from bundles import BundleUploader
+    from hashing import HashCache
+    from journal import Journal
+    from scanner import ParallelScanner
+    from throttle import make_throttle
+    from uploader import UploadScheduler, format_bytes, prefetch
+
+    if args.trace_memory:
+        tracemalloc.start()
 
-    drive = GoogleDrive(authenticate(CREDENTIALS_FILE))
     validate_arguments(drive, args.local, args.remote)
 
-    top_drive_dir = get_file(drive, args.remote)
-    to_upload = get_missing_remote_files(drive, args.local, args.remote, top_drive_dir)
+    owns_snapshot = snapshot is None
+    if owns_snapshot:
+        snapshot = load_remote_snapshot(drive, args)
+    local_index, local_scan, bundling = None, None, None
+
+    journal = Journal(args.journal)
+    if hash_cache is None:
+        hash_cache = HashCache(args.hash_cache)
+    run_id = None
+    if plan is not None:
+        run_id = journal.find_plan_run(plan.key)
+    elif not args.fresh:
+        run_id = journal.find_unfinished_run(args.local, args.remote)
+
+    if plan is not None and run_id is None:
+        # Carry out exactly what was planned, without diffing again.
+        to_upload, to_update, to_move = plan.items()
+    elif plan is not None:
+        # Each plan is carried out once: applying it again only picks up what didn't go through.
+        journal.start_run(args.local, args.remote, run_id)
+        to_upload, to_update, to_move = plan.items(journal.done())
+        remaining = len(to_upload) + len(to_update) + len(to_move)
+        if remaining == 0 and not plan.changed:
+            print("Plan already applied in run %i" % run_id)
+            return [], []
+        print("Resuming run %i of the plan with %i items left" % (run_id, remaining))
+        journal.plan(to_upload, to_update, to_move)
+    elif run_id is not None and journal.is_diffed(run_id):
+        # Pick up exactly where the interrupted run left off, without diffing again.
+        journal.start_run(args.local, args.remote, run_id)
+        to_upload, to_update, to_move = journal.unfinished()
+        print("Resuming run %i with %i unfinished items" % (run_id, len(to_upload) + len(to_update) + len(to_move)))
+    else:
+        if run_id is not None:
+            # What the journal holds of a streamed diff is only what it had found so far.
+            print("Run %i was interrupted before its diff finished, so diffing again" % run_id)
+        to_upload, to_update, to_move, local_index, local_scan, bundling = diff_upload(
+            drive, args, snapshot, hash_cache)
+
+    other_sizes = [local_path.stat().st_size for local_path, _ in to_update] + [0] * len(to_move)
+    if args.dry_run:
+        print()
+        sizes = []
+        for item in to_upload:
+            print(Path(args.local) / item.path)
+            if item.size is not None:
+                sizes.append(item.size)
+        for local_path, _ in to_update:
+            print("%s (changed)" % local_path)
+        for local_path, old_remote_path in to_move:
+            print("%s (moved from %s)" % (local_path, old_remote_path))
+        print("%i files to upload, %i to update, %i to move" % (len(sizes), len(to_update), len(to_move)))
+        if bundling is not None:
+            for rel_dir in bundling.bundled:
+                print("%s (bundled)" % (Path(args.local) / rel_dir))
+        print_estimate(sizes + other_sizes, args)
+        if isinstance(local_scan, ParallelScanner):
+            local_scan.close()
+        return [], []
+
+    dedup = make_dedup_index(drive, args, snapshot)
+
+    if isinstance(to_upload, list):
+        # With a streamed diff, the total isn't known until the uploads are well under way.
+        print_estimate([item.size for item in to_upload if item.size is not None] + other_sizes, args)
+
+    if run_id is None or not journal.is_diffed(run_id):
+        journal.start_run(args.local, args.remote, run_id, None if plan is None else plan.key)
+        # Items of an interrupted diff that didn't go through are found again by this one, if need be.
+        journal.forget_unfinished()
+        journal.plan((), to_update, to_move)
+        if isinstance(to_upload, list):
+            journal.plan(to_upload)
+            journal.finish_diff()
+        else:
+            # Upload while the diff is still running, which stays at most --queue-size items ahead.
+            to_upload = prefetch(journal.planning(to_upload), args.queue_size)
+
+    scheduler = UploadScheduler(
+        make_drive if drive_factory is None else drive_factory,
+        num_workers=args.workers,
+        resumable_threshold=args.resumable_threshold * 1024 * 1024,
+        chunk_size=args.chunk_size * 1024 * 1024,
+        state_dir=args.upload_state_dir,
+        retry_policy=make_retry_policy(args) if retry_policy is None else retry_policy,
+        batch_folders=not args.no_batch,
+        journal=journal,
+        policy=make_policy(args),
+        executor=executor,
+        throttle=make_throttle(args.bandwidth, throttle),
+        reporter=reporter,
+        dedup=dedup,
+        hash_cache=hash_cache)
+    _, errored = scheduler.run(args.local, args.remote, to_upload, to_update, to_move)
+    bundled = plan.bundled if plan is not None else bundling.bundled if bundling is not None else ()
+    if bundled:
+        bundler = BundleUploader(
+            make_drive if drive_factory is None else drive_factory,
+            num_workers=args.workers,
+            bundle_size=args.bundle_size * 1024 * 1024,
+            max_files=args.bundle_max_files,
+            chunk_size=args.chunk_size * 1024 * 1024,
+            retry_policy=scheduler.retry_policy)
+        errored.extend(bundler.run(args.local, args.remote, bundled)[1])
+    journal.finish_run()
+    hash_cache.commit()
+    PATH_CACHE.commit()
+
+    if isinstance(local_scan, ParallelScanner):
+        local_scan.close()
+    if local_index is not None:
+        local_index.commit(local_scan, failed_dirs={
+            local_path if local_path.is_dir() else local_path.parent for local_path, _, _ in errored
+        })
+
+    # Keep a saved snapshot in step with what was just uploaded, so the next run doesn't have to wait
+    # for the changes feed to report it.
+    if owns_snapshot and snapshot is not None and args.snapshot_file is not None:
+        for drive_file in scheduler.created:
+            snapshot.add(drive_file)
+        snapshot.save(args.snapshot_file)
+
+    print("Path cache: %(hits)i hits, %(misses)i misses, %(entries)i entries" % PATH_CACHE.stats())
+    print(journal.report(journal.run_id))
+
+    # ru_maxrss is in kilobytes on Linux but bytes on macOS.
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+    print("Peak resident memory: %s" % format_bytes(peak_rss))
+    if args.trace_memory:
+        print("Peak traced Python memory: %s" % format_bytes(tracemalloc.get_traced_memory()[1]))
+
+    return errored, scheduler.created
+
+def run_download(drive, args, snapshot=None, retry_policy=None, executor=None, drive_factory=None,
+                 throttle=None, reporter=None, hash_cache=None):
+    """
+    Mirrors ARGS.remote into ARGS.local. The other arguments are as in run_upload. Returns the
+    (local path, exception) pairs of the files that couldn't be downloaded.
+    """
+    from downloader import DownloadScheduler
+    from hashing import HashCache
+    from throttle import make_throttle
+
+    scheduler = DownloadScheduler(
+        make_drive if drive_factory is None else drive_factory,
+        num_workers=args.workers,
+        chunk_size=args.chunk_size * 1024 * 1024,
+        retry_policy=make_retry_policy(args) if retry_policy is None else retry_policy,
+        hash_cache=HashCache(args.hash_cache) if hash_cache is None else hash_cache,
+        executor=executor,
+        throttle=make_throttle(args.bandwidth, throttle),
+        reporter=reporter)
+    if snapshot is None:
+        snapshot = load_remote_snapshot(drive, args)
+    _, errored = scheduler.mirror(drive, args.remote, args.local, snapshot)
+    scheduler.hash_cache.commit()
+    PATH_CACHE.commit()
+
+    return errored
+
+def run_sync(drive, args, snapshot=None, retry_policy=None, executor=None, drive_factory=None,
+             throttle=None, reporter=None, hash_cache=None):
+    """
+    Two-way sync of ARGS.local and ARGS.remote against the baseline in ARGS.baseline: adds,
+    modifications and deletions on either side since the last sync are carried over to the other,
+    and files changed on both are settled by ARGS.conflict_policy. The other arguments are as in
+    run_upload.
+
+    Returns a 3-tuple of (1) (local path, exception) pairs for everything that failed, and (2) the
+    files and folders created and (3) the ids of those trashed, for a caller keeping SNAPSHOT in
+    step.
+    """
+    from downloader import DownloadScheduler
+    from hashing import HashCache
+    from throttle import make_throttle
+    from two_way import Baseline, TwoWaySync
+    from uploader import UploadScheduler
+
+    owns_snapshot = snapshot is None
+    if owns_snapshot:
+        snapshot = load_remote_snapshot(drive, args)
+        if snapshot is None:
+            from snapshot import take_snapshot
+            snapshot = take_snapshot(drive)
+
+    if hash_cache is None:
+        hash_cache = HashCache(args.hash_cache)
+    sync = TwoWaySync(args.local, args.remote, Baseline(args.baseline))
+    sync.scan(snapshot, hash_cache, args.scan_workers)
+    plan = sync.plan(args.conflict_policy)
+
+    for path, kind, winner in plan.conflicts:
+        print("Conflict on %s (%s): %s" % (path, kind, {
+            "local": "keeping the local version", "remote": "keeping the remote version",
+            "both": "keeping both", None: "skipped"}[winner]))
+    for path, reason in plan.skipped:
+        print("Skipping %s: %s" % (path, reason))
+
+    if args.dry_run:
+        for path in plan.uploads:
+            print("%s -> (new)" % path)
+        for path, _ in plan.updates:
+            print("%s -> (changed)" % path)
+        for path, _ in plan.downloads:
+            print("%s <-" % path)
+        for path in plan.delete_local:
+            print("%s (delete local)" % path)
+        for path, _ in plan.trash_remote:
+            print("%s (trash remote)" % path)
+        print(plan.summary())
+        return [], [], []
+    print(plan.summary())
+
+    retry_policy = make_retry_policy(args) if retry_policy is None else retry_policy
+    throttle = make_throttle(args.bandwidth, throttle)
+    upload_scheduler = UploadScheduler(
+        make_drive if drive_factory is None else drive_factory,
+        num_workers=args.workers,
+        resumable_threshold=args.resumable_threshold * 1024 * 1024,
+        chunk_size=args.chunk_size * 1024 * 1024,
+        state_dir=args.upload_state_dir,
+        retry_policy=retry_policy,
+        batch_folders=not args.no_batch,
+        policy=make_policy(args),
+        executor=executor,
+        throttle=throttle,
+        reporter=reporter,
+        dedup=make_dedup_index(drive, args, snapshot),
+        hash_cache=hash_cache)
+    download_scheduler = DownloadScheduler(
+        make_drive if drive_factory is None else drive_factory,
+        num_workers=args.workers,
+        chunk_size=args.chunk_size * 1024 * 1024,
+        retry_policy=retry_policy,
+        hash_cache=hash_cache,
+        executor=executor,
+        throttle=throttle,
+        reporter=reporter)
+    errored, trashed = sync.apply(drive, plan, upload_scheduler, download_scheduler, retry_policy)
+    hash_cache.commit()
+    PATH_CACHE.commit()
+
+    # A snapshot that still held the old remote state would have the next run undo this one.
+    if owns_snapshot and args.snapshot_file is not None:
+        for drive_file in upload_scheduler.created:
+            snapshot.add(drive_file)
+        for file_id in trashed:
+            snapshot.remove(file_id)
+        snapshot.save(args.snapshot_file)
+
+    return errored, upload_scheduler.created, trashed
+
+def make_drive():
+    return get_session(CREDENTIALS_FILE).drive
+
+def make_parser():
+    parser = ArgumentParser()
+    parser.add_argument("command", nargs="?", choices=["upload", "download", "sync", "report", "plan", "apply"],
+                        default="upload",
+                        help="Upload missing files under --local to --remote, mirror --remote into --local, "
+                             "sync both ways, summarize the latest run recorded in the journal, work out an "
+                             "upload into --plan-file without changing anything, or carry out such a plan")
+    parser.add_argument("--local")
+    parser.add_argument("--remote")
+    parser.add_argument("--path-cache", help="SQLite file in which to persist resolved remote paths")
+    parser.add_argument("--clear-path-cache", action="store_true")
+    parser.add_argument("--workers", type=int, default=4, help="Number of concurrent transfers")
+    parser.add_argument("--snapshot", action="store_true",
+                        help="List the whole remote tree up front instead of once per directory")
+    parser.add_argument("--snapshot-file", help="Load the remote snapshot from (and save it to) this file")
+    parser.add_argument("--refresh-snapshot", action="store_true",
+                        help="Retake the remote snapshot even if --snapshot-file exists")
+    parser.add_argument("--dry-run", action="store_true", help="Only print what would be uploaded")
+    parser.add_argument("--plan-file", default="./plan.json.gz",
+                        help="Where the plan command saves the plan, and the apply command reads it from")
+    parser.add_argument("--local-index",
+                        help="SQLite file recording the local tree, so unchanged directories aren't rescanned")
+    parser.add_argument("--full-rescan", action="store_true",
+                        help="Re-read every local directory, e.g. to pick up edits to existing files")
+    parser.add_argument("--scan-workers", type=int, default=8,
+                        help="Threads reading local directories ahead of the diff")
+    parser.add_argument("--compare", choices=["name", "md5"], default="name",
+                        help="Treat same-named files as equal, or compare their MD5s and relocate moved files")
+    parser.add_argument("--hash-cache", help="SQLite file caching local MD5s by path, size and mtime")
+    parser.add_argument("--resumable-threshold", type=int, default=64,
+                        help="Upload files of at least this many MB through resumable sessions")
+    parser.add_argument("--chunk-size", type=int, default=32, help="Resumable upload and ranged download chunk size in MB")
+    parser.add_argument("--upload-state-dir", default="./upload_sessions",
+                        help="Where resumable upload sessions are persisted")
+    parser.add_argument("--max-attempts", type=int, default=5,
+                        help="Attempts per item before giving up on rate limits, 5xx and connection errors")
+    parser.add_argument("--no-batch", action="store_true",
+                        help="Create folders one request at a time instead of in batches")
+    parser.add_argument("--journal", default="./journal.db",
+                        help="SQLite file recording the state of every item of every run")
+    parser.add_argument("--fresh", action="store_true",
+                        help="Diff from scratch even if the last run for these paths was interrupted")
+    parser.add_argument("--request-rate", type=float, default=10.0,
+                        help="Initial requests per second across all workers; adapts to throttling")
+    parser.add_argument("--policy", choices=["lanes", "fifo", "smallest", "largest"], default="lanes",
+                        help="Order in which queued files go to free workers; lanes keeps workers for "
+                             "files over --resumable-threshold")
+    parser.add_argument("--large-lanes", type=int, default=1,
+                        help="Workers kept for large files under the lanes policy")
+    parser.add_argument("--bandwidth",
+                        help="Cap on transfer bandwidth, e.g. 10Mbit or 5MB, or a schedule by local time "
+                             "of day such as 09:00-18:00=10Mbit,unlimited")
+    parser.add_argument("--queue-size", type=int, default=10000,
+                        help="How many items the diff may run ahead of the uploads")
+    parser.add_argument("--dedup", choices=["copy", "parent"],
+                        help="Copy new files whose content is already anywhere on Drive server side instead "
+                             "of uploading them; parent instead adds the folder to the existing file where "
+                             "the names match, so both paths are the same file")
+    parser.add_argument("--bundle", action="append", metavar="PATTERN",
+                        help="Upload local directories whose path (relative to --local) matches this glob as "
+                             "a few tar bundles plus an index instead of a file per file; may be repeated")
+    parser.add_argument("--bundle-size", type=int, default=64, help="Target size of a bundle in MB")
+    parser.add_argument("--bundle-max-files", type=int, default=10000, help="Most files in a bundle")
+    parser.add_argument("--baseline", default="./baseline.db",
+                        help="SQLite file recording the state of both sides after the last two-way sync")
+    parser.add_argument("--conflict-policy", choices=["local", "remote", "newer", "keep-both", "skip"],
+                        default="skip",
+                        help="Which version wins when a file changed on both sides since the last sync: "
+                             "keep-both keeps the local one as a conflict copy; skip leaves both alone")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="Report peak Python heap usage (slows the run down)")
+    parser.add_argument("--metrics-file", help="Append a JSON line of API call metrics to this file periodically")
+    parser.add_argument("--prometheus-file",
+                        help="Keep API call metrics in this file in the Prometheus text format, e.g. for "
+                             "node_exporter's textfile collector")
+    parser.add_argument("--report-interval", type=float,
+                        help="Seconds between progress reports (default 1 on a terminal, 30 otherwise)")
+    return parser
+
+def make_reporter(args):
+    from metrics import Reporter
+
+    return Reporter(args.report_interval, metrics_file=args.metrics_file, prometheus_file=args.prometheus_file)
 
-    # TODO(piyush) remove
-    import pickle
-    with open("to_upload.pkl", "wb") as f:
-        pickle.dump(to_upload, f)
+if __name__ == "__main__":
+    args = make_parser().parse_args()
 
-    uploaded, errored = [], []
-    for i, (local_path, drive_dir) in enumerate(to_upload):
-        print_on_same_line("%i / %i - Uploading %s" % (i + 1, len(to_upload), local_path))
+    if args.command == "report":
+        from journal import Journal
+        print(Journal(args.journal).report())
+        sys.exit(0)
 
-        remote_path = args.remote / local_path.relative_to(args.local)
+    drive = make_drive()
+    if args.path_cache is not None:
+        PATH_CACHE.attach(args.path_cache, drive.GetAbout()["permissionId"])
+        if args.clear_path_cache:
+            PATH_CACHE.clear()
 
-        try:
-            if local_path.is_dir():
-                create_remote_folder(drive, remote_path, drive_dir)
-            else:
-                upload_file_fast(drive, local_path, remote_path, drive_dir)
-        except ApiRequestError as e:
-            print("Received HTTP error when uploading file %s: %s" % (local_path, str(e)))
-            errored.append((local_path, drive_dir, e))
-            time.sleep(10) # TODO(piyush) Read the HTTP error to find out how long to wait before trying again
-        except ConnectionResetError as e:
-            print("Connection was reset by peer before uploading file %s: %s" % (local_path, str(e)))
-            drive = GoogleDrive(authenticate(CREDENTIALS_FILE))
-            errored.append((local_path, drive_dir, e))
-        except:
-            print("Received unknown error on file %s: %s" % (local_path, str(e)))
-            errored.append((local_path, drive_dir, None))
-
-        uploaded.append((local_path, drive_dir))
-
-    if uploaded:
-        with open("uploaded.pkl", "wb") as f:
-            pickle.dump(uploaded, f)
-
-
-    # # TODO(piyush) remove
-    if errored:
-        with open("errored.pkl", "wb") as f:
-            pickle.dump(errored, f)
+    reporter = make_reporter(args).start()
+    try:
+        if args.command == "plan":
+            from planner import run_plan
+            run_plan(drive, args)
+            errored = []
+        elif args.command == "apply":
+            from planner import run_apply
+            errored, _ = run_apply(drive, args, reporter=reporter)
+        elif args.command == "download":
+            errored = run_download(drive, args, reporter=reporter)
+        elif args.command == "sync":
+            errored, _, _ = run_sync(drive, args, reporter=reporter)
+        else:
+            errored, _ = run_upload(drive, args, reporter=reporter)
+    finally:
+        reporter.stop()
+        PATH_CACHE.commit()
+        print(METRICS.summary())
+
+    if args.command in ("download", "sync", "apply") and errored:
+        sys.exit(1)
 
     # upload_directory_fast(drive, "/home/piyush/research/dawnfellows/adv_maml", "/temp/adv_maml", get_file(drive, "/temp"))
 
@@ -0,0 +1,93 @@
+from pathlib import Path
+
+import os, sys
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).absolute().parent.parent))
+
+from fake_drive import FOLDER_MIME_TYPE, FakeDriveServer, FakeDriveStore, make_fake_drive
+from path_cache import PATH_CACHE
+
+@pytest.fixture
+def server():
+    """
+    A FakeDriveServer whose Drive holds an empty /bench folder.
+    """
+    store = FakeDriveStore()
+    store.add_folder("root", "bench")
+    PATH_CACHE.clear()
+    with FakeDriveServer(store) as server:
+        yield server
+    PATH_CACHE.clear()
+
+@pytest.fixture
+def drive_factory(server):
+    return lambda: make_fake_drive(server.url)
+
+@pytest.fixture
+def drive(drive_factory):
+    return drive_factory()
+
+@pytest.fixture
+def local_tree(tmp_path):
+    """
+    A small local tree to sync: a few nested folders of files with distinct contents.
+    """
+    root = tmp_path / "bench"
+    for d in range(3):
+        for s in range(2):
+            folder = root / ("d%i" % d) / ("s%i" % s)
+            folder.mkdir(parents=True)
+            for f in range(4):
+                (folder / ("f%i.txt" % f)).write_bytes(os.urandom(100 + 50 * f))
+    (root / "top.txt").write_text("top")
+    return root
+
+@pytest.fixture
+def make_args(tmp_path):
+    """
+    Returns a function parsing syncer arguments, with the state files in TMP_PATH and no request
+    pacing to speak of.
+    """
+    from syncer import make_parser
+
+    def make_args(*argv):
+        return make_parser().parse_args(list(argv) + [
+            "--journal", str(tmp_path / "journal.db"),
+            "--upload-state-dir", str(tmp_path / "upload_sessions"),
+            "--request-rate", "10000",
+        ])
+    return make_args
+
+def remote_files(store, folder_id="root", prefix=""):
+    """
+    Returns a dict of remote path -> metadata of everything under FOLDER_ID in STORE that isn't
+    trashed. Duplicate titles show up as a list of metadata under the one path.
+    """
+    files = {}
+    for metadata in list(store.files.values()):
+        if metadata["labels"]["trashed"] or \
+           store.resolve(folder_id) not in [parent["id"] for parent in metadata["parents"]]:
+            continue
+        path = prefix + "/" + metadata["title"]
+        if path in files:
+            existing = files[path]
+            files[path] = (existing if isinstance(existing, list) else [existing]) + [metadata]
+        else:
+            files[path] = metadata
+        if metadata["mimeType"] == FOLDER_MIME_TYPE:
+            files.update(remote_files(store, metadata["id"], path))
+    return files
+
+def local_files(root):
+    return {
+        "/" + path.relative_to(root).as_posix(): path.read_bytes()
+        for path in sorted(Path(root).rglob("*")) if path.is_file()
+    }
+
+@pytest.fixture
+def retry_policy():
+    from retry import RateLimiter, RetryPolicy
+
+    return RetryPolicy(3, base_delay=0.01, max_delay=0.1, rate_limiter=RateLimiter(10000.0, max_rate=10000.0))
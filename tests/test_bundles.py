@@ -0,0 +1,74 @@
+from conftest import local_files, remote_files
+
+from bundles import BUNDLE_SUFFIX, BundleUploader, read_index, restore
+
+import os
+
+def make_tree(root):
+    for d in range(4):
+        (root / ("pkg%i" % d)).mkdir(parents=True)
+        for f in range(10):
+            (root / ("pkg%i" % d) / ("mod%i.py" % f)).write_bytes(os.urandom(200 + 37 * f))
+    return root
+
+def make_uploader(drive_factory, retry_policy):
+    return BundleUploader(drive_factory, num_workers=2, bundle_size=4096, max_files=15, retry_policy=retry_policy,
+                          verbose=False)
+
+def bundle_titles(store):
+    return sorted(path.rpartition("/")[2] for path in remote_files(store) if "bundle-" in path)
+
+def test_round_trip(server, drive, drive_factory, retry_policy, tmp_path):
+    local_dir = make_tree(tmp_path / "local" / "code")
+    bundled, errored = make_uploader(drive_factory, retry_policy).run(tmp_path / "local", "/bench", ["code"])
+    assert errored == []
+    assert len(bundle_titles(server.store)) > 1
+
+    restored = restore(drive, "/bench/code" + BUNDLE_SUFFIX, tmp_path / "restored", verbose=False)
+    assert len(restored) == 40
+    assert local_files(tmp_path / "restored") == local_files(local_dir)
+
+    restore(drive, "/bench/code" + BUNDLE_SUFFIX, tmp_path / "pkg2", ["pkg2"], verbose=False)
+    assert sorted(local_files(tmp_path / "pkg2")) == ["/pkg2/mod%i.py" % f for f in range(10)]
+
+def test_unchanged_bundles_kept(server, drive, drive_factory, retry_policy, tmp_path):
+    local_dir = make_tree(tmp_path / "local" / "code")
+    make_uploader(drive_factory, retry_policy).run(tmp_path / "local", "/bench", ["code"])
+    before = bundle_titles(server.store)
+
+    (local_dir / "pkg3" / "mod9.py").write_bytes(b"changed")
+    uploader = make_uploader(drive_factory, retry_policy)
+    bundled, errored = uploader.run(tmp_path / "local", "/bench", ["code"])
+    assert errored == []
+    assert uploader.kept_bundles == len(before) - 1 and uploader.uploaded_bundles == 1
+
+    restore(drive, "/bench/code" + BUNDLE_SUFFIX, tmp_path / "restored", verbose=False)
+    assert local_files(tmp_path / "restored") == local_files(local_dir)
+
+def test_failed_bundle(server, drive, drive_factory, retry_policy, tmp_path, monkeypatch):
+    local_dir = make_tree(tmp_path / "local" / "code")
+    upload_bundle = BundleUploader.upload_bundle
+
+    def failing_upload_bundle(self, members, title, parent_id):
+        if title == "bundle-00001.tar":
+            raise ValueError("Failed on purpose")
+        return upload_bundle(self, members, title, parent_id)
+
+    monkeypatch.setattr(BundleUploader, "upload_bundle", failing_upload_bundle)
+    bundled, errored = make_uploader(drive_factory, retry_policy).run(tmp_path / "local", "/bench", ["code"])
+    assert [str(error) for _, _, error in errored] == ["Failed on purpose"]
+
+    # The bundles that did go up are in the index, which was written with them.
+    folder = remote_files(server.store)["/bench/code" + BUNDLE_SUFFIX]
+    index, _ = read_index(drive, folder)
+    uploaded = bundle_titles(server.store)
+    assert sorted(index.bundles) == uploaded and "bundle-00001.tar" not in uploaded
+    assert index.next_number == len(uploaded) + 1
+
+    monkeypatch.setattr(BundleUploader, "upload_bundle", upload_bundle)
+    bundled, errored = make_uploader(drive_factory, retry_policy).run(tmp_path / "local", "/bench", ["code"])
+    assert errored == []
+    titles = bundle_titles(server.store)
+    assert len(titles) == len(set(titles))
+    restore(drive, "/bench/code" + BUNDLE_SUFFIX, tmp_path / "restored", verbose=False)
+    assert local_files(tmp_path / "restored") == local_files(local_dir)
@@ -0,0 +1,67 @@
+from conftest import local_files
+
+from downloader import PARTIAL_SUFFIX, REVISION_SUFFIX, DownloadScheduler, revision_of
+from hashing import HashCache, md5_file
+
+import os
+
+def make_scheduler(drive_factory, retry_policy, hash_cache=None, chunk_size=1024):
+    return DownloadScheduler(drive_factory, num_workers=2, chunk_size=chunk_size, retry_policy=retry_policy,
+                             hash_cache=hash_cache, verbose=False)
+
+def add_remote_tree(store):
+    bench = [metadata for metadata in store.files.values() if metadata["title"] == "bench"][0]
+    folder = store.add_folder(bench["id"], "sub")
+    contents = {"/a.bin": os.urandom(5000), "/sub/b.bin": os.urandom(3000)}
+    store.add_file(bench["id"], "a.bin", contents["/a.bin"])
+    store.add_file(folder["id"], "b.bin", contents["/sub/b.bin"])
+    return contents
+
+def test_mirror(server, drive, drive_factory, retry_policy, tmp_path):
+    contents = add_remote_tree(server.store)
+    downloaded, errored = make_scheduler(drive_factory, retry_policy).mirror(drive, "/bench", tmp_path / "out")
+    assert errored == [] and len(downloaded) == 2
+    assert local_files(tmp_path / "out") == contents
+
+    # Everything is up to date the second time.
+    downloaded, errored = make_scheduler(drive_factory, retry_policy).mirror(drive, "/bench", tmp_path / "out")
+    assert (downloaded, errored) == ([], [])
+
+def test_resume_partial(server, drive, drive_factory, retry_policy, tmp_path):
+    contents = add_remote_tree(server.store)
+    a = [metadata for metadata in server.store.files.values() if metadata["title"] == "a.bin"][0]
+    out = tmp_path / "out"
+    out.mkdir()
+    (out / ("a.bin" + PARTIAL_SUFFIX)).write_bytes(contents["/a.bin"][ : 3072])
+    (out / ("a.bin" + REVISION_SUFFIX)).write_text(revision_of(a))
+
+    server.reset_stats()
+    downloaded, errored = make_scheduler(drive_factory, retry_policy).mirror(drive, "/bench", out)
+    assert errored == []
+    assert local_files(out) == contents
+    # Two chunks of a.bin were left to fetch, and three of b.bin.
+    assert server.stats()["files.get_media"] == 5
+
+def test_partial_of_other_revision(server, drive, drive_factory, retry_policy, tmp_path):
+    contents = add_remote_tree(server.store)
+    out = tmp_path / "out"
+    out.mkdir()
+    stale = os.urandom(3072)
+    (out / ("a.bin" + PARTIAL_SUFFIX)).write_bytes(stale)
+    (out / ("a.bin" + REVISION_SUFFIX)).write_text("an older revision")
+
+    hash_cache = HashCache()
+    downloaded, errored = make_scheduler(drive_factory, retry_policy, hash_cache).mirror(drive, "/bench", out)
+    assert errored == []
+    assert local_files(out) == contents
+    assert hash_cache.get(out / "a.bin") == md5_file(out / "a.bin")
+
+def test_partial_without_revision(server, drive, drive_factory, retry_policy, tmp_path):
+    contents = add_remote_tree(server.store)
+    out = tmp_path / "out"
+    out.mkdir()
+    (out / ("a.bin" + PARTIAL_SUFFIX)).write_bytes(os.urandom(3072))
+
+    downloaded, errored = make_scheduler(drive_factory, retry_policy).mirror(drive, "/bench", out)
+    assert errored == []
+    assert local_files(out) == contents
@@ -0,0 +1,37 @@
+from drivefs import DriveFS
+
+import os
+
+import pytest
+
+@pytest.fixture
+def fs(server, drive_factory, retry_policy, tmp_path):
+    bench = [metadata for metadata in server.store.files.values() if metadata["title"] == "bench"][0]
+    folder = server.store.add_folder(bench["id"], "media")
+    content = os.urandom(10 * 1024 + 123)
+    server.store.add_file(folder["id"], "clip.bin", content)
+    fs = DriveFS(drive_factory, "/bench", cache_dir=str(tmp_path / "cache"), chunk_size=1024, readahead=2,
+                 retry_policy=retry_policy)
+    fs.content = content
+    return fs
+
+def test_listing(fs):
+    assert fs.listdir("/") == ["media"]
+    assert fs.listdir("/media") == ["clip.bin"]
+    assert fs.isdir("/media") and not fs.isdir("/media/clip.bin")
+    with pytest.raises(FileNotFoundError):
+        fs.stat("/missing")
+    with pytest.raises(IsADirectoryError):
+        fs.open("/media")
+
+def test_read(server, fs):
+    with fs.open("/media/clip.bin") as f:
+        assert f.read() == fs.content
+        f.seek(5000)
+        assert f.read(3000) == fs.content[5000 : 8000]
+
+    # Every chunk is cached by now.
+    fetched = server.stats()["files.get_media"]
+    with fs.open("/media/clip.bin") as f:
+        assert f.read() == fs.content
+    assert server.stats()["files.get_media"] == fetched
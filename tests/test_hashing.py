@@ -0,0 +1,23 @@
+from hashing import HashCache, hash_files, md5_file
+
+import hashlib
+
+def test_hash_files(tmp_path, capsys):
+    paths = []
+    for i in range(5):
+        path = tmp_path / ("%i.bin" % i)
+        path.write_bytes(bytes([i]) * (1000 * i))
+        paths.append(path)
+
+    cache = HashCache(tmp_path / "hashes.db")
+    hashes = hash_files(paths, cache, workers=2)
+    assert hashes == {path: hashlib.md5(path.read_bytes()).hexdigest() for path in paths}
+    assert all(cache.get(path) == md5_file(path) for path in paths)
+
+    # Progress is only redrawn on a terminal; a log gets the one line.
+    assert capsys.readouterr().out == "Hashed 5 files\n"
+
+    paths[0].write_bytes(b"changed")
+    hashes = hash_files(paths, cache, workers=2)
+    assert hashes[paths[0]] == hashlib.md5(b"changed").hexdigest()
+    assert capsys.readouterr().out == "Hashed 1 files\n"
@@ -0,0 +1,102 @@
+from conftest import local_files, remote_files
+
+from local_index import LocalIndex
+from path_cache import PATH_CACHE
+from syncer import run_upload
+from uploader import UploadScheduler
+
+def make_tree(root):
+    for name in ("a", "b"):
+        (root / name).mkdir(parents=True)
+        (root / name / "f.txt").write_text(name)
+    return root
+
+def test_unchanged_directories_skipped(tmp_path):
+    root = make_tree(tmp_path / "tree")
+    index = LocalIndex(tmp_path / "index.db")
+    scan = index.scan(root)
+    assert scan.dirty == {"", "a", "b"}
+    index.commit(scan)
+
+    scan = index.scan(root)
+    assert scan.dirty == set() and not scan.needs_visit(root)
+
+    (root / "b" / "new.txt").write_text("new")
+    scan = index.scan(root)
+    assert scan.dirty == {"b"} and scan.changed_files == {"b/new.txt"}
+    assert scan.needs_visit(root) and scan.needs_visit(root / "b") and not scan.needs_visit(root / "a")
+    assert [entry[0] for entry in scan.list_dir(root / "a")] == ["f.txt"]
+
+def test_failed_dirs_stay_dirty(tmp_path):
+    root = make_tree(tmp_path / "tree")
+    index = LocalIndex(tmp_path / "index.db")
+    index.commit(index.scan(root))
+
+    (root / "a" / "new.txt").write_text("new")
+    (root / "b" / "new.txt").write_text("new")
+    index.commit(index.scan(root), failed_dirs=[root / "a"])
+    assert index.scan(root).dirty == {"", "a"}
+
+def upload(drive, drive_factory, make_args, local_tree, tmp_path, *argv):
+    args = make_args("upload", "--local", str(local_tree), "--remote", "/bench",
+                     "--local-index", str(tmp_path / "index.db"), *argv)
+    return run_upload(drive, args, drive_factory=drive_factory)
+
+def test_rerun_with_local_index(server, drive, drive_factory, make_args, local_tree, tmp_path):
+    errored, _ = upload(drive, drive_factory, make_args, local_tree, tmp_path)
+    assert errored == []
+
+    (local_tree / "d1" / "s0" / "new.txt").write_text("new")
+    (local_tree / "d2" / "added").mkdir()
+    (local_tree / "d2" / "added" / "deep.txt").write_text("deep")
+    errored, created = upload(drive, drive_factory, make_args, local_tree, tmp_path)
+    assert errored == []
+    assert sorted(drive_file["title"] for drive_file in created) == ["added", "deep.txt", "new.txt"]
+
+    remote = remote_files(server.store)
+    for path in local_files(local_tree):
+        assert not isinstance(remote["/bench" + path], list), path
+
+def test_unchanged_directory_missing_remotely(server, drive, drive_factory, make_args, local_tree, tmp_path):
+    errored, _ = upload(drive, drive_factory, make_args, local_tree, tmp_path)
+    assert errored == []
+
+    # The folder goes away on Drive while nothing under it changes locally.
+    folder = remote_files(server.store)["/bench/d0"]
+    server.store.trash(folder["id"])
+    (local_tree / "added.txt").write_text("added")
+    # A new process doesn't know where the folder used to be.
+    PATH_CACHE.clear()
+    errored, _ = upload(drive, drive_factory, make_args, local_tree, tmp_path)
+    assert errored == []
+
+    remote = remote_files(server.store)
+    for path in local_files(local_tree):
+        assert "/bench" + path in remote, path
+
+def test_failed_upload_under_unchanged_directory(server, drive, drive_factory, make_args, local_tree, tmp_path,
+                                                 monkeypatch):
+    upload(drive, drive_factory, make_args, local_tree, tmp_path)
+    server.store.trash(remote_files(server.store)["/bench/d0"]["id"])
+    (local_tree / "added.txt").write_text("added")
+    PATH_CACHE.clear()
+
+    send = UploadScheduler.send
+
+    def failing_send(self, local_path, *args):
+        if local_path.name == "f1.txt":
+            raise ValueError("Failed on purpose")
+        return send(self, local_path, *args)
+
+    monkeypatch.setattr(UploadScheduler, "send", failing_send)
+    errored, _ = upload(drive, drive_factory, make_args, local_tree, tmp_path)
+    assert sorted(local_path.relative_to(local_tree).as_posix() for local_path, _, _ in errored) == \
+        ["d0/s0/f1.txt", "d0/s1/f1.txt"]
+
+    # Nothing changed locally since, but the failed files are tried again.
+    monkeypatch.setattr(UploadScheduler, "send", send)
+    errored, _ = upload(drive, drive_factory, make_args, local_tree, tmp_path)
+    assert errored == []
+    remote = remote_files(server.store)
+    for path in local_files(local_tree):
+        assert "/bench" + path in remote, path
@@ -0,0 +1,33 @@
+from path_cache import COMMIT_INTERVAL, PathCache
+
+import sqlite3
+
+def persisted(db_path):
+    with sqlite3.connect(str(db_path)) as db:
+        return db.execute("SELECT COUNT(*) FROM paths").fetchone()[0]
+
+def test_commits_in_batches(tmp_path):
+    db_path = tmp_path / "paths.db"
+    cache = PathCache(db_path, "account")
+    folder = {"id": "id", "title": "title", "mimeType": "application/vnd.google-apps.folder", "labels": {}}
+    for i in range(COMMIT_INTERVAL - 1):
+        cache.put("/a/%i" % i, folder)
+    assert persisted(db_path) == 0
+
+    cache.put("/b", folder)
+    assert persisted(db_path) == COMMIT_INTERVAL
+    cache.put("/c", folder)
+    cache.commit()
+    assert persisted(db_path) == COMMIT_INTERVAL + 1
+
+def test_reload(tmp_path):
+    db_path = tmp_path / "paths.db"
+    cache = PathCache(db_path, "account")
+    cache.put("/a", {"id": "a", "title": "a", "labels": {}})
+    cache.put("/gone", None)
+    cache.close()
+
+    cache = PathCache(db_path, "account")
+    assert cache.lookup("/a") == (True, {"id": "a", "title": "a"})
+    assert cache.lookup("/gone") == (False, None)
+    assert PathCache(db_path, "other account").lookup("/a") == (False, None)
@@ -0,0 +1,68 @@
+from conftest import local_files, remote_files
+
+from journal import Journal, PLANNED
+from planner import load_plan, run_apply, run_plan
+
+def make_plan(drive, make_args, local_tree, tmp_path):
+    plan_file = str(tmp_path / "plan.json.gz")
+    run_plan(drive, make_args("plan", "--local", str(local_tree), "--remote", "/bench", "--plan-file", plan_file))
+    return plan_file
+
+def apply(drive, drive_factory, make_args, plan_file):
+    return run_apply(drive, make_args("apply", "--plan-file", plan_file), drive_factory=drive_factory)
+
+def test_plan_changes_nothing(server, drive, make_args, local_tree, tmp_path):
+    plan_file = make_plan(drive, make_args, local_tree, tmp_path)
+    assert list(remote_files(server.store)) == ["/bench"]
+    assert "files.insert" not in server.stats()
+
+    plan = load_plan(plan_file)
+    assert len([entry for entry in plan.uploads if entry[2] is not None]) == len(local_files(local_tree))
+    assert plan.folders == ["/bench/d0", "/bench/d1", "/bench/d2"] + [
+        "/bench/d%i/s%i" % (d, s) for d in range(3) for s in range(2)]
+    assert plan.estimate["calls"]["files.insert"] == len(local_files(local_tree))
+
+def test_apply(server, drive, drive_factory, make_args, local_tree, tmp_path):
+    plan_file = make_plan(drive, make_args, local_tree, tmp_path)
+    errored, _ = apply(drive, drive_factory, make_args, plan_file)
+    assert errored == []
+
+    remote = remote_files(server.store)
+    for path, content in local_files(local_tree).items():
+        assert server.store.read(remote["/bench" + path]["id"]) == content
+
+def test_apply_twice(server, drive, drive_factory, make_args, local_tree, tmp_path):
+    plan_file = make_plan(drive, make_args, local_tree, tmp_path)
+    apply(drive, drive_factory, make_args, plan_file)
+    inserts = server.stats()["files.insert"]
+
+    errored, created = apply(drive, drive_factory, make_args, plan_file)
+    assert (errored, created) == ([], [])
+    assert server.stats()["files.insert"] == inserts
+    assert not any(isinstance(metadata, list) for metadata in remote_files(server.store).values())
+
+def test_apply_resumes(server, drive, drive_factory, make_args, local_tree, tmp_path):
+    plan_file = make_plan(drive, make_args, local_tree, tmp_path)
+    apply(drive, drive_factory, make_args, plan_file)
+
+    # As if the first apply had been interrupted before these two went up.
+    journal = Journal(str(tmp_path / "journal.db"))
+    journal.db.execute("UPDATE items SET state = ? WHERE path IN (?, ?)", (PLANNED, "top.txt", "d1/s0/f2.txt"))
+    journal.db.commit()
+    for path in ("/bench/top.txt", "/bench/d1/s0/f2.txt"):
+        server.store.delete(remote_files(server.store)[path]["id"])
+
+    errored, created = apply(drive, drive_factory, make_args, plan_file)
+    assert errored == []
+    assert sorted(drive_file["title"] for drive_file in created) == ["f2.txt", "top.txt"]
+    remote = remote_files(server.store)
+    assert not any(isinstance(metadata, list) for metadata in remote.values())
+    assert set("/bench" + path for path in local_files(local_tree)) <= set(remote)
+
+def test_apply_skips_changed_files(server, drive, drive_factory, make_args, local_tree, tmp_path):
+    plan_file = make_plan(drive, make_args, local_tree, tmp_path)
+    (local_tree / "top.txt").write_text("changed since")
+
+    errored, _ = apply(drive, drive_factory, make_args, plan_file)
+    assert [str(local_path) for local_path, _, _ in errored] == [str(local_tree / "top.txt")]
+    assert "/bench/top.txt" not in remote_files(server.store)
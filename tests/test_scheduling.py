@@ -0,0 +1,53 @@
+from retry import RateLimiter, RetryPolicy
+from scheduling import FifoPolicy, LargeFileLanesPolicy, SimulatedDrive, SizeOrderPolicy, estimate_makespan
+from syncer import UploadItem
+from uploader import UploadScheduler
+
+def push_all(policy, sizes):
+    for size in sizes:
+        policy.push(size, size)
+    return policy
+
+def test_order():
+    for policy, order in [(FifoPolicy(), [3, 1, 2]), (SizeOrderPolicy(), [1, 2, 3]),
+                          (SizeOrderPolicy(largest_first=True), [3, 2, 1])]:
+        push_all(policy, [3, 1, 2])
+        assert [policy.pop([]) for _ in order] == order, policy.name
+
+def test_lanes():
+    policy = push_all(LargeFileLanesPolicy(large_threshold=100, large_lanes=1), [90, 120, 90, 150, 90])
+    assert policy.pop([]) == 150
+    # Small files go through the other workers while the lane is busy, however many bytes are queued
+    # in large files.
+    assert [policy.pop([150]) for _ in range(4)] == [90, 90, 90, 120]
+    assert len(policy) == 0
+
+def test_estimate_makespan():
+    assert estimate_makespan([10] * 4, FifoPolicy(), 2, file_overhead=1, bytes_per_second=10) == 4.0
+
+    # Starting the large file first hides the small ones behind it.
+    sizes = [10] * 10 + [1000]
+    lanes = estimate_makespan(sizes, LargeFileLanesPolicy(large_threshold=100), 2, 0, 10)
+    smallest = estimate_makespan(sizes, SizeOrderPolicy(), 2, 0, 10)
+    assert (lanes, smallest) == (100.0, 105.0)
+
+def test_simulated_drive(tmp_path):
+    items = []
+    for i, size in enumerate([10, 2000, 30]):
+        (tmp_path / ("file%i" % i)).write_bytes(bytes(size))
+        items.append(UploadItem("root", "file%i" % i, size))
+
+    drive = SimulatedDrive(file_overhead=0, bytes_per_second=1e9)
+    scheduler = UploadScheduler(
+        lambda: drive, num_workers=2, batch_folders=False,
+        retry_policy=RetryPolicy(rate_limiter=RateLimiter(rate=1e6, max_rate=1e6)),
+        policy=LargeFileLanesPolicy(large_threshold=1000), verbose=False)
+    uploaded, errored = scheduler.run(str(tmp_path), "/benchmark", items)
+    assert (uploaded, errored) == (3, [])
+
+def test_lanes_capped_while_small_files_queued():
+    policy = push_all(LargeFileLanesPolicy(large_threshold=100, large_lanes=2), [1000, 900, 800, 10, 10])
+    assert [policy.pop([]), policy.pop([1000])] == [1000, 900]
+    assert [policy.pop([1000, 900]), policy.pop([1000, 900, 10])] == [10, 10]
+    # With no small file left, large ones take any free worker.
+    assert policy.pop([1000, 900]) == 800
@@ -0,0 +1,48 @@
+from conftest import local_files, remote_files
+
+from hashing import HashCache
+from sync_jobs import load_jobs, run_jobs
+
+import os, threading
+
+JOB_FILE = """
+workers: 4
+request_rate: 10000
+defaults:
+  command: download
+  hash_cache: %(state)s/hash_cache.db
+jobs:
+  - name: one
+    local: %(local)s/one
+    remote: /bench/one
+  - name: two
+    local: %(local)s/two
+    remote: /bench/two
+"""
+
+def test_jobs_sharing_hash_cache(server, drive, tmp_path, monkeypatch):
+    bench = remote_files(server.store)["/bench"]
+    contents = {}
+    for name in ("one", "two"):
+        folder = server.store.add_folder(bench["id"], name)
+        contents[name] = {"/%i.bin" % i: os.urandom(1000 + i) for i in range(10)}
+        for path, content in contents[name].items():
+            server.store.add_file(folder["id"], path[1 : ], content)
+    (tmp_path / "state").mkdir()
+    job_file = tmp_path / "jobs.yaml"
+    job_file.write_text(JOB_FILE % {"state": tmp_path / "state", "local": tmp_path / "local"})
+
+    # Neither job commits its hashes before the other has hashed everything too, as with two big
+    # jobs running side by side.
+    commit, barrier = HashCache.commit, threading.Barrier(2, timeout=10)
+
+    def commit_together(cache):
+        barrier.wait()
+        commit(cache)
+
+    monkeypatch.setattr(HashCache, "commit", commit_together)
+    shared, jobs = load_jobs(job_file)
+    failed, errored = run_jobs(drive, shared, jobs)
+    assert (failed, errored) == ({}, {"one": 0, "two": 0})
+    for name in ("one", "two"):
+        assert local_files(tmp_path / "local" / name) == contents[name]
@@ -0,0 +1,134 @@
+from conftest import local_files, remote_files
+
+from fake_drive import FaultInjector
+from journal import Journal, PLANNED
+from resumable import CHUNK_ALIGNMENT, upload_file_resumable
+from syncer import UploadItem, get_file, get_missing_remote_files, run_upload
+
+import os
+
+import pytest
+
+def upload(drive, drive_factory, make_args, local_tree, *argv):
+    args = make_args("upload", "--local", str(local_tree), "--remote", "/bench", *argv)
+    return run_upload(drive, args, drive_factory=drive_factory)
+
+def test_resume_interrupted_diff(server, drive, drive_factory, make_args, local_tree, tmp_path):
+    # As if a run had crashed with only the first item of its streamed diff planned.
+    journal = Journal(str(tmp_path / "journal.db"))
+    run_id = journal.start_run(local_tree, "/bench")
+    journal.plan([UploadItem(remote_files(server.store)["/bench"]["id"], "top.txt", 3)])
+    journal.close()
+
+    errored, _ = upload(drive, drive_factory, make_args, local_tree)
+    assert errored == []
+    remote = remote_files(server.store)
+    for path in local_files(local_tree):
+        assert "/bench" + path in remote, path
+
+    journal = Journal(str(tmp_path / "journal.db"))
+    assert journal.find_unfinished_run(local_tree, "/bench") is None
+    assert journal.db.execute("SELECT COUNT(*) FROM items WHERE run = ?", (run_id,)).fetchone()[0] == \
+        len(local_files(local_tree))
+
+def assert_mirrored(store, local_tree):
+    remote = remote_files(store)
+    for path, content in local_files(local_tree).items():
+        metadata = remote["/bench" + path]
+        assert not isinstance(metadata, list), path
+        assert store.read(metadata["id"]) == content, path
+
+def test_upload(server, drive, drive_factory, make_args, local_tree):
+    errored, created = upload(drive, drive_factory, make_args, local_tree)
+    assert errored == []
+    assert_mirrored(server.store, local_tree)
+
+    # Nothing is missing the second time.
+    errored, created = upload(drive, drive_factory, make_args, local_tree)
+    assert (errored, created) == ([], [])
+
+def test_upload_with_errors(server, drive, drive_factory, local_tree, tmp_path):
+    from retry import RateLimiter, RetryPolicy
+    from uploader import UploadScheduler
+
+    to_upload = get_missing_remote_files(drive, local_tree, "/bench", get_file(drive, "/bench"))
+    server.faults = FaultInjector(error_rate=0.2, seed=1)
+    scheduler = UploadScheduler(
+        drive_factory, num_workers=4, state_dir=str(tmp_path / "upload_sessions"), verbose=False,
+        retry_policy=RetryPolicy(10, base_delay=0.01, max_delay=0.1, rate_limiter=RateLimiter(10000.0)))
+    uploaded, errored = scheduler.run(local_tree, "/bench", to_upload)
+    assert errored == []
+    assert sum(scheduler.retry_policy.metrics.retries.values()) > 0
+    server.faults = FaultInjector()
+    assert_mirrored(server.store, local_tree)
+
+def test_compare_md5(server, drive, drive_factory, make_args, local_tree):
+    upload(drive, drive_factory, make_args, local_tree)
+
+    (local_tree / "d0" / "s0" / "f0.txt").write_bytes(b"new content")
+    os.rename(str(local_tree / "d1" / "s1" / "f3.txt"), str(local_tree / "d2" / "moved.txt"))
+    inserts = server.stats()["files.insert"]
+    errored, _ = upload(drive, drive_factory, make_args, local_tree, "--compare", "md5")
+    assert errored == []
+    # Updated in place and moved server side, rather than uploaded again.
+    assert server.stats()["files.insert"] == inserts
+    assert_mirrored(server.store, local_tree)
+
+def test_resume_interrupted_run(server, drive, drive_factory, make_args, local_tree, tmp_path):
+    upload(drive, drive_factory, make_args, local_tree)
+
+    # As if the run had been killed before these two went up.
+    journal = Journal(str(tmp_path / "journal.db"))
+    journal.db.execute("UPDATE runs SET finished = NULL")
+    journal.db.execute("UPDATE items SET state = ? WHERE path IN (?, ?)", (PLANNED, "top.txt", "d2/s1/f0.txt"))
+    journal.db.commit()
+    for path in ("/bench/top.txt", "/bench/d2/s1/f0.txt"):
+        server.store.delete(remote_files(server.store)[path]["id"])
+
+    errored, created = upload(drive, drive_factory, make_args, local_tree)
+    assert errored == []
+    assert sorted(drive_file["title"] for drive_file in created) == ["f0.txt", "top.txt"]
+    assert_mirrored(server.store, local_tree)
+
+def test_resumable_upload_resumes(server, drive, tmp_path):
+    source = tmp_path / "big.bin"
+    content = os.urandom(4 * CHUNK_ALIGNMENT + 1000)
+    source.write_bytes(content)
+    bench = get_file(drive, "/bench")
+
+    def interrupt(num_bytes):
+        raise ConnectionResetError("Interrupted on purpose")
+
+    with pytest.raises(ConnectionResetError):
+        upload_file_resumable(drive, source, "/bench/big.bin", bench, chunk_size=CHUNK_ALIGNMENT,
+                              state_dir=str(tmp_path / "sessions"), on_chunk=interrupt)
+
+    drive_file = upload_file_resumable(drive, source, "/bench/big.bin", bench, chunk_size=CHUNK_ALIGNMENT,
+                                       state_dir=str(tmp_path / "sessions"))
+    assert server.store.read(drive_file["id"]) == content
+    # One session, and no chunk sent twice.
+    assert server.stats()["resumable.start"] == 1
+    assert server.stats()["resumable.chunk"] == 1 + 5
+    assert list((tmp_path / "sessions").iterdir()) == []
+
+def test_resumable_session_of_other_target(server, drive, tmp_path):
+    source = tmp_path / "big.bin"
+    content = os.urandom(4 * CHUNK_ALIGNMENT + 1000)
+    source.write_bytes(content)
+    bench = get_file(drive, "/bench")
+    server.store.add_folder(bench["id"], "other")
+    other = get_file(drive, "/bench/other")
+
+    def interrupt(num_bytes):
+        raise ConnectionResetError("Interrupted on purpose")
+
+    with pytest.raises(ConnectionResetError):
+        upload_file_resumable(drive, source, "/bench/big.bin", bench, chunk_size=CHUNK_ALIGNMENT,
+                              state_dir=str(tmp_path / "sessions"), on_chunk=interrupt)
+
+    # The same file going somewhere else doesn't pick up the session of the first upload.
+    drive_file = upload_file_resumable(drive, source, "/bench/other/big.bin", other, chunk_size=CHUNK_ALIGNMENT,
+                                       state_dir=str(tmp_path / "sessions"))
+    assert server.store.read(drive_file["id"]) == content
+    assert [parent["id"] for parent in drive_file["parents"]] == [other["id"]]
+    assert server.stats()["resumable.start"] == 2
@@ -0,0 +1,225 @@
+from argparse import ArgumentParser
+
+import re, threading, time
+
+from metrics import METRICS
+
+# Throttled transfers are cut into pieces of about this many seconds' worth of bytes, so a chunk
+# never goes out in one long burst at line rate.
+PACING_SECONDS = 1.0
+MIN_CHUNK_SIZE = 64 * 1024
+
+RATE_UNITS = {
+    "b": 1, "kb": 1024, "mb": 1024 ** 2, "gb": 1024 ** 3,
+    "bit": 1 / 8, "kbit": 1000 / 8, "mbit": 1000 ** 2 / 8, "gbit": 1000 ** 3 / 8,
+}
+
+def parse_rate(spec):
+    """
+    Parses a rate such as "10Mbit", "500KB" or "1.5MB/s" into bytes per second. Bit units are
+    decimal, as network links are, while byte units are binary. "unlimited" gives None.
+    """
+    spec = spec.strip().lower()
+    if spec in ("unlimited", "none"):
+        return None
+    match = re.match(r"^(\d+(?:\.\d+)?)\s*([kmg]?(?:bit|b))?(?:/s|ps)?$", spec)
+    if match is None:
+        raise ValueError("Can't parse rate %s" % spec)
+    return float(match.group(1)) * RATE_UNITS[match.group(2) or "b"]
+
+def parse_time_of_day(spec):
+    hours, minutes = spec.split(":")
+    if not (0 <= int(hours) <= 24 and 0 <= int(minutes) < 60):
+        raise ValueError("Can't parse time of day %s" % spec)
+    return int(hours) * 60 + int(minutes)
+
+class BandwidthSchedule:
+    """
+    Bandwidth cap that depends on the time of day. WINDOWS is a list of (start minute, end minute,
+    bytes per second or None for no cap) triples, where a window whose end comes before its start
+    wraps around midnight. Outside every window, DEFAULT_RATE applies.
+    """
+
+    def __init__(self, windows=(), default_rate=None):
+        self.windows = list(windows)
+        self.default_rate = default_rate
+
+    def rate_at(self, local_time):
+        minute = local_time.tm_hour * 60 + local_time.tm_min
+        for start, end, rate in self.windows:
+            if (start <= minute < end) if start <= end else (minute >= start or minute < end):
+                return rate
+        return self.default_rate
+
+def parse_schedule(spec):
+    """
+    Parses a comma-separated schedule such as "09:00-18:00=10Mbit,unlimited" (10 Mbit/s during
+    business hours, no cap otherwise). A bare rate is the default outside every window; a single
+    bare rate is a constant cap.
+    """
+    schedule = BandwidthSchedule()
+    for entry in spec.split(","):
+        if "=" in entry:
+            window, rate = entry.split("=", 1)
+            start, end = window.split("-")
+            schedule.windows.append((parse_time_of_day(start), parse_time_of_day(end), parse_rate(rate)))
+        else:
+            schedule.default_rate = parse_rate(entry)
+    return schedule
+
+class TokenBucket:
+    """
+    Lets through RATE bytes per second on average, with bursts of up to BURST bytes. Callers reserve
+    bytes and are told how long to wait; reservations can run the bucket into debt, which is what
+    keeps the total right however many threads are drawing from it.
+    """
+
+    def __init__(self, rate=None, burst=None):
+        self.lock = threading.Lock()
+        self.rate, self.burst = None, None
+        self.tokens, self.updated = 0, time.monotonic()
+        self.set_rate(rate, burst)
+
+    def set_rate(self, rate, burst=None):
+        with self.lock:
+            if rate == self.rate:
+                return
+            self.rate = rate
+            self.burst = burst if burst is not None else (rate * PACING_SECONDS if rate is not None else None)
+            # Start empty, so a fresh limit doesn't open with a burst over its rate.
+            self.tokens, self.updated = 0, time.monotonic()
+
+    def reserve(self, num_bytes):
+        """
+        Takes NUM_BYTES out of the bucket. Returns how many seconds to wait before sending them.
+        """
+        with self.lock:
+            if self.rate is None:
+                return 0
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= num_bytes
+            return max(0, -self.tokens / self.rate)
+
+class Throttle:
+    """
+    Bandwidth limit for every transfer sharing this object, following SCHEDULE (a BandwidthSchedule;
+    no cap if None). Bytes also count against PARENT if given, so a job can have its own limit
+    inside a global one.
+    """
+
+    def __init__(self, schedule=None, parent=None, clock=time.localtime):
+        self.schedule = schedule
+        self.parent = parent
+        self.clock = clock
+        self.bucket = TokenBucket()
+
+        self.lock = threading.Lock()
+        self.consumed = 0
+        self.waited = 0.0
+
+    def rate(self):
+        if self.schedule is None:
+            return None
+        rate = self.schedule.rate_at(self.clock())
+        self.bucket.set_rate(rate)
+        return rate
+
+    def effective_rate(self):
+        rates = [rate for rate in (self.rate(), self.parent.effective_rate() if self.parent else None) if rate]
+        return min(rates) if rates else None
+
+    def reserve(self, num_bytes):
+        self.rate()
+        delay = self.bucket.reserve(num_bytes)
+        if self.parent is not None:
+            delay = max(delay, self.parent.reserve(num_bytes))
+        return delay
+
+    def consume(self, num_bytes):
+        """
+        Blocks until NUM_BYTES may be sent (or have been received).
+        """
+        delay = self.reserve(num_bytes)
+        with self.lock:
+            self.consumed += num_bytes
+            self.waited += delay
+        METRICS.inc("throttle_wait_seconds_total", delay)
+        if delay > 0:
+            time.sleep(delay)
+
+    def chunk_size(self, chunk_size, alignment=1):
+        """
+        Shrinks CHUNK_SIZE to about PACING_SECONDS worth of the current rate, keeping it a multiple
+        of ALIGNMENT.
+        """
+        rate = self.effective_rate()
+        if rate is None:
+            return chunk_size
+        paced = max(MIN_CHUNK_SIZE, alignment, int(rate * PACING_SECONDS))
+        return max(alignment, min(chunk_size, paced - paced % alignment))
+
+def make_throttle(spec, parent=None):
+    """
+    Returns a Throttle following the schedule SPEC (see parse_schedule) inside PARENT, or PARENT
+    itself if there's no SPEC.
+    """
+    if spec is None:
+        return parent
+    return Throttle(parse_schedule(spec), parent)
+
+class ThrottledReader:
+    """
+    File object wrapper whose reads are paced by THROTTLE. Everything else, seeking included, goes
+    straight to the underlying file, so it can stand in for it as an upload body. A single big read
+    is paced as a whole, so callers that read in small pieces get the smoothest traffic.
+    """
+
+    def __init__(self, raw, throttle):
+        self.raw = raw
+        self.throttle = throttle
+
+    def read(self, size=-1):
+        data = self.raw.read(size)
+        self.throttle.consume(len(data))
+        return data
+
+    def seek(self, offset, whence=0):
+        return self.raw.seek(offset, whence)
+
+    def tell(self):
+        return self.raw.tell()
+
+    def close(self):
+        return self.raw.close()
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Check how closely a throttle holds its rate under concurrent workers")
+    parser.add_argument("--rate", default="10Mbit")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=5.0)
+    parser.add_argument("--piece-size", type=int, default=256 * 1024)
+    args = parser.parse_args()
+
+    throttle = Throttle(parse_schedule(args.rate))
+    started = time.monotonic()
+
+    def work():
+        while time.monotonic() - started < args.seconds:
+            throttle.consume(args.piece_size)
+
+    threads = [threading.Thread(target=work) for _ in range(args.workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # The last pieces were paid for up front, so count the time they were waited for.
+    elapsed = max(time.monotonic() - started, 1e-6)
+    target = throttle.effective_rate()
+    print("Target %.0f B/s, achieved %.0f B/s (%.1f%%) over %.1fs with %i workers" % (
+        target, throttle.consumed / elapsed, 100 * throttle.consumed / elapsed / target, elapsed, args.workers))
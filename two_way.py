@@ -0,0 +1,420 @@
+from collections import namedtuple
+from pathlib import Path
+
+from snapshot import FOLDER_MIME_TYPE
+
+import calendar, os, sqlite3, time
+
+POLICIES = ["local", "remote", "newer", "keep-both", "skip"]
+
+# Conflict kinds: both sides changed (or were both added) with different contents, or one side
+# deleted a file the other modified.
+BOTH_CHANGED, DELETED_LOCALLY, DELETED_REMOTELY = "both changed", "deleted locally", "deleted remotely"
+
+class Baseline:
+    """
+    SQLite record of every file as it stood after the last successful two-way sync of a pair of
+    roots: its path relative to them, MD5, local size and mtime, and remote modifiedDate and id.
+    Comparing each side with it tells which side changed a file, and so which way it should go.
+    """
+
+    def __init__(self, db_path):
+        self.db = sqlite3.connect(str(db_path))
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS baseline ("
+            "local_root TEXT, remote_root TEXT, path TEXT, md5 TEXT, size INTEGER, mtime_ns INTEGER, "
+            "modified_date TEXT, file_id TEXT, PRIMARY KEY (local_root, remote_root, path))")
+        self.db.commit()
+
+    def load(self, local_root, remote_root):
+        """
+        Returns a dict of relative path -> BaselineEntry for the pair of roots.
+        """
+        return {
+            row[0]: BaselineEntry(*row) for row in self.db.execute(
+                "SELECT path, md5, size, mtime_ns, modified_date, file_id FROM baseline "
+                "WHERE local_root = ? AND remote_root = ?",
+                (str(Path(local_root).absolute()), str(remote_root)))
+        }
+
+    def record(self, local_root, remote_root, entry):
+        self.db.execute(
+            "INSERT OR REPLACE INTO baseline VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (str(Path(local_root).absolute()), str(remote_root)) + tuple(entry))
+
+    def forget(self, local_root, remote_root, path):
+        self.db.execute(
+            "DELETE FROM baseline WHERE local_root = ? AND remote_root = ? AND path = ?",
+            (str(Path(local_root).absolute()), str(remote_root), path))
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+# A file as of the last sync. SIZE and MTIME_NS are the local file's, MODIFIED_DATE and FILE_ID the
+# remote one's; MD5 is the content both had.
+BaselineEntry = namedtuple(
+    "BaselineEntry", ["path", "md5", "size", "mtime_ns", "modified_date", "file_id"], defaults=(None, None))
+
+def parse_drive_time(value):
+    """
+    Returns the RFC 3339 time VALUE (e.g. a modifiedDate) in seconds since the epoch.
+    """
+    # Drive always gives UTC, as in 2024-05-01T09:30:00.123Z.
+    return calendar.timegm(time.strptime(value[ : 19], "%Y-%m-%dT%H:%M:%S")) + float(value[19 : ].rstrip("Z") or 0)
+
+def scan_local(local_root, workers=None):
+    """
+    Returns a dict of path relative to LOCAL_ROOT -> (size, mtime_ns) for every file under it, and
+    the set of relative paths of its directories, read by WORKERS threads (see scanner.py).
+    Partial downloads are left out.
+    """
+    from downloader import PARTIAL_SUFFIX
+    from scanner import DEFAULT_SCAN_WORKERS, scan
+
+    files, dirs = {}, set()
+    for entry in scan(local_root, workers or DEFAULT_SCAN_WORKERS):
+        if entry.is_dir:
+            dirs.add(entry.path)
+        elif not entry.path.endswith(PARTIAL_SUFFIX):
+            files[entry.path] = (entry.size, entry.mtime_ns)
+    return files, dirs
+
+def scan_remote(snapshot, remote_root):
+    """
+    Returns a 3-tuple of dicts of path relative to REMOTE_ROOT -> metadata, read from SNAPSHOT: (1)
+    files with binary content, (2) folders, including REMOTE_ROOT itself as "", and (3) files
+    without binary content (e.g. Google Docs), which two-way sync leaves alone.
+    """
+    drive_dir = snapshot.get_file(remote_root)
+    if drive_dir is None or drive_dir["mimeType"] != FOLDER_MIME_TYPE:
+        raise ValueError("Remote path %s is not a folder" % str(remote_root))
+
+    files, folders, others = {}, {"": drive_dir}, {}
+    for child_path, drive_file in snapshot.walk(drive_dir, "/"):
+        rel_path = child_path.relative_to("/").as_posix()
+        if drive_file["mimeType"] == FOLDER_MIME_TYPE:
+            folders[rel_path] = drive_file
+        elif drive_file.get("md5Checksum") is None:
+            others[rel_path] = drive_file
+        else:
+            files[rel_path] = drive_file
+    return files, folders, others
+
+class SyncPlan:
+    """
+    What a two-way sync will do, by path relative to the roots. UPLOADS are new remote files,
+    UPDATES (path, drive file) pairs to replace the content of, DOWNLOADS (path, drive file) pairs,
+    DELETE_LOCAL and TRASH_REMOTE (path, drive file) pairs files deleted on the other side, and
+    RENAMES (path, conflict copy path) pairs of local files set aside under a new name (which is
+    then uploaded) to make way for the remote version. FORGET holds paths gone from both sides and
+    RECORD (path, drive file) pairs already alike on both, whose baseline only needs updating.
+    CONFLICTS are (path, kind, resolution) triples and SKIPPED (path, reason) pairs.
+    """
+
+    def __init__(self):
+        self.uploads, self.updates, self.downloads = [], [], []
+        self.delete_local, self.trash_remote, self.renames = [], [], []
+        self.forget, self.record = [], []
+        self.conflicts, self.skipped = [], []
+
+    def is_empty(self):
+        return not (self.uploads or self.updates or self.downloads or self.delete_local or self.trash_remote)
+
+    def summary(self):
+        return "%i to upload, %i to update, %i to download, %i to delete locally, %i to trash remotely, " \
+               "%i conflicts, %i skipped" % (
+                   len(self.uploads), len(self.updates), len(self.downloads), len(self.delete_local),
+                   len(self.trash_remote), len(self.conflicts), len(self.skipped))
+
+def conflict_name(path, when=None):
+    """
+    Returns the name under which the local side of a conflict over PATH is kept, e.g.
+    "notes (conflict 2024-05-01 093000).txt".
+    """
+    path = Path(path)
+    stamp = time.strftime("%Y-%m-%d %H%M%S", time.localtime(when))
+    return path.with_name("%s (conflict %s)%s" % (path.stem, stamp, path.suffix)).as_posix()
+
+def resolve(policy, kind, local_mtime_ns, drive_file):
+    """
+    Returns which side wins a conflict of KIND under POLICY: "local", "remote", "both" (keep the
+    two versions side by side) or None (leave it alone). LOCAL_MTIME_NS and DRIVE_FILE are those of
+    the sides still present.
+    """
+    if policy in ("local", "remote", "skip"):
+        return None if policy == "skip" else policy
+    if kind == DELETED_LOCALLY:
+        return "remote"
+    if kind == DELETED_REMOTELY:
+        return "local"
+    if policy == "keep-both":
+        return "both"
+    # newer
+    if drive_file.get("modifiedDate") is None:
+        return "local"
+    return "local" if local_mtime_ns / 1e9 >= parse_drive_time(drive_file["modifiedDate"]) else "remote"
+
+def plan_sync(local_files, local_hashes, remote_files, remote_folders, remote_others, local_dirs, baseline,
+              policy="skip"):
+    """
+    Compares every path on either side with BASELINE (a dict of path -> BaselineEntry) and returns
+    a SyncPlan. A side whose MD5 still matches the baseline is unchanged, so the other side's
+    change (an add, a modification or a deletion) is carried over; a path both sides changed
+    differently is a conflict, resolved under POLICY (one of POLICIES).
+
+    LOCAL_FILES maps paths to (size, mtime_ns), LOCAL_HASHES paths to MD5s, and LOCAL_DIRS holds
+    local directories; the remote dicts are as returned by scan_remote.
+    """
+    plan = SyncPlan()
+
+    def carry(path, winner):
+        drive_file, local = remote_files.get(path), local_files.get(path)
+        if winner == "local" and local is None:
+            plan.trash_remote.append((path, drive_file))
+        elif winner == "local" and drive_file is None:
+            plan.uploads.append(path)
+        elif winner == "local":
+            plan.updates.append((path, drive_file))
+        elif drive_file is None:
+            plan.delete_local.append(path)
+        else:
+            plan.downloads.append((path, drive_file))
+
+    for path in sorted(set(local_files) | set(remote_files) | set(baseline)):
+        local, drive_file, entry = local_files.get(path), remote_files.get(path), baseline.get(path)
+
+        # A file on one side where the other has a folder, or something without content.
+        if local is not None and (path in remote_folders or path in remote_others):
+            plan.skipped.append((path, "a remote folder or Google Docs file has the same name"))
+            continue
+        if drive_file is not None and path in local_dirs:
+            plan.skipped.append((path, "a local directory has the same name"))
+            continue
+
+        local_md5 = local_hashes.get(path) if local is not None else None
+        remote_md5 = drive_file["md5Checksum"] if drive_file is not None else None
+        base_md5 = entry.md5 if entry is not None else None
+        local_changed, remote_changed = local_md5 != base_md5, remote_md5 != base_md5
+
+        if not local_changed and not remote_changed:
+            if entry is not None and (entry.modified_date != drive_file.get("modifiedDate") or
+                                      entry.file_id != drive_file["id"] or (entry.size, entry.mtime_ns) != local):
+                plan.record.append((path, drive_file))
+        elif local_md5 == remote_md5:
+            # Changed the same way on both sides, or deleted from both.
+            if local_md5 is None:
+                plan.forget.append(path)
+            else:
+                plan.record.append((path, drive_file))
+        elif not remote_changed:
+            carry(path, "local")
+        elif not local_changed:
+            carry(path, "remote")
+        else:
+            kind = DELETED_LOCALLY if local is None else DELETED_REMOTELY if drive_file is None else BOTH_CHANGED
+            winner = resolve(policy, kind, local[1] if local is not None else None, drive_file or {})
+            plan.conflicts.append((path, kind, winner))
+            if winner == "both":
+                copy_path = conflict_name(path, local[1] / 1e9)
+                plan.renames.append((path, copy_path))
+                plan.uploads.append(copy_path)
+                plan.downloads.append((path, drive_file))
+            elif winner is not None:
+                carry(path, winner)
+
+    if plan.trash_remote and len(plan.trash_remote) == len(remote_files) and not local_files:
+        raise ValueError("Every local file is gone, which looks more like a missing disk than deletions; "
+                         "refusing to trash all %i remote files" % len(remote_files))
+    if plan.delete_local and len(plan.delete_local) == len(local_files) and not remote_files:
+        raise ValueError("Every remote file is gone; refusing to delete all %i local files" % len(local_files))
+
+    return plan
+
+def collapse_trash(trash_remote, remote_files, remote_folders, remote_others, local_dirs):
+    """
+    Returns the (path, drive file) pairs to trash for TRASH_REMOTE, trashing a whole folder instead
+    of its contents wherever the folder is gone locally and nothing else under it is kept.
+    """
+    trashed = {path for path, _ in trash_remote}
+    kept, emptied = set(), set()
+    for path in list(remote_files) + list(remote_others):
+        ancestors = kept if path not in trashed else emptied
+        ancestors.update(parent.as_posix() for parent in Path(path).parents)
+
+    covered = set()
+    for folder_path in sorted(emptied - kept, key=lambda path: path.count("/")):
+        if folder_path in remote_folders and folder_path not in local_dirs and folder_path != "." and \
+           not any(parent.as_posix() in covered for parent in Path(folder_path).parents):
+            covered.add(folder_path)
+
+    collapsed = [(folder_path, remote_folders[folder_path]) for folder_path in sorted(covered)]
+    for path, drive_file in trash_remote:
+        if not any(parent.as_posix() in covered for parent in Path(path).parents):
+            collapsed.append((path, drive_file))
+    return collapsed
+
+def remove_empty_dirs(local_root, rel_path, remote_folders):
+    """
+    Removes the directories above the deleted file REL_PATH that were left empty, up to the first
+    one that still has a remote folder (or LOCAL_ROOT).
+    """
+    for parent in Path(rel_path).parents:
+        rel_dir = parent.as_posix()
+        if rel_dir in ("", ".") or rel_dir in remote_folders:
+            return
+        try:
+            (Path(local_root) / rel_dir).rmdir()
+        except OSError:
+            return
+
+def nearest_folder_id(path, remote_folders):
+    for parent in Path(path).parents:
+        rel_dir = parent.as_posix()
+        if rel_dir == ".":
+            rel_dir = ""
+        if rel_dir in remote_folders:
+            return remote_folders[rel_dir]["id"]
+    return remote_folders[""]["id"]
+
+def hash_local(local_root, local_files, baseline, hash_cache=None):
+    """
+    Returns a dict of path -> MD5 for LOCAL_FILES, taking it from BASELINE for files whose size and
+    mtime haven't changed since the last sync, and hashing the rest (see hashing.hash_files).
+    """
+    from hashing import hash_files
+
+    hashes, to_hash = {}, []
+    for path, stat in local_files.items():
+        entry = baseline.get(path)
+        if entry is not None and (entry.size, entry.mtime_ns) == stat:
+            hashes[path] = entry.md5
+        else:
+            to_hash.append(path)
+
+    hashed = hash_files([Path(local_root) / path for path in to_hash], hash_cache)
+    for path in to_hash:
+        hashes[path] = hashed[Path(local_root) / path]
+    return hashes
+
+class TwoWaySync:
+    """
+    Two-way sync of the local directory LOCAL_ROOT with the remote folder REMOTE_ROOT against the
+    state recorded in BASELINE (a Baseline) after the last one: changes made on either side since
+    then are carried over to the other, and files changed on both are conflicts settled by a
+    policy. Only files are synced; directories and folders follow from them.
+
+    A file is only recorded in the baseline once it's alike on both sides, so anything that fails
+    is simply looked at again on the next run.
+    """
+
+    def __init__(self, local_root, remote_root, baseline):
+        self.local_root, self.remote_root = Path(local_root), Path(remote_root)
+        self.baseline = baseline
+        self.entries = {}
+        self.local_files, self.local_dirs, self.local_hashes = {}, set(), {}
+        self.remote_files, self.remote_folders, self.remote_others = {}, {}, {}
+
+    def scan(self, snapshot, hash_cache=None, workers=None):
+        self.entries = self.baseline.load(self.local_root, self.remote_root)
+        self.remote_files, self.remote_folders, self.remote_others = scan_remote(snapshot, self.remote_root)
+        self.local_files, self.local_dirs = scan_local(self.local_root, workers)
+        self.local_hashes = hash_local(self.local_root, self.local_files, self.entries, hash_cache)
+
+    def plan(self, policy="skip"):
+        return plan_sync(
+            self.local_files, self.local_hashes, self.remote_files, self.remote_folders, self.remote_others,
+            self.local_dirs, self.entries, policy)
+
+    def apply(self, drive, plan, upload_scheduler, download_scheduler, retry_policy=None):
+        """
+        Carries out PLAN: uploads and updates through UPLOAD_SCHEDULER at the same time as downloads
+        through DOWNLOAD_SCHEDULER, then deletions, then brings the baseline up to date. Returns a
+        2-tuple of (1) (local path, exception) pairs for everything that failed, and (2) the ids of
+        the remote files and folders trashed.
+        """
+        from batch import trash_files_batch
+        from concurrent.futures import ThreadPoolExecutor
+        from syncer import UploadItem
+
+        local_path = lambda path: self.local_root / path
+        relative = lambda local_path: local_path.relative_to(self.local_root).as_posix()
+
+        for path, copy_path in plan.renames:
+            os.rename(str(local_path(path)), str(local_path(copy_path)))
+            self.local_files[copy_path], self.local_hashes[copy_path] = self.local_files[path], self.local_hashes[path]
+
+        to_upload = [
+            UploadItem(nearest_folder_id(path, self.remote_folders), path, self.local_files[path][0])
+            for path in plan.uploads
+        ]
+        to_update = [(local_path(path), drive_file) for path, drive_file in plan.updates]
+        to_download = [(local_path(path), drive_file) for path, drive_file in plan.downloads]
+
+        errors = {}
+        with ThreadPoolExecutor(2, thread_name_prefix="sync") as executor:
+            uploading = executor.submit(
+                upload_scheduler.run, self.local_root, self.remote_root, to_upload, to_update) \
+                if to_upload or to_update else None
+            downloading = executor.submit(download_scheduler.run, to_download) if to_download else None
+            if uploading is not None:
+                for failed_path, _, error in uploading.result()[1]:
+                    errors[relative(failed_path)] = error
+            if downloading is not None:
+                for failed_path, error in downloading.result()[1]:
+                    errors[relative(failed_path)] = error
+
+        to_trash = collapse_trash(
+            plan.trash_remote, self.remote_files, self.remote_folders, self.remote_others, self.local_dirs)
+        trash_errors = trash_files_batch(
+            drive, [(self.remote_root / path, drive_file["id"]) for path, drive_file in to_trash], retry_policy)
+        trashed_paths = {}
+        for path, drive_file in to_trash:
+            trashed_paths[path] = trash_errors[drive_file["id"]]
+        for path, _ in plan.trash_remote:
+            for covering in [path] + [parent.as_posix() for parent in Path(path).parents]:
+                if trashed_paths.get(covering) is not None:
+                    errors[path] = trashed_paths[covering]
+                    break
+            if errors.get(path) is None:
+                print("Trashed remote %s" % (self.remote_root / path))
+
+        for path in plan.delete_local:
+            try:
+                local_path(path).unlink()
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                errors[path] = e
+                continue
+            print("Deleted local %s" % local_path(path))
+            remove_empty_dirs(self.local_root, path, self.remote_folders)
+
+        self.update_baseline(plan, errors)
+        return [(local_path(path), error) for path, error in sorted(errors.items())], \
+            [drive_file["id"] for path, drive_file in to_trash if trashed_paths[path] is None]
+
+    def update_baseline(self, plan, errors):
+        record = lambda entry: self.baseline.record(self.local_root, self.remote_root, entry)
+        forget = lambda path: self.baseline.forget(self.local_root, self.remote_root, path)
+
+        for path in plan.uploads:
+            if path not in errors:
+                record(BaselineEntry(path, self.local_hashes[path], *self.local_files[path]))
+        for path, drive_file in plan.updates:
+            if path not in errors:
+                record(BaselineEntry(path, self.local_hashes[path], *self.local_files[path], file_id=drive_file["id"]))
+        for path, drive_file in plan.downloads:
+            if path not in errors:
+                stat = (self.local_root / path).stat()
+                record(BaselineEntry(path, drive_file["md5Checksum"], stat.st_size, stat.st_mtime_ns,
+                                     drive_file.get("modifiedDate"), drive_file["id"]))
+        for path, drive_file in plan.record:
+            record(BaselineEntry(path, drive_file["md5Checksum"], *self.local_files[path],
+                                 drive_file.get("modifiedDate"), drive_file["id"]))
+        for path in plan.forget + plan.delete_local + [path for path, _ in plan.trash_remote]:
+            if path not in errors:
+                forget(path)
+        self.baseline.commit()
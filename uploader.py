@@ -0,0 +1,528 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from contextlib import nullcontext
+from pathlib import Path
+
+from pydrive.files import GoogleDriveFile
+
+from batch import create_folders_batch, lookup_files_batch
+from dedup import is_gone
+from hashing import md5_file
+from metrics import METRICS, Reporter
+from path_cache import PATH_CACHE
+from retry import RetryPolicy
+from scheduling import DEFAULT_LARGE_THRESHOLD, LargeFileLanesPolicy
+from session import reset_connections
+from snapshot import compact
+from resumable import DEFAULT_CHUNK_SIZE, DEFAULT_STATE_DIR, upload_file_resumable
+from syncer import create_remote_folder, get_file, move_file, update_file, upload_file_fast
+
+import heapq, queue, threading, time
+
+def format_bytes(num_bytes):
+    for unit in ["B", "KB", "MB", "GB", "TB"]:
+        if num_bytes < 1024 or unit == "TB":
+            break
+        num_bytes /= 1024
+    return "%.1f %s" % (num_bytes, unit)
+
+class TransferProgress:
+    """
+    Aggregates per-worker transfer counts into overall throughput figures, also counted in METRICS
+    under the DIRECTION label.
+    """
+
+    def __init__(self, total, direction="upload"):
+        self.total = total
+        self.direction = direction
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.workers = {}
+
+    def record(self, num_bytes):
+        worker = threading.current_thread().name
+        with self.lock:
+            files, total_bytes = self.workers.get(worker, (0, 0))
+            self.workers[worker] = (files + 1, total_bytes + num_bytes)
+        METRICS.inc("files_total", direction=self.direction)
+        METRICS.inc("bytes_total", num_bytes, direction=self.direction)
+
+    def totals(self):
+        with self.lock:
+            files = sum(files for files, _ in self.workers.values())
+            total_bytes = sum(num_bytes for _, num_bytes in self.workers.values())
+        return files, total_bytes
+
+    def rates(self):
+        files, total_bytes = self.totals()
+        elapsed = max(time.time() - self.started, 1e-6)
+        return files / elapsed, total_bytes / elapsed
+
+    def summary(self):
+        files, total_bytes = self.totals()
+        files_per_second, bytes_per_second = self.rates()
+        lines = ["%i / %i files, %s in %.1fs (%.2f files/s, %s/s)" % (
+            files, self.total, format_bytes(total_bytes), time.time() - self.started,
+            files_per_second, format_bytes(bytes_per_second))]
+        with self.lock:
+            for worker, (files, total_bytes) in sorted(self.workers.items()):
+                lines.append("  %s: %i files, %s" % (worker, files, format_bytes(total_bytes)))
+        return "\n".join(lines)
+
+def prefetch(iterable, max_queued=10000):
+    """
+    Runs ITERABLE in a background thread and yields its items through a queue holding at most
+    MAX_QUEUED of them, so the producer can work ahead of the consumer but only so far. An error
+    raised by the producer is re-raised to the consumer.
+    """
+    items, done = queue.Queue(max_queued), object()
+
+    def produce():
+        try:
+            for item in iterable:
+                items.put((item, None))
+            items.put((done, None))
+        except Exception as e:
+            items.put((done, e))
+
+    threading.Thread(target=produce, name="prefetch", daemon=True).start()
+    while True:
+        item, error = items.get()
+        if item is done:
+            if error is not None:
+                raise error
+            return
+        yield item
+
+def iter_chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+class UploadScheduler:
+    """
+    Uploads the UploadItems found by iter_missing_remote_files with a pool of NUM_WORKERS threads,
+    each using its own GoogleDrive client built by DRIVE_FACTORY. Items are taken CHUNK_ITEMS at a
+    time, and the remote folders a chunk needs are created one tree level at a time before any of
+    its files is uploaded, so a parent always exists before its children.
+
+    Which ready task a free worker gets next is up to POLICY (see scheduling.py), which is shown up
+    to LOOKAHEAD tasks at a time. By default large files get a lane of their own.
+
+    Several schedulers can share one EXECUTOR, and one RETRY_POLICY for a common request budget.
+    Progress is shown through REPORTER (see metrics.py), or a reporter of its own if VERBOSE.
+    """
+
+    def __init__(self, drive_factory, num_workers=4, resumable_threshold=None,
+                 chunk_size=DEFAULT_CHUNK_SIZE, state_dir=DEFAULT_STATE_DIR, retry_policy=None,
+                 batch_folders=True, journal=None, chunk_items=256, lookahead=1024, policy=None,
+                 executor=None, throttle=None, reporter=None, dedup=None, hash_cache=None, verbose=True):
+        self.drive_factory = drive_factory
+        self.num_workers = num_workers
+        self.verbose = verbose
+        self.reporter = reporter
+
+        # Whether folders are looked up and created through batch requests, a tree level at a time.
+        self.batch_folders = batch_folders
+
+        # If given, every item's progress is recorded in this journal (see journal.py) as it happens.
+        self.journal = journal
+
+        self.chunk_items = chunk_items
+        self.lookahead = lookahead
+        if policy is None:
+            policy = LargeFileLanesPolicy(resumable_threshold or DEFAULT_LARGE_THRESHOLD)
+        self.policy = policy
+
+        # If given, tasks run on this executor (shared with other schedulers) instead of a pool of our
+        # own, with at most NUM_WORKERS of them in flight at once.
+        self.executor = executor
+
+        # Bandwidth limit (see throttle.py) on every byte uploaded, if given.
+        self.throttle = throttle
+
+        # Shared by every worker, so throttling seen by one slows down all of them.
+        self.retry_policy = RetryPolicy() if retry_policy is None else retry_policy
+
+        # Files of at least RESUMABLE_THRESHOLD bytes go through resumable sessions.
+        self.resumable_threshold = resumable_threshold
+        self.chunk_size = chunk_size
+        self.state_dir = state_dir
+        self.local = threading.local()
+        self.factory_lock = threading.Lock()
+
+        # Compact metadata (see snapshot.compact) of every drive file and folder created.
+        self.created = []
+
+        # If given, a dedup.DedupIndex through which new files whose content is already on Drive are
+        # copied there instead of uploaded, going by local MD5s cached in HASH_CACHE.
+        self.dedup = dedup
+        self.hash_cache = hash_cache
+
+    def drive(self, reconnect=False):
+        if getattr(self.local, "drive", None) is None:
+            # Factories may authenticate, reading and rewriting the credentials file, so don't let
+            # workers race.
+            with self.factory_lock:
+                self.local.drive = self.drive_factory()
+        elif reconnect:
+            reset_connections(self.local.drive)
+        return self.local.drive
+
+    def run(self, local_root, remote_root, to_upload, to_update=(), to_move=()):
+        """
+        Uploads the UploadItems in TO_UPLOAD, replaces the content of the (local path, drive file)
+        pairs in TO_UPDATE, and relocates the (local path, old remote path) pairs in TO_MOVE to the
+        remote path matching their local path. TO_UPLOAD may be any iterable, including one that's
+        still diffing; it's read no faster than uploads go. Items that fail with a retryable error
+        are put back in the queue after a backoff delay, and only end up in ERRORED once the retry
+        policy gives up on them.
+
+        Returns a 2-tuple of (uploaded, errored): the number of items that made it, and a list of
+        (local path, item, exception) triples for those that didn't, where ITEM is the UploadItem,
+        the drive file to update, or the old remote path of a move.
+        """
+        local_root, remote_root = Path(local_root), Path(remote_root)
+
+        self.uploaded, self.errored, self.total = 0, [], 0
+        progress = TransferProgress(0)
+
+        # Progress is drawn by the reporter's thread, however fast or slowly items complete.
+        reporter = self.reporter
+        if reporter is None and self.verbose:
+            reporter = Reporter().start()
+
+        def status():
+            files_per_second, bytes_per_second = progress.rates()
+            return "Uploaded %i / %i - %.2f files/s, %s/s - %i running, %i queued" % (
+                self.uploaded + len(self.errored), self.total, files_per_second,
+                format_bytes(bytes_per_second), len(pending), len(self.policy) + len(delayed))
+
+        pending, delayed = {}, []
+        if reporter is not None:
+            reporter.add(status)
+
+        # A shared executor belongs to the caller, so only one made here gets shut down.
+        executor_context = nullcontext(self.executor) if self.executor is not None else \
+            ThreadPoolExecutor(self.num_workers, thread_name_prefix="upload")
+        with executor_context as executor:
+            tasks = self.iter_tasks(executor, local_root, remote_root, to_upload, to_update, to_move, progress)
+
+            # Entries are (task, size, attempt). Futures map to the entries running, DELAYED is a heap
+            # of entries waiting out a backoff, and the policy holds the ones ready to go.
+            sequence = 0
+            while True:
+                while tasks is not None and len(self.policy) + len(pending) < self.lookahead:
+                    entry = next(tasks, None)
+                    if entry is None:
+                        tasks = None
+                    else:
+                        self.policy.push(entry, entry[1])
+
+                while delayed and delayed[0][0] <= time.time():
+                    _, _, entry = heapq.heappop(delayed)
+                    self.policy.push(entry, entry[1])
+
+                while len(pending) < self.num_workers and len(self.policy):
+                    entry = self.policy.pop([size for _, size, _ in pending.values()])
+                    pending[self.submit(executor, entry[0])] = entry
+
+                METRICS.set("queued", len(self.policy) + len(delayed), direction="upload")
+                METRICS.set("in_flight", len(pending), direction="upload")
+                if not (pending or delayed):
+                    break
+
+                timeout = max(delayed[0][0] - time.time(), 0) if delayed else None
+                done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+                for future in done:
+                    task, size, attempt = pending.pop(future)
+                    (local_path, second), _, _ = task
+                    error = future.exception()
+                    if error is None:
+                        self.retry_policy.rate_limiter.on_success()
+                        self.settle(local_path, second)
+                    else:
+                        delay = self.retry_policy.on_failure(attempt, error)
+                        if delay is not None:
+                            print("Retrying %s in %.1fs after error: %s" % (local_path, delay, str(error)))
+                            heapq.heappush(delayed, (time.time() + delay, sequence, (task, size, attempt + 1)))
+                            if self.journal is not None:
+                                self.journal.retrying(local_path, error)
+                            sequence += 1
+                            continue
+                        print("Giving up on %s: %s" % (local_path, str(error)))
+                        self.settle(local_path, second, error)
+
+        if reporter is not None:
+            reporter.remove(status)
+            if reporter is not self.reporter:
+                reporter.stop()
+        if self.verbose:
+            print(progress.summary())
+            print(self.retry_policy.summary())
+            if self.dedup is not None:
+                print(self.dedup.summary())
+
+        return self.uploaded, self.errored
+
+    def iter_tasks(self, executor, local_root, remote_root, to_upload, to_update, to_move, progress):
+        """
+        Yields (task, size, 0) for every item, where a task is ((local path, second element of the
+        result), function, args), creating the folders each chunk of TO_UPLOAD needs just before its tasks. Items whose
+        folder couldn't be created are settled as failed on the spot.
+        """
+        remote_path = lambda local_path: remote_root / local_path.relative_to(local_root)
+        folders, folder_errors, created = {}, {}, set()
+
+        self.create_folders(
+            executor, [remote_path(local_path).parent for local_path, _ in to_move], folders, folder_errors, created)
+
+        for local_path, drive_file in to_update:
+            self.total += 1
+            progress.total += 1
+            yield ((local_path, drive_file), self.update, (local_path, drive_file, progress)), \
+                local_path.stat().st_size, 0
+
+        for local_path, old_remote_path in to_move:
+            self.total += 1
+            if remote_path(local_path).parent in folder_errors:
+                self.settle(local_path, old_remote_path, folder_errors[remote_path(local_path).parent])
+                continue
+            yield ((local_path, old_remote_path), self.move, (old_remote_path, remote_path(local_path))), 0, 0
+
+        for chunk in iter_chunks(to_upload, self.chunk_items):
+            self.create_folders(executor, [
+                remote_path(local_root / item.path) if item.size is None else remote_path(local_root / item.path).parent
+                for item in chunk
+            ], folders, folder_errors, created)
+
+            for item in chunk:
+                self.total += 1
+                local_path = local_root / item.path
+                if item.size is None:
+                    # Empty directories are done as soon as their folder exists.
+                    self.settle(local_path, item, folder_errors.get(remote_path(local_path)))
+                    continue
+
+                parent_path = remote_path(local_path).parent
+                if parent_path in folder_errors:
+                    self.settle(local_path, item, folder_errors[parent_path])
+                    continue
+
+                progress.total += 1
+                yield ((local_path, item), self.upload, (local_path, remote_path(local_path), folders[parent_path], progress)), \
+                    item.size, 0
+
+    def submit(self, executor, task):
+        return executor.submit(self.run_task, task)
+
+    def run_task(self, task):
+        (local_path, _), function, args = task
+        if self.journal is not None:
+            self.journal.started(local_path)
+        return function(*args)
+
+    def settle(self, local_path, second, error=None):
+        if error is None:
+            self.uploaded += 1
+        else:
+            self.errored.append((local_path, second, error))
+        if self.journal is not None:
+            self.journal.finished(local_path, error)
+
+    def create_folders(self, executor, remote_dir_paths, folders, errors, created):
+        """
+        Makes sure every path in REMOTE_DIR_PATHS exists remotely, creating missing ones (and their
+        missing ancestors) level by level. Fills in FOLDERS, a dict of path -> drive folder, ERRORS,
+        a dict of path -> exception for the folders that couldn't be created, and CREATED, the set
+        of paths created during this run. Paths already in FOLDERS or ERRORS are left alone.
+        """
+        needed = set()
+        for remote_dir_path in remote_dir_paths:
+            if remote_dir_path in folders or remote_dir_path in errors:
+                continue
+            needed.add(remote_dir_path)
+            needed.update(remote_dir_path.parents)
+        needed.discard(Path("/"))
+        needed.discard(Path("."))
+        needed.difference_update(folders, errors)
+
+        levels = {}
+        for remote_dir_path in needed:
+            levels.setdefault(len(remote_dir_path.parts), []).append(remote_dir_path)
+
+        for depth in sorted(levels):
+            if self.batch_folders:
+                self.create_folders_batched(levels[depth], folders, errors, created)
+                continue
+
+            futures = {}
+            for remote_dir_path in levels[depth]:
+                parent_path = remote_dir_path.parent
+                if parent_path in errors:
+                    errors[remote_dir_path] = errors[parent_path]
+                    continue
+
+                # Children of a folder created during this run can't exist yet, so skip the lookup.
+                parent_created = parent_path in created
+                future = executor.submit(
+                    self.retry_policy.call, self.ensure_folder, remote_dir_path, folders.get(parent_path),
+                    parent_created)
+                futures[future] = remote_dir_path
+
+            for future in as_completed(futures):
+                remote_dir_path = futures[future]
+                error = future.exception()
+                if error is not None:
+                    print("Failed to create remote folder %s: %s" % (remote_dir_path, str(error)))
+                    errors[remote_dir_path] = error
+                else:
+                    folders[remote_dir_path], was_created = future.result()
+                    if was_created:
+                        created.add(remote_dir_path)
+                        self.created.append(compact(folders[remote_dir_path]))
+
+    def create_folders_batched(self, remote_dir_paths, folders, errors, created):
+        """
+        Resolves one level of the folder tree with at most one batch of lookups and one batch of
+        creates (per 100 folders), filling in FOLDERS, ERRORS and CREATED.
+        """
+        drive = self.drive()
+        parent_id = lambda remote_dir_path: \
+            folders[remote_dir_path.parent]["id"] if remote_dir_path.parent in folders else "root"
+
+        to_lookup, to_create = [], []
+        for remote_dir_path in remote_dir_paths:
+            if remote_dir_path.parent in errors:
+                errors[remote_dir_path] = errors[remote_dir_path.parent]
+                continue
+
+            # Children of a folder created during this run can't exist yet, so skip the lookup.
+            if remote_dir_path.parent in created:
+                to_create.append(remote_dir_path)
+                continue
+
+            found, metadata = PATH_CACHE.lookup(remote_dir_path)
+            if not found:
+                to_lookup.append(remote_dir_path)
+            elif metadata is None:
+                to_create.append(remote_dir_path)
+            else:
+                folders[remote_dir_path] = GoogleDriveFile(auth=drive.auth, metadata=metadata, uploaded=True)
+
+        lookups = lookup_files_batch(
+            drive, [(parent_id(path), path.name) for path in to_lookup], self.retry_policy)
+        for remote_dir_path in to_lookup:
+            drive_folder, error = lookups[(parent_id(remote_dir_path), remote_dir_path.name)]
+            PATH_CACHE.put(remote_dir_path, drive_folder)
+            if error is not None:
+                print("Failed to look up remote folder %s: %s" % (remote_dir_path, str(error)))
+                errors[remote_dir_path] = error
+            elif drive_folder is None:
+                to_create.append(remote_dir_path)
+            else:
+                folders[remote_dir_path] = drive_folder
+
+        results = create_folders_batch(
+            drive, [(parent_id(path), path.name) for path in to_create], self.retry_policy)
+        for remote_dir_path in to_create:
+            drive_folder, error = results[(parent_id(remote_dir_path), remote_dir_path.name)]
+            if error is not None:
+                print("Failed to create remote folder %s: %s" % (remote_dir_path, str(error)))
+                errors[remote_dir_path] = error
+            else:
+                PATH_CACHE.put(remote_dir_path, drive_folder)
+                folders[remote_dir_path] = drive_folder
+                created.add(remote_dir_path)
+                self.created.append(compact(drive_folder))
+
+    def ensure_folder(self, remote_dir_path, drive_parent_dir, parent_created):
+        drive = self.drive()
+        if not parent_created:
+            drive_folder = get_file(drive, str(remote_dir_path))
+            if drive_folder is not None:
+                return drive_folder, False
+
+        if drive_parent_dir is None:
+            if remote_dir_path.parent in (Path("/"), Path(".")):
+                drive_parent_dir = {"id": "root"}
+            else:
+                drive_parent_dir = get_file(drive, str(remote_dir_path.parent))
+        return create_remote_folder(drive, remote_dir_path, drive_parent_dir), True
+
+    def is_resumable(self, local_path):
+        return self.resumable_threshold is not None and \
+            local_path.stat().st_size >= max(self.resumable_threshold, 1)
+
+    def upload(self, local_path, remote_path, drive_parent_dir, progress):
+        size = local_path.stat().st_size
+        if self.dedup is None or size == 0:
+            return self.send(local_path, remote_path, drive_parent_dir, progress)
+
+        md5 = self.hash_cache.get(local_path) if self.hash_cache is not None else None
+        if md5 is None:
+            md5 = md5_file(local_path)
+            if self.hash_cache is not None:
+                self.hash_cache.put(local_path, md5)
+
+        entry = self.dedup.claim(md5, size)
+        if entry is None:
+            drive_file = None
+            try:
+                drive_file = self.send(local_path, remote_path, drive_parent_dir, progress)
+            finally:
+                self.dedup.release(md5, drive_file)
+            return drive_file
+
+        self.retry_policy.rate_limiter.acquire()
+        try:
+            drive_file = self.dedup.link(self.drive(), entry, remote_path.name, drive_parent_dir["id"])
+        except Exception as e:
+            if not is_gone(e):
+                raise
+            # The index was out of date, so upload after all.
+            self.dedup.discard(md5, entry.file_id)
+            return self.upload(local_path, remote_path, drive_parent_dir, progress)
+
+        self.dedup.add(drive_file, md5)
+        self.dedup.record_saved(size)
+        progress.record(0)
+        self.created.append(compact(drive_file))
+        return drive_file
+
+    def send(self, local_path, remote_path, drive_parent_dir, progress):
+        if self.is_resumable(local_path):
+            return self.transfer(
+                local_path, progress, upload_file_resumable, local_path, remote_path, drive_parent_dir,
+                None, self.chunk_size, self.state_dir, throttle=self.throttle)
+        return self.transfer(
+            local_path, progress, upload_file_fast, local_path, remote_path, drive_parent_dir,
+            throttle=self.throttle)
+
+    def update(self, local_path, drive_file, progress):
+        if self.is_resumable(local_path):
+            self.transfer(
+                local_path, progress, upload_file_resumable, local_path, local_path, None,
+                drive_file["id"], self.chunk_size, self.state_dir, throttle=self.throttle)
+        else:
+            self.transfer(local_path, progress, update_file, local_path, drive_file, throttle=self.throttle)
+
+    def move(self, old_remote_path, remote_path):
+        self.retry_policy.rate_limiter.acquire()
+        self.created.append(compact(move_file(self.drive(), old_remote_path, remote_path)))
+
+    def transfer(self, local_path, progress, transfer_function, *args, **kwargs):
+        self.retry_policy.rate_limiter.acquire()
+        try:
+            drive_file = transfer_function(self.drive(), *args, **kwargs)
+        except ConnectionResetError:
+            self.drive(reconnect=True)
+            raise
+
+        progress.record(local_path.stat().st_size)
+        self.created.append(compact(drive_file))
+        return drive_file